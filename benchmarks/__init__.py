@@ -0,0 +1,7 @@
+"""
+Offline benchmarks for the chat apps.
+
+Run with ``python -m benchmarks.run``. The apps run inside an in-memory oTree
+database and their LLM calls go to the stub server in tools.stub_server
+in-process, so the timings only measure our own code.
+"""
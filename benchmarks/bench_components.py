@@ -0,0 +1,55 @@
+"""
+Benchmarks for the pieces every live method call repeats: decoding and
+encoding the JSON history cache, and the NPC distance check in threejs.
+"""
+
+import json
+import random
+
+from benchmarks.harness import summarize, time_calls
+
+
+# a history cache in the format used by chat_complex and similar apps
+def make_history(size, rng):
+    messages = []
+    for i in range(size):
+        sender = 'P1' if i % 2 == 0 else 'B1'
+        content = dict(
+            sender=sender,
+            msgId=f'{sender}-{1700000000 + i}.123456',
+            instructions='',
+            tone='friendly',
+            text=' '.join(rng.choice(['yes', 'no', 'maybe', 'politics', 'really', 'think']) for _ in range(30)),
+            reactions=json.dumps({'👍': rng.randint(0, 2), '👎': 0, '❤️': 0}),
+        )
+        messages.append({'role': 'user' if sender == 'P1' else 'assistant', 'content': json.dumps(content)})
+    return messages
+
+def bench_json_cache(sizes, repeat):
+    rng = random.Random(0)
+    results = {'decode': {}, 'encode': {}}
+    for size in sizes:
+        cached = json.dumps(make_history(size, rng))
+        messages = json.loads(cached)
+        results['decode'][str(size)] = summarize(time_calls(lambda: json.loads(cached), repeat))
+        results['encode'][str(size)] = summarize(time_calls(lambda: json.dumps(messages), repeat))
+    return results
+
+# time a batch of distance checks, as sent by posCheck and text events
+def bench_npc_distances(repeat, calls=1000):
+    import threejs
+
+    rng = random.Random(0)
+    positions = [{'x': rng.uniform(-25, 25), 'y': 2, 'z': rng.uniform(-15, 15)} for _ in range(calls)]
+
+    def batch():
+        for pos in positions:
+            threejs.calculate_npc_distances(pos)
+
+    return {f'batch_{calls}': summarize(time_calls(batch, repeat))}
+
+def run(sizes, repeat=5):
+    return dict(
+        json_cache=bench_json_cache(sizes, max(repeat, 20)),
+        calculate_npc_distances=bench_npc_distances(max(repeat, 20)),
+    )
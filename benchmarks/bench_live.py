@@ -0,0 +1,174 @@
+"""
+Live method benchmarks.
+
+Each app's conversation is replayed through its live method, and at every
+checkpoint size (number of messages in the history cache) each branch is
+timed: the page refresh ({}), text, botMsg, reaction and so on. Reactions
+always target the newest message, which is the worst case for the reaction
+recount loop. custom_export is timed at the same checkpoints.
+"""
+
+import json
+
+from benchmarks.harness import call_live, create_players, stub_llm, summarize, time_calls
+
+SAMPLE_TEXT = 'I think that is a fair point, but what about the other side?'
+
+
+########################################################
+# Conversation turns per app                           #
+########################################################
+
+# payload of the first reply
+def first(replies):
+    for reply in replies:
+        for payload in reply.values():
+            if payload:
+                return payload
+    return {}
+
+class Turns:
+
+    def __init__(self, module, players):
+        self.module = module
+        self.page = module.chat
+        self.players = players
+        self.times = None
+
+    async def send(self, branch, data, player=None):
+        replies, seconds = await call_live(self.page, player or self.players[0], data)
+        if self.times is not None:
+            self.times.setdefault(branch, []).append(seconds)
+        return first(replies)
+
+    async def react(self, reply, player=None):
+        msgId = reply.get('botMsgId') or reply.get('msgId')
+        if msgId:
+            await self.send('reaction', {'event': 'reaction', 'msgId': msgId, 'emoji': '👍', 'target': reply.get('sender', 'B1')}, player)
+
+    # number of messages in the history cache
+    def history_size(self):
+        player = self.players[0]
+        if hasattr(type(player.group), 'cachedMessages'):
+            return len(json.loads(player.group.cachedMessages))
+        return len(json.loads(player.cachedMessages))
+
+    async def start(self):
+        pass
+
+    async def turn(self):
+        await self.send('text', {'event': 'text', 'text': SAMPLE_TEXT})
+        await self.send('botMsg', {'event': 'botMsg'})
+
+
+class ReactionTurns(Turns):
+
+    async def turn(self):
+        await self.send('text', {'event': 'text', 'text': SAMPLE_TEXT})
+        reply = await self.send('botMsg', {'event': 'botMsg'})
+        await self.react(reply)
+
+
+class JapaneseTurns(ReactionTurns):
+
+    # answer the pre-chat question, which sets the bot's stance
+    async def start(self):
+        for player in self.players:
+            player.pre_chat_opinion = 2
+            self.module.PreChatQuestion.before_next_page(player, timeout_happened=False)
+
+
+class MultipleAgentsTurns(Turns):
+
+    async def start(self):
+        await self.send('phase', {'event': 'phase', 'phase': 1})
+        for botId in ('B1', 'M1'):
+            await self.send('greeting', {'event': 'botMsg', 'botId': botId, 'isGreeting': True})
+
+    async def turn(self):
+        await self.send('text', {'event': 'text', 'text': SAMPLE_TEXT})
+        reply = await self.send('botMsg', {'event': 'botMsg', 'botId': 'B1'})
+        await self.send('moderator', {'event': 'botMsg', 'botId': 'M1'})
+        await self.react(reply)
+
+
+class TwoHumansTurns(Turns):
+
+    async def start(self):
+        await self.send('phase', {'event': 'phase', 'phase': 1})
+        await self.send('greeting', {'event': 'botMsg', 'isGreeting': True})
+
+    async def turn(self):
+        p1, p2 = self.players
+        reply = await self.send('text', {'event': 'text', 'text': SAMPLE_TEXT}, p1)
+        await self.send('text', {'event': 'text', 'text': SAMPLE_TEXT}, p2)
+        await self.send('moderator', {'event': 'botMsg'}, p1)
+        await self.react(reply, p2)
+
+
+class ThreejsTurns(Turns):
+
+    async def start(self):
+        await self.send('phase', {'event': 'phase', 'phase': 0})
+
+    async def turn(self):
+        pos = dict(self.module.C.RED_POS, x=self.module.C.RED_POS['x'] + 2)
+        await self.send('posCheck', {'event': 'posCheck', 'pos': pos})
+        reply = await self.send('text', {'event': 'text', 'text': SAMPLE_TEXT, 'pos': pos})
+        await self.send('botMsg', {'event': 'botMsg', 'botId': reply.get('target') or 'Red'})
+
+
+# chat_voice (audio, s3) and traffic_light (no history) are not included
+APPS = {
+    'chat_simple': (Turns, 1),
+    'chat_complex': (ReactionTurns, 1),
+    'dictator_game': (ReactionTurns, 1),
+    'chat_japanese': (JapaneseTurns, 1),
+    'chat_multiple_agents': (MultipleAgentsTurns, 1),
+    'chat_2humans1bot': (TwoHumansTurns, 2),
+    'threejs': (ThreejsTurns, 1),
+}
+
+
+########################################################
+# Benchmark                                            #
+########################################################
+
+# grow the history up to each size and time every branch there
+async def bench_app(app, sizes, repeat):
+    cls, numParticipants = APPS[app]
+    module, players = create_players(app, numParticipants)
+    stub_llm(module)
+    turns = cls(module, players)
+    await turns.start()
+
+    results = {}
+    for size in sizes:
+        # untimed turns until the history is big enough
+        turns.times = None
+        while turns.history_size() < size:
+            before = turns.history_size()
+            await turns.turn()
+            if turns.history_size() == before:
+                raise RuntimeError(f'{app}: history stopped growing at {before} messages')
+
+        # timed turns (these add a few messages, which is fine at this scale)
+        turns.times = {}
+        for _ in range(repeat):
+            await turns.send('refresh', {})
+            await turns.turn()
+
+        for branch, times in turns.times.items():
+            results.setdefault(branch, {})[str(size)] = summarize(times)
+
+        # custom export over everything stored so far
+        for name in dir(module):
+            if name.startswith('custom_export'):
+                exportTimes = time_calls(lambda: getattr(module, name)(players), repeat)
+                results.setdefault(name, {})[str(size)] = summarize(exportTimes)
+
+        print(f'  {app}: {turns.history_size()} messages')
+    return results
+
+async def run(apps, sizes, repeat=5):
+    return {app: await bench_app(app, sizes, repeat) for app in apps}
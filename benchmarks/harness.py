@@ -0,0 +1,172 @@
+"""
+Shared setup for the benchmarks: an in-memory oTree project, a stubbed LLM,
+timing helpers, and the result history used to spot regressions.
+"""
+
+import contextlib
+import io
+import json
+import logging
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+from functools import partial
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# past runs, one json object per line
+HISTORY_FILE = os.path.join(ROOT, 'benchmarks', 'results', 'history.jsonl')
+
+# ignore differences smaller than this when comparing runs
+NOISE_FLOOR_MS = 0.05
+
+
+########################################################
+# oTree setup                                          #
+########################################################
+
+_READY = False
+
+# load the project with an in-memory database
+## oTree opens db.sqlite3 in the working directory when it is imported,
+## so import it from a temp folder to keep the project folder clean
+def setup_otree():
+    global _READY
+    if _READY:
+        return
+    os.environ['OTREE_IN_MEMORY'] = '1'
+    os.environ.setdefault('OPENAI_KEY', 'stub')
+    os.environ.setdefault('LOG_LEVEL', 'WARNING')
+    if ROOT not in sys.path:
+        sys.path.insert(0, ROOT)
+    os.chdir(tempfile.mkdtemp(prefix='otree_bench_'))
+    import otree.database  # noqa
+    os.chdir(ROOT)
+
+    from otree.main import setup
+    setup()
+    logging.getLogger('httpx').setLevel(logging.WARNING)
+    _READY = True
+
+# route an app's openai client to the stub server, without opening sockets
+def stub_llm(module):
+    import httpx
+    import openai
+    from tools.stub_server import StubServer
+
+    transport = httpx.ASGITransport(app=StubServer().app())
+    module.AsyncOpenAI = partial(
+        openai.AsyncOpenAI,
+        base_url='http://stub/v1',
+        http_client=httpx.AsyncClient(transport=transport),
+    )
+
+# create a session and return its players for one app
+def create_players(app: str, numParticipants: int = 1):
+    import importlib
+    import otree.session
+
+    module = importlib.import_module(app)
+    session = otree.session.create_session(session_config_name=app, num_participants=numParticipants)
+    players = [module.Player.objects_get(participant=pp) for pp in session.get_participants()]
+    return module, players
+
+
+########################################################
+# Timing                                               #
+########################################################
+
+# run a live method with one message and return (replies, seconds)
+async def call_live(page, player, data):
+    replies = []
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        async for reply in page.live_method(player, data):
+            replies.append(reply)
+    return replies, time.perf_counter() - start
+
+# time a plain function over several repeats and return the seconds of each
+def time_calls(func, repeat=5):
+    times = []
+    with contextlib.redirect_stdout(io.StringIO()):
+        for _ in range(repeat):
+            start = time.perf_counter()
+            result = func()
+            # consume generators such as custom_export
+            if hasattr(result, '__next__'):
+                for _ in result:
+                    pass
+            times.append(time.perf_counter() - start)
+    return times
+
+def summarize(times) -> dict:
+    times = sorted(times)
+    return dict(
+        median_ms=round(statistics.median(times) * 1000, 4),
+        p95_ms=round(times[min(len(times) - 1, int(0.95 * len(times)))] * 1000, 4),
+        n=len(times),
+    )
+
+
+########################################################
+# Result history                                       #
+########################################################
+
+def git_revision():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True, text=True).stdout.strip()
+        dirty = bool(subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=ROOT, capture_output=True, text=True).stdout.strip())
+        return commit or None, dirty
+    except OSError:
+        return None, False
+
+def machine_id() -> str:
+    return f'{platform.node()}/{platform.machine()}/py{platform.python_version()}'
+
+def make_record(results: dict, config: dict) -> dict:
+    commit, dirty = git_revision()
+    return dict(
+        commit=commit,
+        dirty=dirty,
+        timestamp=datetime.now(tz=timezone.utc).isoformat(),
+        machine=machine_id(),
+        config=config,
+        results=results,
+    )
+
+def load_history(path=HISTORY_FILE):
+    if not os.path.exists(path):
+        return []
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+def save_record(record, path=HISTORY_FILE):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'a') as f:
+        f.write(json.dumps(record, ensure_ascii=False) + '\n')
+
+# flatten nested results to {'live/chat_complex/botMsg/500': median_ms}
+def flatten(results, prefix=''):
+    flat = {}
+    for key, value in results.items():
+        if isinstance(value, dict) and 'median_ms' in value:
+            flat[f'{prefix}{key}'] = value['median_ms']
+        elif isinstance(value, dict):
+            flat.update(flatten(value, f'{prefix}{key}/'))
+    return flat
+
+# list benchmarks that got slower than the baseline by more than `threshold`
+def compare(baseline: dict, current: dict, threshold=0.2):
+    old, new = flatten(baseline['results']), flatten(current['results'])
+    rows = []
+    for key in sorted(old.keys() & new.keys()):
+        before, after = old[key], new[key]
+        change = (after - before) / before if before else 0.0
+        regressed = change > threshold and after - before > NOISE_FLOOR_MS
+        rows.append((key, before, after, change, regressed))
+    return rows
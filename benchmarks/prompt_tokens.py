@@ -0,0 +1,60 @@
+"""
+Prompt tokens per bot request in chat_japanese, for each way of attaching the
+output instructions (C.INSTRUCTIONS_MODE), as the chat history grows.
+
+    python -m benchmarks.prompt_tokens --sizes 0,10,50,100,250
+
+'every_message' copies the instructions into every message of the history, so
+each turn's prompt grows by one copy of them on top of the new messages.
+'once' puts them in the latest participant message only. Tokens are counted
+with tiktoken if it is installed, otherwise estimated (see shared.prompts).
+"""
+
+import argparse
+import json
+import random
+from types import SimpleNamespace
+
+from benchmarks.bench_components import make_history
+from benchmarks.harness import setup_otree
+
+MODES = ['every_message', 'once']
+
+
+def prompt_tokens(sizes):
+    import chat_japanese
+    from shared.prompts import count_tokens
+
+    C = chat_japanese.C
+    topic = C.TOPICS[0]
+    player = SimpleNamespace(ai_stance='support', topic_title=topic['title'], topic_bot_context=topic['bot_context'])
+    botPrompt = chat_japanese.system_prompt(player).text
+    instructions = chat_japanese.instructions_prompt('friendly').render(msg_id=f'{C.BOT_LABEL}-1700000000.123456')
+
+    rng = random.Random(0)
+    rows = []
+    for size in sizes:
+        # histories end with the participant's message, as when botMsg arrives
+        history = make_history(size + 1, rng)
+        counts = {}
+        for mode in MODES:
+            messages = chat_japanese.build_request(botPrompt, history, instructions, mode=mode)
+            counts[mode] = count_tokens(json.dumps(messages, ensure_ascii=False), C.MODEL)
+        rows.append((size, counts))
+    return rows
+
+def main():
+    parser = argparse.ArgumentParser(description='Prompt tokens per bot request in chat_japanese')
+    parser.add_argument('--sizes', default='0,10,50,100,250,500', help='history sizes (comma separated)')
+    args = parser.parse_args()
+
+    setup_otree()
+    rows = prompt_tokens([int(x) for x in args.sizes.split(',')])
+    print(f"\n  {'history':>8s} {'every_message':>14s} {'once':>10s} {'saved':>10s}")
+    for size, counts in rows:
+        before, after = counts['every_message'], counts['once']
+        print(f'  {size:8d} {before:14d} {after:10d} {1 - after / before:10.0%}')
+
+
+if __name__ == '__main__':
+    main()
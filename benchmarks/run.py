@@ -0,0 +1,91 @@
+"""
+Run the offline benchmarks and compare them with earlier runs.
+
+    python -m benchmarks.run                      # all apps, history sizes 0..500
+    python -m benchmarks.run --app chat_complex --sizes 0,100,500 --repeat 10
+    python -m benchmarks.run --baseline 1e56ca2   # compare with a specific commit
+
+Every run is appended to benchmarks/results/history.jsonl together with the
+git commit it ran on. The report lists each benchmark's median next to the
+last run on the same machine (or the given baseline commit) and flags
+anything that got slower by more than --threshold.
+"""
+
+import argparse
+import asyncio
+import sys
+
+from benchmarks import bench_components, bench_live
+from benchmarks.harness import (
+    HISTORY_FILE, compare, flatten, load_history, machine_id, make_record, save_record, setup_otree,
+)
+
+DEFAULT_SIZES = '0,50,100,250,500'
+
+
+# latest earlier run on this machine, optionally for a given commit
+def find_baseline(history, commit=None):
+    for record in reversed(history):
+        if record.get('machine') != machine_id():
+            continue
+        if commit is None or (record.get('commit') or '').startswith(commit):
+            return record
+    return None
+
+def print_results(results):
+    print()
+    for key, median in flatten(results).items():
+        print(f'  {key:60s} {median:10.3f} ms')
+
+def print_comparison(baseline, record, threshold):
+    rows = compare(baseline, record, threshold)
+    print(f"\nCompared with {baseline['commit']}{' (dirty)' if baseline.get('dirty') else ''} from {baseline['timestamp']}:")
+    regressions = 0
+    for key, before, after, change, regressed in rows:
+        flag = '  << slower' if regressed else ''
+        regressions += regressed
+        print(f'  {key:60s} {before:10.3f} -> {after:10.3f} ms  ({change:+.0%}){flag}')
+    print(f'{regressions} regression(s) over {threshold:.0%}')
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline benchmarks for the chat apps')
+    parser.add_argument('--app', action='append', choices=list(bench_live.APPS), help='app to benchmark (repeatable, default all)')
+    parser.add_argument('--sizes', default=DEFAULT_SIZES, help='history sizes to time at (comma separated)')
+    parser.add_argument('--repeat', type=int, default=5, help='timed turns per size')
+    parser.add_argument('--skip-live', action='store_true', help='only run the component benchmarks')
+    parser.add_argument('--baseline', help='commit to compare with (default: previous run on this machine)')
+    parser.add_argument('--threshold', type=float, default=0.2, help='slowdown that counts as a regression')
+    parser.add_argument('--no-save', action='store_true', help="don't add this run to the history")
+    parser.add_argument('--fail-on-regression', action='store_true', help='exit with status 1 if anything regressed')
+    args = parser.parse_args()
+
+    sizes = [int(x) for x in args.sizes.split(',')]
+    apps = args.app or list(bench_live.APPS)
+
+    setup_otree()
+    results = {'components': bench_components.run(sizes, args.repeat)}
+    if not args.skip_live:
+        print('Running live method benchmarks...')
+        results['live'] = asyncio.run(bench_live.run(apps, sizes, args.repeat))
+
+    record = make_record(results, dict(apps=apps, sizes=sizes, repeat=args.repeat))
+    print_results(results)
+
+    regressions = 0
+    baseline = find_baseline(load_history(), args.baseline)
+    if baseline is not None:
+        regressions = print_comparison(baseline, record, args.threshold)
+    elif args.baseline:
+        print(f'\nNo earlier run for {args.baseline} on this machine')
+
+    if not args.no_save:
+        save_record(record)
+        print(f'\nSaved to {HISTORY_FILE}')
+
+    if args.fail_on_regression and regressions:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -2,11 +2,15 @@ from otree.api import *
 from os import environ
 from openai import AsyncOpenAI
 import random
-import re
-import asyncio
 import json
 from pydantic import BaseModel 
 from datetime import datetime, timezone
+from shared.llm import call_model_chain, canned_response, fallback_chain
+from shared.hedge import HedgePolicy
+from shared.scheduler import MODERATOR
+from shared.warmup import Warmup
+from shared.tracing import span, trace_live_method
+from shared.log import log_context
 
 doc = """
 LLM chat with multiple agents, based on chat_complex
@@ -54,6 +58,30 @@ class C(BaseConstants):
     ## IMPORTANT: for this app, you must use a model that supports structured output
     MODEL = "gpt-4o-mini"
 
+    ## models to try in order, with the seconds each gets before the next is tried
+    ## None gives a model whatever is left of TURN_DEADLINE
+    FALLBACK_MODEL = "gpt-4.1-nano"
+    MODEL_CHAIN = [(MODEL, 8), (FALLBACK_MODEL, None)]
+
+    ## most seconds a bot turn can take, over all models and retries
+    TURN_DEADLINE = 20
+
+    ## send a second copy of a bot request that is slower than usual (the HEDGE_PERCENTILE of recent calls)
+    ## the copy that finishes first is used; HEDGE_MAX_COST_USD caps the extra spend and HEDGE_MAX_RATE the share of calls hedged, per hour
+    HEDGE = False
+    HEDGE_PERCENTILE = 95
+    HEDGE_MAX_COST_USD = 1.0
+    HEDGE_MAX_RATE = 0.2
+
+    ## if every model fails or the deadline passes: 'canned' replies with FALLBACK_TEXT, [] shows an error
+    FALLBACK = ['canned']
+    FALLBACK_TEXT = "Please keep going, I'll share some feedback in a moment."
+
+    ## generate bot greetings in the background when both players have arrived, so the first bot message shows at once
+    ## PREGENERATE_CONCURRENCY caps how many greetings are generated at the same time
+    PREGENERATE_GREETINGS = False
+    PREGENERATE_CONCURRENCY = 4
+
     ## set system prompt for moderator bot
     ## according to OpenAI's documentation, this should be less than ~1500 words
     SYS_MODERATOR = f"""You are Moderator bot, a helpful dialogue coach analyzing conversations to improve discussion quality. You will be moderating a discussion between two human participants on the merits of cognitive dissonance vs. self-perception theory. As a greeting, state that you are excited to moderate the discussion. For each intervention:
@@ -87,6 +115,17 @@ class C(BaseConstants):
 # LLM Setup                                            #
 ########################################################
 
+# hedging for slow bot requests (see C.HEDGE)
+HEDGE_POLICY = HedgePolicy(
+    __name__,
+    percentile=C.HEDGE_PERCENTILE,
+    max_cost=C.HEDGE_MAX_COST_USD,
+    max_rate=C.HEDGE_MAX_RATE,
+) if C.HEDGE else None
+
+# greetings generated ahead of time (see C.PREGENERATE_GREETINGS)
+GREETINGS = Warmup(__name__, concurrency=C.PREGENERATE_CONCURRENCY)
+
 # specify json schema for bot messages
 class MsgOutputSchema(BaseModel):
     sender: str
@@ -126,51 +165,40 @@ async def runModeratorGPT(inputDat):
 
     # openai client and response creation
     client = AsyncOpenAI(api_key=C.OPENAI_KEY)
+    def request(model):
+        return client.responses.parse(
+            model=model,
+            input=inputMsg,
+            text_format=MsgOutputSchema,
+        )
+
+    # reply to use if the api is down
+    cannedReply = canned_response(MsgOutputSchema(
+        sender=botLabel, msgId=botMsgId, tone='moderator', text=C.FALLBACK_TEXT, reactions=json.dumps(reactionsDict),
+    ))
 
     # responses api with retries in case of rate limits
-    max_retries = 9
-    for attempt in range(max_retries):
-        try:
-            response = await client.responses.parse(
-                model=C.MODEL,
-                input=inputMsg,
-                text_format=MsgOutputSchema,
-            )
-
-            # if model supports reasoning, include, otherwise dont
-            reasoning = {'effort': C.REASONING_LVL} if 'gpt-5' in C.MODEL else None
-            response.reasoning = reasoning
-
-            # if model supports temperature, include, otherwise dont
-            temperature = botTemp if 'gpt-4' in C.MODEL else None
-            response.temperature = temperature
-            return response.output_parsed
-
-        except Exception as e:
-            if attempt < max_retries - 1:
-                # exponential backoff with larger delays and jitter; honor server hint if present
-                base_delay = min(64, 2 ** (attempt + 1))
-                hinted = None
-                try:
-                    m = re.search(r"Please try again in\s+([0-9]+(?:\.[0-9]+)?)s", str(e))
-                    if m:
-                        hinted = float(m.group(1))
-                except Exception:
-                    hinted = None
-                delay = max(base_delay, hinted or 0) + random.uniform(0, 1.0)
-                botLabel = inputDat.get('botLabel', 'UNKNOWN')
-                try:
-                    print(f"[LLM][retry] runGPT for {botLabel}: {e}. Retrying in {delay:.1f}s (attempt {attempt+1}/{max_retries})")
-                except Exception:
-                    pass
-                await asyncio.sleep(delay)
-            else:
-                botLabel = inputDat.get('botLabel', 'UNKNOWN')
-                try:
-                    print(f"[LLM][error] runGPT for {botLabel}: giving up after {max_retries} attempts. Last error: {e}")
-                except Exception:
-                    pass
-                raise
+    ## tries each model in C.MODEL_CHAIN within C.TURN_DEADLINE, then falls back as set in C.FALLBACK
+    response = await call_model_chain(
+        request,
+        C.MODEL_CHAIN,
+        deadline=C.TURN_DEADLINE,
+        hedge=HEDGE_POLICY,
+        app=__name__,
+        bot=inputDat.get('botLabel', 'UNKNOWN'),
+        name='runModeratorGPT',
+        priority=MODERATOR,
+        fallback=fallback_chain(C.FALLBACK, canned=cannedReply),
+    )
+
+    # if model supports reasoning, include, otherwise dont
+    reasoning = {'effort': C.REASONING_LVL} if 'gpt-5' in C.MODEL else None
+    response.reasoning = reasoning
+
+    # if model supports temperature, include, otherwise dont
+    temperature = botTemp if 'gpt-4' in C.MODEL else None
+    response.temperature = temperature
+    return response.output_parsed
 
 
 ########################################################
@@ -318,7 +346,13 @@ def custom_export(players):
 
 # wait page so both players arrive before chat begins
 class ChatWaitPage(WaitPage):
-    pass
+
+    # start generating the moderator's greeting once the group is complete
+    @staticmethod
+    def after_all_players_arrive(group: Group):
+        if C.PREGENERATE_GREETINGS:
+            inputDat = dict(botLabel=C.MOD_LABEL, messages=[], tone=group.get_player_by_id(1).tone)
+            GREETINGS.schedule(group.id, lambda: runModeratorGPT(inputDat))
 
 # chat page 
 class chat(Page):
@@ -352,8 +386,12 @@ class chat(Page):
 
     # live method functions
     @staticmethod
+    @trace_live_method(__name__)
     async def live_method(player: Player, data):
         group = player.group
+
+        # tag logs from this message with the session and participant
+        log_context(player)
         
         # if no new data, just return cached messages
         if not data:
@@ -364,7 +402,8 @@ class chat(Page):
             return
         
         # if we have new data, process it and update cache
-        messages = json.loads(group.cachedMessages)
+        with span('cache.decode'):
+            messages = json.loads(group.cachedMessages)
 
         # create current player identifier
         currentPlayer = 'P' + str(player.id_in_group)
@@ -393,14 +432,15 @@ class chat(Page):
                 reactionsDict = {emoji: 0 for emoji in C.EMOJIS}
       
                 # save to database
-                MessageData.create(
-                    player=player,
-                    sender=currentPlayer,
-                    msgId=msgId,
-                    timestamp=dateNow,
-                    tone=tone,
-                    msgText=text,
-                )
+                with span('db.write'):
+                    MessageData.create(
+                        player=player,
+                        sender=currentPlayer,
+                        msgId=msgId,
+                        timestamp=dateNow,
+                        tone=tone,
+                        msgText=text,
+                    )
 
                 # add message to list
                 messages.append({
@@ -412,7 +452,8 @@ class chat(Page):
                 })
                 
                 # update group cache and message count
-                group.cachedMessages = json.dumps(messages)
+                with span('cache.encode'):
+                    group.cachedMessages = json.dumps(messages)
                 group.messageCount += 1
                                 
                 # broadcast to all players in group
@@ -442,8 +483,12 @@ class chat(Page):
                 # handle moderator greeting (first message)
                 if isGreeting:
                     dateNow = str(datetime.now(tz=timezone.utc).timestamp())
-                    botText = await runModeratorGPT(inputDat)
-                        
+
+                    # use the greeting generated ahead of time if there is one
+                    botText = await GREETINGS.take(group.id)
+                    if botText is None:
+                        botText = await runModeratorGPT(inputDat)
+
                     # grab bot response data
                     outputText = botText.text
                     botMsgId = botText.msgId
@@ -451,14 +496,15 @@ class chat(Page):
                     botReactions = botText.reactions
 
                     # save to database
-                    MessageData.create(
-                        player=player,
-                        sender=modLabel,
-                        msgId=botMsgId,
-                        timestamp=dateNow,
-                        tone=botTone,
-                        msgText=outputText,
-                    )
+                    with span('db.write'):
+                        MessageData.create(
+                            player=player,
+                            sender=modLabel,
+                            msgId=botMsgId,
+                            timestamp=dateNow,
+                            tone=botTone,
+                            msgText=outputText,
+                        )
                     # update cache with bot message
                     messages.append({
                         'sender': 'assistant (Moderator)',
@@ -467,7 +513,8 @@ class chat(Page):
                         'text': outputText,
                         'reactions': json.dumps(botReactions),
                     })
-                    group.cachedMessages = json.dumps(messages)
+                    with span('cache.encode'):
+                        group.cachedMessages = json.dumps(messages)
                     group.lastModeratorBotMsg = group.messageCount
                     group.messageCount += 1
                     
@@ -501,14 +548,15 @@ class chat(Page):
                     botReactions = botText.reactions
 
                     # save to database
-                    MessageData.create(
-                        player=player,
-                        sender=modLabel,
-                        msgId=botMsgId,
-                        timestamp=dateNow,
-                        tone=botTone,
-                        msgText=outputText,
-                    )
+                    with span('db.write'):
+                        MessageData.create(
+                            player=player,
+                            sender=modLabel,
+                            msgId=botMsgId,
+                            timestamp=dateNow,
+                            tone=botTone,
+                            msgText=outputText,
+                        )
                     
                     # update group cache and message count
                     group.lastModeratorBotMsg = group.messageCount
@@ -520,7 +568,8 @@ class chat(Page):
                         'text': outputText,
                         'reactions': json.dumps(botReactions),
                     })
-                    group.cachedMessages = json.dumps(messages)
+                    with span('cache.encode'):
+                        group.cachedMessages = json.dumps(messages)
 
                     # broadcast to all players in group
                     response = dict(
@@ -558,15 +607,16 @@ class chat(Page):
                 
                 # create new reaction in database if not existing
                 if not existingReactions:
-                    MsgReactionData.create(
-                        player=player,
-                        sender=currentPlayer,
-                        msgId=msgId,
-                        msgReactionId=msgReactionId,
-                        timestamp=dateNow,
-                        target=trgt,
-                        emoji=emoji,
-                    )
+                    with span('db.write'):
+                        MsgReactionData.create(
+                            player=player,
+                            sender=currentPlayer,
+                            msgId=msgId,
+                            msgReactionId=msgReactionId,
+                            timestamp=dateNow,
+                            target=trgt,
+                            emoji=emoji,
+                        )
 
                     # update reaction counts in message cache
                     # search across ALL players in group for accurate counts
@@ -584,7 +634,8 @@ class chat(Page):
                             break
 
                     # update group cache
-                    group.cachedMessages = json.dumps(messages)
+                    with span('cache.encode'):
+                        group.cachedMessages = json.dumps(messages)
 
                     # broadcast reaction to all players in group
                     response = dict(
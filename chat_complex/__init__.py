@@ -5,6 +5,10 @@ import random
 import json
 from pydantic import BaseModel 
 from datetime import datetime, timezone
+from shared.llm import call_model_chain, canned_response, fallback_chain
+from shared.hedge import HedgePolicy
+from shared.tracing import span, trace_live_method
+from shared.log import log_context
 
 doc = """
 LLM chat with reactions and structured output
@@ -50,6 +54,25 @@ class C(BaseConstants):
     ## IMPORTANT: for this app, you must use a model that supports structured output
     MODEL = "gpt-4o-mini"
 
+    ## models to try in order, with the seconds each gets before the next is tried
+    ## None gives a model whatever is left of TURN_DEADLINE
+    FALLBACK_MODEL = "gpt-4.1-nano"
+    MODEL_CHAIN = [(MODEL, 8), (FALLBACK_MODEL, None)]
+
+    ## most seconds a bot turn can take, over all models and retries
+    TURN_DEADLINE = 20
+
+    ## send a second copy of a bot request that is slower than usual (the HEDGE_PERCENTILE of recent calls)
+    ## the copy that finishes first is used; HEDGE_MAX_COST_USD caps the extra spend and HEDGE_MAX_RATE the share of calls hedged, per hour
+    HEDGE = False
+    HEDGE_PERCENTILE = 95
+    HEDGE_MAX_COST_USD = 1.0
+    HEDGE_MAX_RATE = 0.2
+
+    ## if every model fails or the deadline passes: 'canned' replies with FALLBACK_TEXT, [] shows an error
+    FALLBACK = ['canned']
+    FALLBACK_TEXT = "Sorry, give me a moment to think about that."
+
     ## set system prompt for agents
     ## according to OpenAI's documentation, this should be less than ~1500 words
     SYS_BOT = f"""You are Alex, a human participant taking part in an online discussion. Always limit messages to less than 200 characters and speak in an informal language. 
@@ -78,6 +101,14 @@ class C(BaseConstants):
 # LLM Setup                                            #
 ########################################################
 
+# hedging for slow bot requests (see C.HEDGE)
+HEDGE_POLICY = HedgePolicy(
+    __name__,
+    percentile=C.HEDGE_PERCENTILE,
+    max_cost=C.HEDGE_MAX_COST_USD,
+    max_rate=C.HEDGE_MAX_RATE,
+) if C.HEDGE else None
+
 # specify json schema for bot messages
 class MsgOutputSchema(BaseModel):
     sender: str
@@ -118,51 +149,39 @@ async def runGPT(inputDat):
 
     # openai client and response creation
     client = AsyncOpenAI(api_key=C.OPENAI_KEY)
+    def request(model):
+        return client.responses.parse(
+            model=model,
+            input=inputMsg,
+            text_format=MsgOutputSchema,
+        )
+
+    # reply to use if the api is down
+    cannedReply = canned_response(MsgOutputSchema(
+        sender=botLabel, msgId=botMsgId, tone=tone, text=C.FALLBACK_TEXT, reactions=json.dumps(reactionsDict),
+    ))
 
     # responses api with retries in case of rate limits
-    max_retries = 9
-    for attempt in range(max_retries):
-        try:
-            response = await client.responses.parse(
-                model=C.MODEL,
-                input=inputMsg,
-                text_format=MsgOutputSchema,
-            )
-
-            # if model supports reasoning, include, otherwise dont
-            reasoning = {'effort': C.REASONING_LVL} if 'gpt-5' in C.MODEL else None
-            response.reasoning = reasoning
-
-            # if model supports temperature, include, otherwise dont
-            temperature = botTemp if 'gpt-4' in C.MODEL else None
-            response.temperature = temperature
-            return response.output_parsed
-
-        except Exception as e:
-            if attempt < max_retries - 1:
-                # exponential backoff with larger delays and jitter; honor server hint if present
-                base_delay = min(64, 2 ** (attempt + 1))
-                hinted = None
-                try:
-                    m = re.search(r"Please try again in\s+([0-9]+(?:\.[0-9]+)?)s", str(e))
-                    if m:
-                        hinted = float(m.group(1))
-                except Exception:
-                    hinted = None
-                delay = max(base_delay, hinted or 0) + random.uniform(0, 1.0)
-                botLabel = inputDat.get('botLabel', 'UNKNOWN')
-                try:
-                    print(f"[LLM][retry] runGPT for {botLabel}: {e}. Retrying in {delay:.1f}s (attempt {attempt+1}/{max_retries})")
-                except Exception:
-                    pass
-                await asyncio.sleep(delay)
-            else:
-                botLabel = inputDat.get('botLabel', 'UNKNOWN')
-                try:
-                    print(f"[LLM][error] runGPT for {botLabel}: giving up after {max_retries} attempts. Last error: {e}")
-                except Exception:
-                    pass
-                raise
+    ## tries each model in C.MODEL_CHAIN within C.TURN_DEADLINE, then falls back as set in C.FALLBACK
+    response = await call_model_chain(
+        request,
+        C.MODEL_CHAIN,
+        deadline=C.TURN_DEADLINE,
+        hedge=HEDGE_POLICY,
+        app=__name__,
+        bot=inputDat.get('botLabel', 'UNKNOWN'),
+        name='runGPT',
+        fallback=fallback_chain(C.FALLBACK, canned=cannedReply),
+    )
+
+    # if model supports reasoning, include, otherwise dont
+    reasoning = {'effort': C.REASONING_LVL} if 'gpt-5' in C.MODEL else None
+    response.reasoning = reasoning
+
+    # if model supports temperature, include, otherwise dont
+    temperature = botTemp if 'gpt-4' in C.MODEL else None
+    response.temperature = temperature
+    return response.output_parsed
 
 
 ########################################################
@@ -326,7 +345,11 @@ class chat(Page):
 
     # live method functions
     @staticmethod
+    @trace_live_method(__name__)
     async def live_method(player: Player, data):
+
+        # tag logs from this message with the session and participant
+        log_context(player)
         
         # if no new data, just return cached messages
         if not data:
@@ -336,7 +359,8 @@ class chat(Page):
             )}
         
         # if we have new data, process it and update cache
-        messages = json.loads(player.cachedMessages)
+        with span('cache.decode'):
+            messages = json.loads(player.cachedMessages)
 
         # create current player identifier
         currentPlayer = 'P' + str(player.id_in_group)
@@ -365,14 +389,15 @@ class chat(Page):
                 reactionsDict = {emoji: 0 for emoji in C.EMOJIS}
       
                 # save to database
-                MessageData.create(
-                    player=player,
-                    msgId=msgId,
-                    timestamp=dateNow,
-                    sender='Subject',
-                    tone=tone,
-                    msgText=text,
-                )
+                with span('db.write'):
+                    MessageData.create(
+                        player=player,
+                        msgId=msgId,
+                        timestamp=dateNow,
+                        sender='Subject',
+                        tone=tone,
+                        msgText=text,
+                    )
 
                 # add message to list
                 messages.append({
@@ -384,7 +409,8 @@ class chat(Page):
                 })
                 
                 # update cache
-                player.cachedMessages = json.dumps(messages)
+                with span('cache.encode'):
+                    player.cachedMessages = json.dumps(messages)
                 
                 # return output to chat.html
                 yield {player.id_in_group: dict(
@@ -420,14 +446,15 @@ class chat(Page):
                 botReactions = botText.reactions
 
                 # save to database
-                MessageData.create(
-                    player=player,
-                    sender=botId,
-                    msgId=botMsgId,
-                    timestamp=dateNow,
-                    tone=botTone,
-                    msgText=outputText,
-                )
+                with span('db.write'):
+                    MessageData.create(
+                        player=player,
+                        sender=botId,
+                        msgId=botMsgId,
+                        timestamp=dateNow,
+                        tone=botTone,
+                        msgText=outputText,
+                    )
 
                 # update cache with bot message
                 messages.append({
@@ -437,7 +464,8 @@ class chat(Page):
                     'text': outputText,
                     'reactions': json.dumps(botReactions),
                 })
-                player.cachedMessages = json.dumps(messages)
+                with span('cache.encode'):
+                    player.cachedMessages = json.dumps(messages)
 
                 # return output to chat.html
                 yield {player.id_in_group: dict(
@@ -472,15 +500,16 @@ class chat(Page):
                 
                 # create new reaction in database if not existing
                 if not existingReactions:
-                    MsgReactionData.create(
-                        player=player,
-                        sender=currentPlayer,
-                        msgId=msgId,
-                        msgReactionId=msgReactionId,
-                        timestamp=dateNow,
-                        target=trgt,
-                        emoji=emoji,
-                    )
+                    with span('db.write'):
+                        MsgReactionData.create(
+                            player=player,
+                            sender=currentPlayer,
+                            msgId=msgId,
+                            msgReactionId=msgReactionId,
+                            timestamp=dateNow,
+                            target=trgt,
+                            emoji=emoji,
+                        )
 
                     # update reaction counts in message cache
                     # this function looks through the database to make sure that players can only react once for each emoji/message
@@ -498,7 +527,8 @@ class chat(Page):
                             break
 
                     # update cache
-                    player.cachedMessages = json.dumps(messages)
+                    with span('cache.encode'):
+                        player.cachedMessages = json.dumps(messages)
 
                     # return output to chat.html
                     yield {player.id_in_group: dict(
@@ -5,6 +5,11 @@ import random
 import json
 from pydantic import BaseModel 
 from datetime import datetime, timezone
+from shared.llm import call_model_chain, canned_response, fallback_chain
+from shared.hedge import HedgePolicy
+from shared.prompts import PROMPTS
+from shared.tracing import span, trace_live_method
+from shared.log import log_context
 
 doc = """
 LLM chat with reactions and structured output
@@ -74,6 +79,31 @@ class C(BaseConstants):
     ## IMPORTANT: for this app, you must use a model that supports structured output
     MODEL = "gpt-4o-mini"
 
+    ## models to try in order, with the seconds each gets before the next is tried
+    ## None gives a model whatever is left of TURN_DEADLINE
+    FALLBACK_MODEL = "gpt-4.1-nano"
+    MODEL_CHAIN = [(MODEL, 8), (FALLBACK_MODEL, None)]
+
+    ## most seconds a bot turn can take, over all models and retries
+    TURN_DEADLINE = 20
+
+    ## send a second copy of a bot request that is slower than usual (the HEDGE_PERCENTILE of recent calls)
+    ## the copy that finishes first is used; HEDGE_MAX_COST_USD caps the extra spend and HEDGE_MAX_RATE the share of calls hedged, per hour
+    HEDGE = False
+    HEDGE_PERCENTILE = 95
+    HEDGE_MAX_COST_USD = 1.0
+    HEDGE_MAX_RATE = 0.2
+
+    ## if every model fails or the deadline passes: 'canned' replies with FALLBACK_TEXT, [] shows an error
+    FALLBACK = ['canned']
+    FALLBACK_TEXT = "すみません、少し考えさせてください。"
+
+    ## where the output instructions (msgId, tone, schema) go in each bot request
+    ## 'once': into the participant's latest message only, so the prompt doesn't grow by a copy of them every turn
+    ## 'every_message': copied into every message of the history, as in earlier versions of this app
+    ## either way, the saved chat history is left as it is
+    INSTRUCTIONS_MODE = 'once'
+
     ## set system prompt for agents
     ## according to OpenAI's documentation, this should be less than ~1500 words
     SYS_BOT = f"""あなたはアレックスという名前で、オンライン討論に参加している一般市民です。常にメッセージは200文字以内に制限し、カジュアルな日本語で話してください。
@@ -102,42 +132,25 @@ class C(BaseConstants):
 
 
 ########################################################
-# LLM Setup                                            #
+# Prompts                                              #
 ########################################################
 
-# specify json schema for bot messages
-class MsgOutputSchema(BaseModel):
-    sender: str
-    msgId: str
-    tone: str
-    text: str
-    reactions: str
-
-# function to run messages 
-async def runGPT(player, inputMessage, tone):
-
-    # grab bot vars from constants
-    botTemp = C.BOT_TEMP
-    botLabel = C.BOT_LABEL
-    
-    # AIの立場に基づいた説得指示を追加
-    if player.ai_stance == 'support':
-        persuasion_instruction = f"""
-        あなたの目標は、参加者を「{player.topic_title}」という立場に賛成するように説得することです。
+# persuasion goal for each stance the bot can take
+PROMPTS.register(f'{__name__}.persuasion.support', """
+        あなたの目標は、参加者を「{topic_title}」という立場に賛成するように説得することです。
         賛成する理由やメリットを強調し、反対意見に対する反論を提供してください。
         ただし、強引になりすぎず、建設的な対話を心がけてください。
-        """
-    else:  # oppose
-        persuasion_instruction = f"""
-        あなたの目標は、参加者を「{player.topic_title}」という立場に反対するように説得することです。
+        """)
+PROMPTS.register(f'{__name__}.persuasion.oppose', """
+        あなたの目標は、参加者を「{topic_title}」という立場に反対するように説得することです。
         反対する理由やリスク、問題点を強調し、賛成意見に対する反論を提供してください。
         ただし、強引になりすぎず、建設的な対話を心がけてください。
-        """
-    
-    # プレイヤーの論点情報と説得指示を使用してシステムプロンプトを構築
-    botPrompt = f"""あなたはアレックスという名前で、オンライン討論に参加している一般市民です。常にメッセージは200文字以内に制限し、カジュアルな日本語で話してください。
+        """)
+
+# system prompt with the player's topic and persuasion goal
+PROMPTS.register(f'{__name__}.system', """あなたはアレックスという名前で、オンライン討論に参加している一般市民です。常にメッセージは200文字以内に制限し、カジュアルな日本語で話してください。
 
-    {player.topic_bot_context}
+    {topic_bot_context}
     
     {persuasion_instruction}
 
@@ -149,9 +162,9 @@ async def runGPT(player, inputMessage, tone):
     - 応答するテキスト（文字列）
     - ユーザーが異なるメッセージに対して行ったリアクション（'reactions'フィールド内の文字列）
 
-    重要：このリストは、会話内のすべての参加者間のメッセージ履歴全体です。あなたが送信したメッセージは、'Sender'フィールドに{botLabel}とラベル付けされています。他の参加者は異なるラベルが付けられます（例：'P1'、'B1'など）。
+    重要：このリストは、会話内のすべての参加者間のメッセージ履歴全体です。あなたが送信したメッセージは、'Sender'フィールドに{bot_label}とラベル付けされています。他の参加者は異なるラベルが付けられます（例：'P1'、'B1'など）。
     
-    メッセージに対するリアクションを積極的に監視し、認識する必要があります。可能なリアクションは次のとおりです：{', '.join(C.EMOJIS)}
+    メッセージに対するリアクションを積極的に監視し、認識する必要があります。可能なリアクションは次のとおりです：{emojis}
     jsonでこれらのリアクションを見た場合は、自然に応答に組み込んでください。
     
     出力として、以下のjsonオブジェクトを提供する必要があります：
@@ -159,43 +172,139 @@ async def runGPT(player, inputMessage, tone):
     - 'msgId': 割り当てられたメッセージID
     - 'tone': 割り当てられたトーン
     - 'text': あなたの応答（300文字まで）
-    - 'reactions': 割り当てられたリアクション値"""
+    - 'reactions': 割り当てられたリアクション値""")
+
+# output instructions; only the message id changes from turn to turn
+PROMPTS.register(f'{__name__}.instructions', """
+        以下のスキーマでjsonオブジェクトを提供してください（割り当てられた値は変更しないでください）：
+            'sender': {bot_label} (文字列),
+            'msgId': {msg_id} (文字列), 
+            'tone': {tone} (文字列), 
+            'text': {tone}のトーンでユーザーのメッセージに対するあなたの応答（文字列）, 
+            'reactions': {reactions} (文字列)
+    """)
+
+# the player's system prompt, compiled once for each topic and stance
+def system_prompt(player):
+    stance = 'support' if player.ai_stance == 'support' else 'oppose'
+    persuasion = PROMPTS.compile(f'{__name__}.persuasion.{stance}', topic_title=player.topic_title)
+    return PROMPTS.compile(
+        f'{__name__}.system',
+        topic_bot_context=player.topic_bot_context,
+        persuasion_instruction=persuasion.text,
+        bot_label=C.BOT_LABEL,
+        emojis=', '.join(C.EMOJIS),
+    )
+
+# the player's output instructions, compiled once for each tone; render with msg_id
+def instructions_prompt(tone):
+    return PROMPTS.compile(
+        f'{__name__}.instructions',
+        bot_label=C.BOT_LABEL,
+        tone=tone,
+        reactions=json.dumps({emoji: 0 for emoji in C.EMOJIS}),
+    )
+
+
+########################################################
+# LLM Setup                                            #
+########################################################
+
+# hedging for slow bot requests (see C.HEDGE)
+HEDGE_POLICY = HedgePolicy(
+    __name__,
+    percentile=C.HEDGE_PERCENTILE,
+    max_cost=C.HEDGE_MAX_COST_USD,
+    max_rate=C.HEDGE_MAX_RATE,
+) if C.HEDGE else None
+
+# specify json schema for bot messages
+class MsgOutputSchema(BaseModel):
+    sender: str
+    msgId: str
+    tone: str
+    text: str
+    reactions: str
+
+# messages for a bot request: the system prompt, the chat history and the output instructions
+## the history is copied, not changed, so the instructions never end up in player.cachedMessages
+def build_request(botPrompt, history, instructions, mode=None):
+    mode = mode or C.INSTRUCTIONS_MODE
+    system = {'role': 'system', 'content': botPrompt}
+    if mode == 'every_message':
+        return [system] + [dict(x, instructions=json.dumps(instructions)) for x in history]
+
+    messages = [system] + [{'role': x['role'], 'content': x['content']} for x in history]
+
+    # fill the 'instructions' field of the participant's latest message
+    for i in range(len(messages) - 1, 0, -1):
+        if messages[i]['role'] != 'user':
+            continue
+        try:
+            content = json.loads(messages[i]['content'])
+        except (TypeError, ValueError):
+            break
+        if isinstance(content, dict):
+            content['instructions'] = instructions
+            messages[i] = dict(messages[i], content=json.dumps(content))
+            return messages
+        break
+
+    # no participant message to put them in
+    messages.append({'role': 'system', 'content': instructions})
+    return messages
+
+# function to run messages 
+async def runGPT(player, inputMessage, tone):
+
+    # grab bot vars from constants
+    botTemp = C.BOT_TEMP
+    botLabel = C.BOT_LABEL
+
+    # system prompt with the player's topic and stance, compiled once (see system_prompt)
+    botPrompt = system_prompt(player).text
     
     # assign message id and bot label
     dateNow = str(datetime.now(tz=timezone.utc).timestamp())
     botMsgId = botLabel + '-' + str(dateNow)
 
-    # grab text that participant inputs and format for chatgpt
+    # fill the message id into the player's output instructions
     reactionsDict = {emoji: 0 for emoji in C.EMOJIS}
-    instructions = f"""
-        以下のスキーマでjsonオブジェクトを提供してください（割り当てられた値は変更しないでください）：
-            'sender': {botLabel} (文字列),
-            'msgId': {botMsgId} (文字列), 
-            'tone': {tone} (文字列), 
-            'text': {tone}のトーンでユーザーのメッセージに対するあなたの応答（文字列）, 
-            'reactions': {json.dumps(reactionsDict)} (文字列)
-    """
-
-    # overwrite instructions for each dictionary
-    for x in inputMessage:
-        x['instructions'] = json.dumps(instructions)
+    instructions = instructions_prompt(tone).render(msg_id=botMsgId)
 
-    # combine input message with assigned prompt
-    inputMsg = [{'role': 'system', 'content': botPrompt}] + inputMessage
+    # combine the history with the assigned prompt and instructions (see C.INSTRUCTIONS_MODE)
+    inputMsg = build_request(botPrompt, inputMessage, instructions)
 
     # openai client and response creation
     client = AsyncOpenAI(api_key=C.OPENAI_KEY)
-    response = await client.chat.completions.create(
-        model=C.MODEL,
-        temperature=botTemp,
-        messages=inputMsg,
-        response_format={
-            "type": "json_schema",
-            "json_schema": {
-                "name": "msg_output_schema",
-                "schema": MsgOutputSchema.model_json_schema(),
+    def request(model):
+        return client.chat.completions.create(
+            model=model,
+            temperature=botTemp,
+            messages=inputMsg,
+            response_format={
+                "type": "json_schema",
+                "json_schema": {
+                    "name": "msg_output_schema",
+                    "schema": MsgOutputSchema.model_json_schema(),
+                }
             }
-        }
+        )
+
+    # reply to use if the api is down
+    cannedReply = canned_response(MsgOutputSchema(
+        sender=botLabel, msgId=botMsgId, tone=tone, text=C.FALLBACK_TEXT, reactions=json.dumps(reactionsDict),
+    ))
+
+    # tries each model in C.MODEL_CHAIN within C.TURN_DEADLINE, then falls back as set in C.FALLBACK
+    response = await call_model_chain(
+        request,
+        C.MODEL_CHAIN,
+        deadline=C.TURN_DEADLINE,
+        hedge=HEDGE_POLICY,
+        app=__name__,
+        bot=botLabel,
+        fallback=fallback_chain(C.FALLBACK, canned=cannedReply),
     )
 
     # grab text output
@@ -406,7 +515,11 @@ class chat(Page):
 
     # live method functions
     @staticmethod
+    @trace_live_method(__name__)
     async def live_method(player: Player, data):
+
+        # tag logs from this message with the session and participant
+        log_context(player)
         
         # if no new data, just return cached messages
         if not data:
@@ -416,7 +529,8 @@ class chat(Page):
             )}
         
         # if we have new data, process it and update cache
-        messages = json.loads(player.cachedMessages)
+        with span('cache.decode'):
+            messages = json.loads(player.cachedMessages)
 
         # create current player identifier
         currentPlayer = 'P' + str(player.id_in_group)
@@ -455,21 +569,23 @@ class chat(Page):
                 msg = {'role': 'user', 'content': json.dumps(content)}
 
                 # save to database
-                MessageData.create(
-                    player=player,
-                    msgId=msgId,
-                    timestamp=dateNow,
-                    sender='Subject',
-                    tone=tone,
-                    fullText=json.dumps(msg),
-                    msgText=text,
-                )
+                with span('db.write'):
+                    MessageData.create(
+                        player=player,
+                        msgId=msgId,
+                        timestamp=dateNow,
+                        sender='Subject',
+                        tone=tone,
+                        fullText=json.dumps(msg),
+                        msgText=text,
+                    )
 
                 # add message to list
                 messages.append(msg)
                 
                 # update cache
-                player.cachedMessages = json.dumps(messages)
+                with span('cache.encode'):
+                    player.cachedMessages = json.dumps(messages)
                 
                 # return output to chat.html
                 yield {player.id_in_group: dict(
@@ -499,19 +615,21 @@ class chat(Page):
                 botMsg = {'role': 'assistant', 'content': botText}
                 
                 # save to database
-                MessageData.create(
-                    player=player,
-                    sender=botId,
-                    msgId=botMsgId,
-                    timestamp=dateNow,
-                    tone=tone,
-                    fullText=json.dumps(botMsg),
-                    msgText=outputText,
-                )
+                with span('db.write'):
+                    MessageData.create(
+                        player=player,
+                        sender=botId,
+                        msgId=botMsgId,
+                        timestamp=dateNow,
+                        tone=tone,
+                        fullText=json.dumps(botMsg),
+                        msgText=outputText,
+                    )
 
                 # update cache with bot message
                 messages.append(botMsg)
-                player.cachedMessages = json.dumps(messages)
+                with span('cache.encode'):
+                    player.cachedMessages = json.dumps(messages)
 
                 # return output to chat.html
                 yield {player.id_in_group: dict(
@@ -545,15 +663,16 @@ class chat(Page):
                 
                 # create new reaction in database if not existing
                 if not existingReactions:
-                    MsgReactionData.create(
-                        player=player,
-                        sender=currentPlayer,
-                        msgId=msgId,
-                        msgReactionId=msgReactionId,
-                        timestamp=dateNow,
-                        target=trgt,
-                        emoji=emoji,
-                    )
+                    with span('db.write'):
+                        MsgReactionData.create(
+                            player=player,
+                            sender=currentPlayer,
+                            msgId=msgId,
+                            msgReactionId=msgReactionId,
+                            timestamp=dateNow,
+                            target=trgt,
+                            emoji=emoji,
+                        )
 
                     # update reaction counts in message cache
                     # this function looks through the database to make sure that players can only react once for each emoji/message
@@ -572,7 +691,8 @@ class chat(Page):
                             break
 
                     # update cache
-                    player.cachedMessages = json.dumps(messages)
+                    with span('cache.encode'):
+                        player.cachedMessages = json.dumps(messages)
 
                     # return output to chat.html
                     yield {player.id_in_group: dict(
@@ -611,6 +731,10 @@ class PreChatQuestion(Page):
             # 中立の場合はランダムにAIの立場を決定
             player.ai_stance = random.choice(['support', 'oppose'])
 
+        # the stance is known now, so compile the bot's prompts before the chat starts
+        system_prompt(player)
+        instructions_prompt(player.tone)
+
 # ポストチャット質問ページ
 class PostChatQuestion(Page):
     form_model = 'player'
@@ -3,7 +3,13 @@ from os import environ
 from openai import AsyncOpenAI
 import random
 import json
+import asyncio
 from datetime import datetime, timezone
+from shared.llm import BotThinking, call_model_chain, canned_response, fallback_chain
+from shared.hedge import HedgePolicy
+from shared.semantic_cache import SemanticCache
+from shared.tracing import span, trace_live_method
+from shared.log import log_context
 
 doc = """
 Simple LLM chat with a randomized condition
@@ -41,6 +47,41 @@ class C(BaseConstants):
     ## https://platform.openai.com/docs/models
     MODEL = "gpt-4o-mini"
 
+    ## models to try in order, with the seconds each gets before the next is tried
+    ## None gives a model whatever is left of TURN_DEADLINE
+    FALLBACK_MODEL = "gpt-4.1-nano"
+    MODEL_CHAIN = [(MODEL, 8), (FALLBACK_MODEL, None)]
+
+    ## most seconds a bot turn can take, over all models and retries
+    TURN_DEADLINE = 20
+
+    ## send a second copy of a bot request that is slower than usual (the HEDGE_PERCENTILE of recent calls)
+    ## the copy that finishes first is used; HEDGE_MAX_COST_USD caps the extra spend and HEDGE_MAX_RATE the share of calls hedged, per hour
+    HEDGE = False
+    HEDGE_PERCENTILE = 95
+    HEDGE_MAX_COST_USD = 1.0
+    HEDGE_MAX_RATE = 0.2
+
+    ## if every model fails or the deadline passes: 'canned' replies with FALLBACK_TEXT, [] shows an error
+    ## 'thinking' keeps the bot's typing indicator up and tries again after THINKING_RETRY_SECONDS,
+    ## up to THINKING_RETRIES times, before moving on to the next option (e.g. ['thinking', 'canned'])
+    FALLBACK = ['canned']
+    FALLBACK_TEXT = "Sorry, give me a moment to think about that."
+    THINKING_RETRY_SECONDS = 15
+    THINKING_RETRIES = 2
+
+    ## reuse the bot's reply when a participant's message in the first SEMANTIC_CACHE_TURNS turns
+    ## is near-identical (SEMANTIC_CACHE_THRESHOLD cosine similarity) to one answered in the same
+    ## condition in the last SEMANTIC_CACHE_TTL seconds, e.g. the many "hi, how are you?" openers
+    ## off by default: participants who get a cached reply see the same text, so leave it off where variability matters
+    ## SEMANTIC_CACHE_MODEL is a local sentence-transformers model (pip install sentence-transformers),
+    ## or 'hashing' to compare spelling only, with no extra package
+    SEMANTIC_CACHE = False
+    SEMANTIC_CACHE_MODEL = 'sentence-transformers/all-MiniLM-L6-v2'
+    SEMANTIC_CACHE_THRESHOLD = 0.92
+    SEMANTIC_CACHE_TTL = 3600
+    SEMANTIC_CACHE_TURNS = 1
+
     ## set system prompt for agents
     ## according to OpenAI's documentation, this should be less than ~1500 words
 
@@ -85,20 +126,52 @@ class C(BaseConstants):
 # LLM Setup                                            #
 ########################################################
 
+# hedging for slow bot requests (see C.HEDGE)
+HEDGE_POLICY = HedgePolicy(
+    __name__,
+    percentile=C.HEDGE_PERCENTILE,
+    max_cost=C.HEDGE_MAX_COST_USD,
+    max_rate=C.HEDGE_MAX_RATE,
+) if C.HEDGE else None
+
+# replies to near-identical early messages (see C.SEMANTIC_CACHE)
+BOT_CACHE = SemanticCache(
+    __name__,
+    embedder=C.SEMANTIC_CACHE_MODEL,
+    threshold=C.SEMANTIC_CACHE_THRESHOLD,
+    ttl=C.SEMANTIC_CACHE_TTL,
+    max_turns=C.SEMANTIC_CACHE_TURNS,
+) if C.SEMANTIC_CACHE else None
+
 # function to run messages (async)
-async def runGPT(inputMessage):
+## with thinking=False, a 'thinking' fallback is skipped (for the last retry)
+async def runGPT(inputMessage, thinking=True):
 
     # openai async client and response creation
     client = AsyncOpenAI(api_key=C.OPENAI_KEY)
-    response = await client.chat.completions.create(
-        model=C.MODEL,
-        temperature=C.BOT_TEMP,
-        messages=inputMessage,
-        stream=False,
+    def request(model):
+        return client.chat.completions.create(
+            model=model,
+            temperature=C.BOT_TEMP,
+            messages=inputMessage,
+            stream=False,
+        )
+
+    # tries each model in C.MODEL_CHAIN within C.TURN_DEADLINE, then falls back as set in C.FALLBACK
+    canned = canned_response(text=C.FALLBACK_TEXT)
+    fallbackModes = C.FALLBACK if thinking else [m for m in C.FALLBACK if m != 'thinking']
+    response = await call_model_chain(
+        request,
+        C.MODEL_CHAIN,
+        deadline=C.TURN_DEADLINE,
+        hedge=HEDGE_POLICY,
+        app=__name__,
+        bot=C.BOT_LABEL,
+        fallback=fallback_chain(fallbackModes, canned=canned, retry_after=C.THINKING_RETRY_SECONDS),
     )
 
-    # return just the text response
-    return response.choices[0].message.content
+    # return the text response, and whether it is the canned fallback
+    return response.choices[0].message.content, response is canned
 
 
 ########################################################
@@ -164,6 +237,8 @@ class MessageData(ExtraModel):
     sender = models.StringField()
     fullText = models.StringField()
     msgText = models.StringField()
+    # bot reply reused from the semantic cache (see C.SEMANTIC_CACHE)
+    cached = models.BooleanField(initial=False)
 
 
 ########################################################
@@ -182,6 +257,7 @@ def custom_export(players):
         'sender',
         'fullText',
         'msgText',
+        'cached',
     ]
 
     # get MessageData model
@@ -209,6 +285,7 @@ def custom_export(players):
             m.sender,
             fullText,
             m.msgText,
+            m.cached,
         ]
 
 ########################################################
@@ -253,7 +330,11 @@ class chat(Page):
 
     # live method functions (async)
     @staticmethod
+    @trace_live_method(__name__)
     async def live_method(player: Player, data):
+
+        # tag logs from this message with the session and participant
+        log_context(player)
         
         # if no new data, just return cached messages
         if not data:
@@ -263,7 +344,8 @@ class chat(Page):
             return
         
         # if we have new data, process it and update cache
-        messages = json.loads(player.cachedMessages)
+        with span('cache.decode'):
+            messages = json.loads(player.cachedMessages)
 
         # create current player identifier
         currentPlayer = 'P' + str(player.id_in_group)
@@ -289,21 +371,23 @@ class chat(Page):
                 inputMsg = {'role': 'user', 'content': text}
 
                 # create message data in database
-                MessageData.create(
-                    player = player,
-                    botParty = botParty,
-                    msgId = msgId,
-                    timestamp = dateNow,
-                    sender = 'Subject',
-                    fullText = json.dumps(inputMsg),
-                    msgText = text,
-                )
+                with span('db.write'):
+                    MessageData.create(
+                        player = player,
+                        botParty = botParty,
+                        msgId = msgId,
+                        timestamp = dateNow,
+                        sender = 'Subject',
+                        fullText = json.dumps(inputMsg),
+                        msgText = text,
+                    )
 
                 # add message to list
                 messages.append(inputMsg)
                 
                 # update cache
-                player.cachedMessages = json.dumps(messages)
+                with span('cache.encode'):
+                    player.cachedMessages = json.dumps(messages)
                 
                 # get css class for background color
                 if botParty == 'Republican':
@@ -340,25 +424,47 @@ class chat(Page):
                 # run llm on input text
                 dateNow = str(datetime.now(tz=timezone.utc).timestamp())
                 botMsgId = botId + '-' + str(dateNow)
-                botText = await runGPT(messages)
+                # reuse a cached reply to a near-identical opener if the cache is on
+                botText = await BOT_CACHE.lookup(messages, condition=botParty) if BOT_CACHE else None
+                cached = botText is not None
+                if botText is None:
+                    # while the api is down, show the bot as still thinking and try again later (see C.FALLBACK)
+                    for attempt in range(C.THINKING_RETRIES + 1):
+                        try:
+                            botText, usedFallback = await runGPT(messages, thinking=attempt < C.THINKING_RETRIES)
+                            break
+                        except BotThinking as e:
+                            yield {player.id_in_group: dict(
+                                event='botThinking',
+                                sender=botId,
+                                botClass=botClass,
+                                retryAfter=e.retry_after,
+                            )}
+                            await asyncio.sleep(e.retry_after)
+                    # don't cache the canned fallback as a reply
+                    if BOT_CACHE and not usedFallback:
+                        await BOT_CACHE.add(messages, botText, condition=botParty)
                 
                 # create bot message formatted for llm
                 botMsg = {'role': 'assistant', 'content': botText}
                 
                 # save to database
-                MessageData.create(
-                    player=player,
-                    botParty=botParty,
-                    msgId=botMsgId,
-                    timestamp=dateNow,
-                    sender=botId,
-                    fullText=json.dumps(botMsg),
-                    msgText=botText,
-                )
+                with span('db.write'):
+                    MessageData.create(
+                        player=player,
+                        botParty=botParty,
+                        msgId=botMsgId,
+                        timestamp=dateNow,
+                        sender=botId,
+                        fullText=json.dumps(botMsg),
+                        msgText=botText,
+                        cached=cached,
+                    )
 
                 # update cache with bot message
                 messages.append(botMsg)
-                player.cachedMessages = json.dumps(messages)
+                with span('cache.encode'):
+                    player.cachedMessages = json.dumps(messages)
 
                 # yield output to chat.html
                 yield {player.id_in_group: dict(
@@ -8,8 +8,21 @@ from datetime import datetime, timezone
 import httpx
 import base64
 import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config as BotoConfig
+import io
 import asyncio
-import requests as _requests
+from shared.recordings import RecordingStore
+from shared.stt import OpenAIWhisperBackend, LocalWhisperBackend
+from shared.audio import prepare_for_transcription
+from shared.llm import call_llm, call_model_chain, canned_response, current_call, fallback_chain
+from shared.tracing import span, trace_live_method
+from shared.log import get_logger, log_context, set_msg_id
+from shared.hedge import HedgePolicy
+from shared.dashboard import LIVE_STATS
+from shared.replay import replay_transport, sync_replay_transport
+
+logger = get_logger(__name__)
 
 doc = """
 Chat with voice via Whisper API and ElevenLabs. Based on chat_complex.
@@ -45,10 +58,33 @@ class C(BaseConstants):
     ### if set to false, audio will be saved locally to static folder
     AMAZON_S3 = False 
 
+    ## local recording writes
+    ### files are queued and written in the background; when the queue is full, new saves wait for room
+    RECORDING_QUEUE_SIZE = 64
+    ### 'none' (fastest), 'file' (fsync each file) or 'full' (also fsync the folder after renaming)
+    RECORDING_FSYNC = 'file'
+
     ## Amazon S3 keys
     AMAZON_S3_KEY = environ.get('AMAZON_S3_KEY')
     AMAZON_S3_SECRET = environ.get('AMAZON_S3_SECRET')
 
+    ## S3 upload tuning
+    ### connections kept open to S3 (shared by all participants on this server)
+    S3_MAX_POOL = 32
+    ### recordings larger than this (in bytes) are sent as multipart uploads
+    S3_MULTIPART_THRESHOLD = 8 * 1024 * 1024
+    ### attempts for background uploads of user audio before giving up
+    S3_ARCHIVE_RETRIES = 5
+
+    ## S3 audio urls
+    ### seconds a presigned url stays valid
+    S3_URL_EXPIRATION = 3600
+    ### bot audio files are never changed after upload, so they can be cached by the browser (and a CDN) for good
+    ### if True, bot audio is uploaded with a long-lived immutable Cache-Control header and served from long-lived urls
+    S3_IMMUTABLE_AUDIO = False
+    ### optional public base url (e.g. a CloudFront domain) used instead of presigned urls in immutable mode
+    S3_PUBLIC_URL = environ.get('AMAZON_S3_PUBLIC_URL')
+
     # LLM vars
     ## openAI key
     OPENAI_KEY = environ.get('OPENAI_KEY')
@@ -69,6 +105,25 @@ class C(BaseConstants):
     ## IMPORTANT: you must use a model that supports structured output
     MODEL = "gpt-4o-mini"
 
+    ## models to try in order, with the seconds each gets before the next is tried
+    ## None gives a model whatever is left of TURN_DEADLINE
+    FALLBACK_MODEL = "gpt-4.1-nano"
+    MODEL_CHAIN = [(MODEL, 8), (FALLBACK_MODEL, None)]
+
+    ## most seconds a bot turn can take, over all models and retries
+    TURN_DEADLINE = 20
+
+    ## send a second copy of a bot request that is slower than usual (the HEDGE_PERCENTILE of recent calls)
+    ## the copy that finishes first is used; HEDGE_MAX_COST_USD caps the extra spend and HEDGE_MAX_RATE the share of calls hedged, per hour
+    HEDGE = False
+    HEDGE_PERCENTILE = 95
+    HEDGE_MAX_COST_USD = 1.0
+    HEDGE_MAX_RATE = 0.2
+
+    ## if every model fails or the deadline passes: 'canned' replies with FALLBACK_TEXT, [] shows an error
+    FALLBACK = ['canned']
+    FALLBACK_TEXT = "Sorry, give me a moment to think about that."
+
     ## set system prompt for agents
     ## according to OpenAI's documentation, this should be less than ~1500 words
     SYS_BOT = f"""You are Alex, a human participant taking part in an online discussion. Always limit messages to less than 200 characters and speak in an informal language. 
@@ -92,6 +147,22 @@ class C(BaseConstants):
         - 'text': your response (limit to 300 characters)
         - 'reactions': your assigned reactions value"""
 
+    ## speech-to-text
+    ### 'openai' sends recordings to the Whisper API
+    ### 'local' runs faster-whisper on this server's CPU (pip install faster-whisper), which also works offline
+    STT_BACKEND = 'openai'
+    ### local model size ('tiny', 'base', 'small', ...) and number of worker processes
+    LOCAL_STT_MODEL = 'base'
+    LOCAL_STT_WORKERS = 2
+
+    ## audio preprocessing before transcription (needs: pip install av numpy)
+    ### cut leading and trailing silence; recordings with no speech are not transcribed
+    TRIM_SILENCE = False
+    ### send 16 kHz mono audio instead of the original recording
+    DOWNSAMPLE_AUDIO = False
+    ### frames quieter than this (in dBFS) count as silence
+    SILENCE_THRESHOLD_DB = -45
+
     ## ElevenLabs vars
     ELEVENLABS_KEY = environ.get('ELEVENLABS_KEY')
 
@@ -104,6 +175,14 @@ class C(BaseConstants):
 # LLM Setup                                            #
 ########################################################
 
+# hedging for slow bot requests (see C.HEDGE)
+HEDGE_POLICY = HedgePolicy(
+    __name__,
+    percentile=C.HEDGE_PERCENTILE,
+    max_cost=C.HEDGE_MAX_COST_USD,
+    max_rate=C.HEDGE_MAX_RATE,
+) if C.HEDGE else None
+
 # specify json schema for bot messages
 class MsgOutputSchema(BaseModel):
     sender: str
@@ -144,51 +223,39 @@ async def runGPT(inputDat):
 
     # openai client and response creation
     client = AsyncOpenAI(api_key=C.OPENAI_KEY)
+    def request(model):
+        return client.responses.parse(
+            model=model,
+            input=inputMsg,
+            text_format=MsgOutputSchema,
+        )
 
-    # responses api with retries in case of rate limits
-    max_retries = 9
-    for attempt in range(max_retries):
-        try:
-            response = await client.responses.parse(
-                model=C.MODEL,
-                input=inputMsg,
-                text_format=MsgOutputSchema,
-            )
+    # reply to use if the api is down
+    cannedReply = canned_response(MsgOutputSchema(
+        sender=botLabel, msgId=botMsgId, tone=tone, text=C.FALLBACK_TEXT, reactions=json.dumps(reactionsDict),
+    ))
 
-            # if model supports reasoning, include, otherwise dont
-            reasoning = {'effort': C.REASONING_LVL} if 'gpt-5' in C.MODEL else None
-            response.reasoning = reasoning
+    # responses api with retries in case of rate limits
+    ## tries each model in C.MODEL_CHAIN within C.TURN_DEADLINE, then falls back as set in C.FALLBACK
+    response = await call_model_chain(
+        request,
+        C.MODEL_CHAIN,
+        deadline=C.TURN_DEADLINE,
+        hedge=HEDGE_POLICY,
+        app=__name__,
+        bot=inputDat.get('botLabel', 'UNKNOWN'),
+        name='runGPT',
+        fallback=fallback_chain(C.FALLBACK, canned=cannedReply),
+    )
 
-            # if model supports temperature, include, otherwise dont
-            temperature = botTemp if 'gpt-4' in C.MODEL else None
-            response.temperature = temperature
-            return response.output_parsed
+    # if model supports reasoning, include, otherwise dont
+    reasoning = {'effort': C.REASONING_LVL} if 'gpt-5' in C.MODEL else None
+    response.reasoning = reasoning
 
-        except Exception as e:
-            if attempt < max_retries - 1:
-                # exponential backoff with larger delays and jitter; honor server hint if present
-                base_delay = min(64, 2 ** (attempt + 1))
-                hinted = None
-                try:
-                    m = re.search(r"Please try again in\s+([0-9]+(?:\.[0-9]+)?)s", str(e))
-                    if m:
-                        hinted = float(m.group(1))
-                except Exception:
-                    hinted = None
-                delay = max(base_delay, hinted or 0) + random.uniform(0, 1.0)
-                botLabel = inputDat.get('botLabel', 'UNKNOWN')
-                try:
-                    print(f"[LLM][retry] runGPT for {botLabel}: {e}. Retrying in {delay:.1f}s (attempt {attempt+1}/{max_retries})")
-                except Exception:
-                    pass
-                await asyncio.sleep(delay)
-            else:
-                botLabel = inputDat.get('botLabel', 'UNKNOWN')
-                try:
-                    print(f"[LLM][error] runGPT for {botLabel}: giving up after {max_retries} attempts. Last error: {e}")
-                except Exception:
-                    pass
-                raise
+    # if model supports temperature, include, otherwise dont
+    temperature = botTemp if 'gpt-4' in C.MODEL else None
+    response.temperature = temperature
+    return response.output_parsed
 
 
 ########################################################
@@ -196,11 +263,29 @@ async def runGPT(inputDat):
 ########################################################
 
 # httpx client for whisper transcription
-HTTPX_CLIENT = httpx.AsyncClient(timeout=30)
+## recorded or replayed like the bot's api calls if REPLAY_MODE is set
+HTTPX_CLIENT = httpx.AsyncClient(timeout=30, transport=replay_transport())
+
+# transcription backend
+if C.STT_BACKEND == 'local':
+    STT_BACKEND = LocalWhisperBackend(model_size=C.LOCAL_STT_MODEL, workers=C.LOCAL_STT_WORKERS)
+else:
+    STT_BACKEND = OpenAIWhisperBackend(HTTPX_CLIENT, C.OPENAI_KEY)
+
+# elevenlabs api root, can be pointed at a proxy or local stub server
+ELEVENLABS_BASE_URL = environ.get('ELEVENLABS_BASE_URL', 'https://api.elevenlabs.io').rstrip('/')
+ELEVENLABS_MODEL = 'eleven_multilingual_v2'
+
+# httpx client for elevenlabs, used from worker threads
+ELEVENLABS_CLIENT = httpx.Client(timeout=30, transport=sync_replay_transport())
 
 # function to get audio from elevenlabs via REST API
 def _call_elevenlabs(inputMessage: str, voice_id: str) -> bytes:
-    url = f"https://api.elevenlabs.io/v1/text-to-speech/{voice_id}"
+    # mark when a worker thread picked this up, so waiting for a thread counts as queue time
+    call = current_call()
+    if call is not None:
+        call.sent()
+    url = f"{ELEVENLABS_BASE_URL}/v1/text-to-speech/{voice_id}"
     key = C.ELEVENLABS_KEY.strip() if C.ELEVENLABS_KEY else ""
     headers = {
         "xi-api-key": key,
@@ -208,22 +293,30 @@ def _call_elevenlabs(inputMessage: str, voice_id: str) -> bytes:
     }
     payload = {
         "text": inputMessage,
-        "model_id": "eleven_multilingual_v2",
+        "model_id": ELEVENLABS_MODEL,
     }
-    resp = _requests.post(
+    resp = ELEVENLABS_CLIENT.post(
         url,
         headers=headers,
         json=payload,
         params={"output_format": "mp3_44100_128"},
-        timeout=30,
     )
     if resp.status_code != 200:
-        print(f"[ElevenLabs] Error {resp.status_code}: {resp.text}")
+        logger.error(f"ElevenLabs error {resp.status_code}: {resp.text}")
     resp.raise_for_status()
     return resp.content
 
-async def runVoiceAPI(inputMessage: str, voice_id: str) -> bytes:
-    return await asyncio.to_thread(_call_elevenlabs, inputMessage, voice_id)
+async def runVoiceAPI(inputMessage: str, voice_id: str, botLabel: str = '') -> bytes:
+    return await call_llm(
+        lambda: asyncio.to_thread(_call_elevenlabs, inputMessage, voice_id),
+        app=__name__,
+        bot=botLabel,
+        model=ELEVENLABS_MODEL,
+        kind='tts',
+        name='runVoiceAPI',
+        usage=lambda audio: dict(characters=len(inputMessage)),
+        max_retries=1,
+    )
 
 # for further prompt formatting, check out this page:
 # https://elevenlabs.io/docs/best-practices/prompting
@@ -237,11 +330,25 @@ async def runVoiceAPI(inputMessage: str, voice_id: str) -> bytes:
 ########################################################
 
 # load s3 bucket environment
+## keep a pool of connections open so concurrent uploads don't queue for a socket
 s3_client = boto3.client(
     's3',
     aws_access_key_id=C.AMAZON_S3_KEY,
     aws_secret_access_key=C.AMAZON_S3_SECRET,
     region_name='us-east-2',
+    config=BotoConfig(
+        max_pool_connections=C.S3_MAX_POOL,
+        tcp_keepalive=True,
+        retries={'max_attempts': 3, 'mode': 'adaptive'},
+    ),
+)
+
+# large recordings are split into parts and uploaded in parallel
+S3_TRANSFER_CONFIG = TransferConfig(
+    multipart_threshold=C.S3_MULTIPART_THRESHOLD,
+    multipart_chunksize=C.S3_MULTIPART_THRESHOLD,
+    max_concurrency=4,
+    use_threads=True,
 )
 
 s3_signer = boto3.client(
@@ -251,43 +358,101 @@ s3_signer = boto3.client(
     region_name='us-east-2',
 )
 
+# cache-control headers for uploaded audio
+S3_NO_CACHE = 'no-cache'
+S3_IMMUTABLE_CACHE = 'public, max-age=31536000, immutable'
+
+# longest expiration allowed for presigned urls (7 days)
+S3_MAX_URL_EXPIRATION = 7 * 24 * 3600
+
 # save audio to s3 function
-async def saveToS3(bucket: str, filename: str, audio: bytes) -> bool:
+async def saveToS3(bucket: str, filename: str, audio: bytes, cacheControl: str = S3_NO_CACHE) -> bool:
     content_type = 'audio/mpeg' if filename.endswith('.mp3') else 'audio/webm'
 
     def _put():
-        s3_client.put_object(
-                Bucket=bucket,
-                Key=filename,
-                Body=audio,
-                ContentType=content_type,
-                ContentDisposition='inline',
-                CacheControl='no-cache',
+        s3_client.upload_fileobj(
+                io.BytesIO(audio),
+                bucket,
+                filename,
+                ExtraArgs=dict(
+                    ContentType=content_type,
+                    ContentDisposition='inline',
+                    CacheControl=cacheControl,
+                ),
+                Config=S3_TRANSFER_CONFIG,
             )
         return True
 
     try:
-        return await asyncio.to_thread(_put)
+        with span('s3.upload', filename=filename, bytes=len(audio)):
+            return await asyncio.to_thread(_put)
     except Exception as e:
-        print(f'Error saving to S3: {e}')
+        logger.error(f'Error saving to S3: {e}')
         return False
 
+# background uploads that are still running
+## asyncio only keeps weak references to tasks, so hold on to them here
+BACKGROUND_UPLOADS = set()
+
+# save audio to s3, retrying with backoff if it fails
+async def archiveToS3(bucket: str, filename: str, audio: bytes) -> bool:
+    for attempt in range(C.S3_ARCHIVE_RETRIES):
+        if await saveToS3(bucket, filename, audio):
+            return True
+        if attempt < C.S3_ARCHIVE_RETRIES - 1:
+            await asyncio.sleep(min(30, 2 ** attempt) + random.uniform(0, 1.0))
+    logger.error(f'Giving up on saving {filename} to S3 after {C.S3_ARCHIVE_RETRIES} attempts')
+    return False
+
+# start an archival upload without waiting for it
+def archiveToS3InBackground(bucket: str, filename: str, audio: bytes) -> asyncio.Task:
+    task = asyncio.create_task(archiveToS3(bucket, filename, audio))
+    BACKGROUND_UPLOADS.add(task)
+    task.add_done_callback(BACKGROUND_UPLOADS.discard)
+    return task
+
 # grab s3 url function
-def get_s3_url(bucket, filename, expiration=3600):
+## called once per bot message, and every bot audio file has its own name, so the url isn't cached
+def get_s3_url(bucket, filename, expiration=None):
+
+    # immutable audio with a public/CDN domain doesn't need signing
+    if C.S3_IMMUTABLE_AUDIO and C.S3_PUBLIC_URL:
+        return f"{C.S3_PUBLIC_URL.rstrip('/')}/{filename}"
+
+    if expiration is None:
+        expiration = S3_MAX_URL_EXPIRATION if C.S3_IMMUTABLE_AUDIO else C.S3_URL_EXPIRATION
+
     try:
         content_type = 'audio/mpeg' if filename.endswith('.mp3') else 'audio/webm'
-        url = s3_signer.generate_presigned_url(
+        return s3_signer.generate_presigned_url(
             'get_object',
             Params={'Bucket': bucket, 'Key': filename, 'ResponseContentType': content_type},
             ExpiresIn=expiration,
         )
-        print(f"Generated S3 URL for {filename} with content type {content_type}")
-        return url
     except Exception as e:
-        print(f"Error generating S3 URL: {str(e)}")
+        logger.error(f"Error generating S3 URL: {str(e)}")
         return None
 
 
+########################################################
+# Local recording storage                              #
+########################################################
+
+# background writer for the static recordings folder
+## check RECORDING_STORE.health() for the current queue depth
+RECORDING_STORE = RecordingStore(
+    '_static/chat_voice/recordings',
+    max_queue=C.RECORDING_QUEUE_SIZE,
+    fsync=C.RECORDING_FSYNC,
+)
+
+# show the writer's queue depth on the live dashboard
+LIVE_STATS.register_queue('chat_voice recording writes', lambda: RECORDING_STORE.queue_depth)
+
+# background s3 uploads still running
+LIVE_STATS.register_queue('chat_voice s3 uploads', lambda: len(BACKGROUND_UPLOADS))
+
+
 ########################################################
 # Models                                               #
 ########################################################
@@ -449,7 +614,11 @@ class chat(Page):
 
     # live method functions
     @staticmethod
+    @trace_live_method(__name__)
     async def live_method(player: Player, data):
+
+        # tag logs from this message with the session and participant
+        log_context(player)
         
         # if no new data, just return cached messages
         if not data:
@@ -459,7 +628,8 @@ class chat(Page):
             )}
         
         # if we have new data, process it and update cache
-        messages = json.loads(player.cachedMessages)
+        with span('cache.decode'):
+            messages = json.loads(player.cachedMessages)
 
         # create current player identifier
         currentPlayer = 'P' + str(player.id_in_group)
@@ -480,68 +650,79 @@ class chat(Page):
 
                 # # grab base64 text and decode
                 voiceInput = data['text']
-                print("Received base64 text length:", len(voiceInput))
                 b64 = base64.b64decode(voiceInput)
-                print("Decoded base64 length:", len(b64))
+                logger.debug('Received recording', extra=dict(base64Length=len(voiceInput), audioBytes=len(b64)))
 
                 # get session code
                 sessionCode = player.session.code
 
                 # create filename format: (sessioncode)_(player id in group).webm
                 filename = str(player.session.code) + '_' + str(player.id_in_group) + '.webm'
-                
-                # Check if we have the OpenAI key
-                if not C.OPENAI_KEY:
-                    print("ERROR: OpenAI API key is not set!")
-                    yield {player.id_in_group: {'error': 'OpenAI API key is not configured'}}
-
-                try:
-                    
-                    headers = {
-                        'Authorization': f'Bearer {C.OPENAI_KEY}',
-                    }
-                    data = {
-                        'model': 'whisper-1',
-                    }
-                    files = {
-                        'file': (filename, b64, 'audio/webm'),
-                    }
-
-                    resp = await HTTPX_CLIENT.post(
-                        'https://api.openai.com/v1/audio/transcriptions',
-                        headers=headers,
-                        data=data,
-                        files=files,
-                        timeout=60,
-                    )
-                    resp.raise_for_status()
-                    llmText = resp.json()['text']
-                    print("LLM Text:", llmText)
 
-                # debug if there was a problem with transcription
-                except Exception as e:
-                    print("Error during transcription:", str(e))
-                    yield {player.id_in_group: {'error': f'Transcription failed: {str(e)}'}}
-                    return
-                
                 # create message id
                 dateNow = str(datetime.now(tz=timezone.utc).timestamp())
                 msgId = currentPlayer + '-' + str(dateNow)
+                set_msg_id(msgId)
 
                 # write user audio to file if enabled
+                ## this starts before transcription so the upload and whisper run at the same time
                 if C.SAVE_USER_AUDIO:
                     ## if amazon s3 setting, save to s3, otherwise save to static folder
-                    filename = f'{sessionCode}_{msgId}.webm'
+                    audioFilename = f'{sessionCode}_{msgId}.webm'
                     if C.AMAZON_S3:
                         # change to whatever you named your S3 bucket
-                        await saveToS3('otree-gpt', filename, b64)
+                        # failed uploads are retried in the background without holding up the reply
+                        archiveToS3InBackground('otree-gpt', audioFilename, b64)
                     else:
-                        # or save to static folder
-                        audioFilePath = f'_static/chat_voice/recordings/{filename}'
-                        with open(audioFilePath, 'wb') as f:
-                            f.write(b64)
-                else:
-                    pass
+                        # or save to static folder (written in the background)
+                        await RECORDING_STORE.submit(audioFilename, b64)
+                
+                # Check if we have the OpenAI key
+                if C.STT_BACKEND == 'openai' and not C.OPENAI_KEY:
+                    logger.error("OpenAI API key is not set!")
+                    yield {player.id_in_group: {'error': 'OpenAI API key is not configured'}}
+
+                try:
+
+                    # trim silence and downsample before transcribing
+                    ## the saved recording above is the original, untrimmed audio
+                    if C.TRIM_SILENCE or C.DOWNSAMPLE_AUDIO:
+                        with span('audio.prepare', bytes=len(b64)):
+                            prepared = await asyncio.to_thread(
+                                prepare_for_transcription,
+                                b64,
+                                filename,
+                                'audio/webm',
+                                trim=C.TRIM_SILENCE,
+                                downsample=C.DOWNSAMPLE_AUDIO,
+                                thresholdDb=C.SILENCE_THRESHOLD_DB,
+                            )
+                    else:
+                        prepared = (b64, filename, 'audio/webm')
+
+                    # nothing but silence, so don't send it to whisper
+                    if prepared is None:
+                        yield {player.id_in_group: {'error': 'No speech detected in recording'}}
+                        return
+
+                    # transcribe with whisper api or local model
+                    sttAudio, sttFilename, sttType = prepared
+                    llmText = await call_llm(
+                        lambda: STT_BACKEND.transcribe(sttAudio, sttFilename, sttType),
+                        app=__name__,
+                        bot=currentPlayer,
+                        model=STT_BACKEND.model,
+                        kind='stt',
+                        name='transcribe',
+                        max_retries=1,
+                    )
+                    logger.debug('Transcribed recording', extra=dict(text=llmText))
+
+                # debug if there was a problem with transcription
+                except Exception as e:
+                    logger.error(f"Error during transcription: {e}")
+                    yield {player.id_in_group: {'error': f'Transcription failed: {str(e)}'}}
+                    return
                 
                 # grab text and phase info
                 text = llmText
@@ -550,14 +731,15 @@ class chat(Page):
                 reactionsDict = {emoji: 0 for emoji in C.EMOJIS}
       
                 # save to database
-                MessageData.create(
-                    player=player,
-                    msgId=msgId,
-                    timestamp=dateNow,
-                    sender='Subject',
-                    tone=tone,
-                    msgText=text,
-                )
+                with span('db.write'):
+                    MessageData.create(
+                        player=player,
+                        msgId=msgId,
+                        timestamp=dateNow,
+                        sender='Subject',
+                        tone=tone,
+                        msgText=text,
+                    )
 
                 # add message to list
                 messages.append({
@@ -569,7 +751,8 @@ class chat(Page):
                 })
                 
                 # update cache
-                player.cachedMessages = json.dumps(messages)
+                with span('cache.encode'):
+                    player.cachedMessages = json.dumps(messages)
                 
                 # return output to chat.html
                 yield {player.id_in_group: dict(
@@ -602,18 +785,20 @@ class chat(Page):
                 # grab bot response data
                 outputText = botText.text
                 botMsgId = botText.msgId
+                set_msg_id(botMsgId)
                 botTone = botText.tone
                 botReactions = botText.reactions
 
                 # save to database
-                MessageData.create(
-                    player=player,
-                    sender=botId,
-                    msgId=botMsgId,
-                    timestamp=dateNow,
-                    tone=botTone,
-                    msgText=outputText,
-                )
+                with span('db.write'):
+                    MessageData.create(
+                        player=player,
+                        sender=botId,
+                        msgId=botMsgId,
+                        timestamp=dateNow,
+                        tone=botTone,
+                        msgText=outputText,
+                    )
 
                 # update cache with bot message
                 messages.append({
@@ -623,7 +808,8 @@ class chat(Page):
                     'text': outputText,
                     'reactions': json.dumps(botReactions),
                 })
-                player.cachedMessages = json.dumps(messages)
+                with span('cache.encode'):
+                    player.cachedMessages = json.dumps(messages)
 
                 # set voice id
                 ## this one is Sarah: A young, serious sounding crisp British female. Great for a podcast.
@@ -634,27 +820,27 @@ class chat(Page):
                 textForVoice = f"<{tone}>: {outputText}"
 
                 # run elevenlabs on the botText
-                audioDat = await runVoiceAPI(textForVoice, voiceId)
+                audioDat = await runVoiceAPI(textForVoice, voiceId, botId)
                 
                 # write audio to file and stream from chat.html
                 ## if amazon s3 setting, save to s3, otherwise save to static folder
                 sessionCode = player.session.code
                 filename = f'{sessionCode}_{botMsgId}.mp3'
                 if C.AMAZON_S3:
-                    if await saveToS3('otree-gpt', filename, audioDat):
+                    cacheControl = S3_IMMUTABLE_CACHE if C.S3_IMMUTABLE_AUDIO else S3_NO_CACHE
+                    if await saveToS3('otree-gpt', filename, audioDat, cacheControl):
                         audioURL = get_s3_url('otree-gpt', filename)
                         if not audioURL:
-                            print("Failed to generate S3 URL, falling back to local storage")
-                            audioFilePath = f'_static/chat_voice/recordings/{filename}'
-                            with open(audioFilePath, 'wb') as f:
-                                f.write(audioDat)
+                            logger.warning("Failed to generate S3 URL, falling back to local storage")
+                            with span('recording.save', filename=filename):
+                                await RECORDING_STORE.save(filename, audioDat)
                             audioURL = filename
                     else:
-                        print("Failed to save to S3!")
+                        logger.error("Failed to save to S3!")
                 else:
-                    audioFilePath = f'_static/chat_voice/recordings/{filename}'
-                    with open(audioFilePath, 'wb') as f:
-                        f.write(audioDat)
+                    # wait until the file is on disk, since the page plays it right away
+                    with span('recording.save', filename=filename):
+                        await RECORDING_STORE.save(filename, audioDat)
                     audioURL = filename
 
                 # return output to chat.html
@@ -691,15 +877,16 @@ class chat(Page):
                 
                 # create new reaction in database if not existing
                 if not existingReactions:
-                    MsgReactionData.create(
-                        player=player,
-                        sender=currentPlayer,
-                        msgId=msgId,
-                        msgReactionId=msgReactionId,
-                        timestamp=dateNow,
-                        target=trgt,
-                        emoji=emoji,
-                    )
+                    with span('db.write'):
+                        MsgReactionData.create(
+                            player=player,
+                            sender=currentPlayer,
+                            msgId=msgId,
+                            msgReactionId=msgReactionId,
+                            timestamp=dateNow,
+                            target=trgt,
+                            emoji=emoji,
+                        )
 
                     # update reaction counts in message cache
                     # this function looks through the database to make sure that players can only react once for each emoji/message
@@ -717,7 +904,8 @@ class chat(Page):
                             break
 
                     # update cache
-                    player.cachedMessages = json.dumps(messages)
+                    with span('cache.encode'):
+                        player.cachedMessages = json.dumps(messages)
 
                     # return output to chat.html
                     yield {player.id_in_group: dict(
@@ -4,6 +4,11 @@ from dotenv import load_dotenv
 # Load environment variables from .env file
 load_dotenv()
 
+# /metrics, the live dashboard, live cancellation and api replay for every app
+## installed here because oTree imports settings before the apps (see shared/server.py)
+import shared.server
+shared.server.install()
+
 
 SESSION_CONFIGS = [
      dict(
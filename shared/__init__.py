@@ -0,0 +1,6 @@
+"""
+Helpers shared by the oTree GPT apps (storage, LLM calls, monitoring).
+
+These modules do not import otree, so they can also be used from scripts
+that run outside of the oTree server.
+"""
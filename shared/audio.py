@@ -0,0 +1,139 @@
+"""
+Audio preprocessing before transcription.
+
+Recordings from the browser (webm/opus) are decoded frame by frame, mixed
+down to mono and optionally resampled to 16 kHz. Frame energies are computed
+with NumPy to find where speech starts and ends, and leading and trailing
+silence is cut off before the audio is re-encoded as ogg/opus at about the
+bitrate of the original, so the upload shrinks by the silence that was cut.
+
+This needs the optional PyAV (``av``) and ``numpy`` packages. If they are not
+installed, or the recording cannot be decoded, the original audio is used.
+"""
+
+import io
+
+from shared.log import get_logger
+
+logger = get_logger(__name__)
+
+
+########################################################
+# Settings                                             #
+########################################################
+
+# length of each analysis frame
+FRAME_MS = 30
+
+# keep this much audio around detected speech so words aren't clipped
+PAD_MS = 200
+
+# bitrate of the re-encoded audio (the browser records opus at about 32 kbps)
+OPUS_BITRATE = 32000
+
+# sample rates opus can encode; other rates are resampled to 48 kHz
+OPUS_RATES = (8000, 12000, 16000, 24000, 48000)
+
+
+########################################################
+# Decoding                                             #
+########################################################
+
+# decode a recording to mono 16-bit samples, one frame at a time
+def decode_to_mono(audio: bytes, sampleRate=None):
+    import av
+    import numpy as np
+
+    chunks = []
+    with av.open(io.BytesIO(audio)) as container:
+        stream = container.streams.audio[0]
+        resampler = av.AudioResampler(format='s16', layout='mono', rate=sampleRate)
+        for frame in container.decode(stream):
+            for outFrame in resampler.resample(frame):
+                chunks.append(outFrame.to_ndarray().reshape(-1))
+        # flush samples buffered in the resampler
+        for outFrame in resampler.resample(None):
+            chunks.append(outFrame.to_ndarray().reshape(-1))
+        rate = sampleRate or stream.rate
+
+    samples = np.concatenate(chunks) if chunks else np.zeros(0, dtype=np.int16)
+    return samples, rate
+
+
+########################################################
+# Voice activity detection                             #
+########################################################
+
+# return (start, end) sample indices of the speech in a recording, or None if there is no speech
+## frames louder than thresholdDb count as speech; the threshold is absolute, so
+## a recording that is speech from start to end is kept whole
+def find_speech(samples, rate, thresholdDb=-45.0):
+    import numpy as np
+
+    frameLen = max(1, int(rate * FRAME_MS / 1000))
+    numFrames = len(samples) // frameLen
+    if numFrames == 0:
+        return None
+
+    # rms energy of every frame in dBFS
+    frames = samples[:numFrames * frameLen].reshape(numFrames, frameLen).astype(np.float32) / 32768.0
+    rms = np.sqrt(np.mean(frames ** 2, axis=1))
+    db = 20 * np.log10(rms + 1e-10)
+
+    voiced = np.flatnonzero(db > thresholdDb)
+    if len(voiced) == 0:
+        return None
+
+    pad = int(rate * PAD_MS / 1000)
+    start = max(0, voiced[0] * frameLen - pad)
+    end = min(len(samples), (voiced[-1] + 1) * frameLen + pad)
+    return start, end
+
+
+########################################################
+# Preprocessing                                        #
+########################################################
+
+# encode mono 16-bit samples as an ogg/opus file
+def to_opus(samples, rate) -> bytes:
+    import av
+
+    buf = io.BytesIO()
+    with av.open(buf, 'w', format='ogg') as container:
+        stream = container.add_stream('libopus', rate=rate if rate in OPUS_RATES else 48000, layout='mono')
+        stream.bit_rate = OPUS_BITRATE
+        frame = av.AudioFrame.from_ndarray(samples.reshape(1, -1), format='s16', layout='mono')
+        frame.sample_rate = rate
+        # the encoder resamples and splits the audio into opus frames itself
+        for packet in stream.encode(frame):
+            container.mux(packet)
+        for packet in stream.encode(None):
+            container.mux(packet)
+    return buf.getvalue()
+
+# trim silence (and optionally downsample) before transcription
+## returns (audio, filename, content type), or None if the recording has no speech in it
+## this is cpu-bound, so call it with asyncio.to_thread from a live method
+def prepare_for_transcription(audio: bytes, filename: str, content_type='audio/webm',
+                              trim=True, downsample=True, thresholdDb=-45.0):
+    try:
+        samples, rate = decode_to_mono(audio, 16000 if downsample else None)
+    except Exception as e:
+        # missing packages or undecodable audio, send the original
+        logger.warning(f'Audio preprocessing skipped: {e}')
+        return audio, filename, content_type
+
+    if trim:
+        speech = find_speech(samples, rate, thresholdDb)
+        if speech is None:
+            return None
+        samples = samples[speech[0]:speech[1]]
+
+    try:
+        encoded = to_opus(samples, rate)
+    except Exception as e:
+        logger.warning(f'Audio preprocessing skipped: {e}')
+        return audio, filename, content_type
+
+    oggName = filename.rsplit('.', 1)[0] + '.ogg'
+    return encoded, oggName, 'audio/ogg'
@@ -0,0 +1,233 @@
+"""
+Circuit breakers for API calls.
+
+During a provider outage, every bot turn used to retry for minutes while
+holding the participant's websocket. A circuit breaker watches the recent
+failure rate of a service. Once too many calls fail it "opens", and calls
+fail at once (so apps can fall back to a cheaper model or a canned reply)
+instead of piling up more retries. After a cool-down it lets a few probe
+calls through ("half-open"). If they succeed, the breaker closes again; if
+not, it stays open for longer.
+
+shared.llm keeps one breaker per kind and model (e.g. 'llm:gpt-4o-mini'),
+shared by every app. A call cut off by its model's time in a model chain
+counts as a failure; a call cancelled because the participant left does not.
+Its state lives in shared.state, so with a Redis backend all server processes
+share it: a breaker opened by one process fails calls fast in the others too.
+
+Settings (environment variables):
+- BREAKER_FAILURE_RATE: failure rate that opens the breaker (default 0.5)
+- BREAKER_MIN_CALLS: calls needed in the window before it can open (default 10)
+- BREAKER_WINDOW: seconds of calls used for the failure rate (default 30)
+- BREAKER_OPEN_SECONDS: cool-down before probing again (default 15, doubling up to 120)
+- BREAKER_PROBES: calls let through at once while half-open (default 2)
+"""
+
+import threading
+from os import environ
+
+from shared.log import get_logger
+from shared.metrics import REGISTRY
+from shared.state import get_state
+
+logger = get_logger(__name__)
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+STATE = REGISTRY.gauge('breaker_state', 'Circuit breaker state (0 closed, 1 half-open, 2 open)', ('breaker',))
+REJECTED = REGISTRY.counter('breaker_rejected_total', 'Calls failed fast by an open breaker', ('breaker',))
+TRIPS = REGISTRY.counter('breaker_trips_total', 'Times a breaker opened', ('breaker',))
+
+
+class CircuitOpenError(Exception):
+
+    def __init__(self, breaker, state=OPEN):
+        super().__init__(f'circuit breaker {breaker.name} is {state}, failing fast')
+        self.breaker = breaker
+
+
+########################################################
+# Breaker                                              #
+########################################################
+
+class CircuitBreaker:
+
+    def __init__(
+        self,
+        name,
+        failure_rate=float(environ.get('BREAKER_FAILURE_RATE', 0.5)),
+        min_calls=int(environ.get('BREAKER_MIN_CALLS', 10)),
+        window=float(environ.get('BREAKER_WINDOW', 30)),
+        open_seconds=float(environ.get('BREAKER_OPEN_SECONDS', 15)),
+        max_open_seconds=120,
+        probes=int(environ.get('BREAKER_PROBES', 2)),
+        buckets=10,
+        state=None,
+    ):
+        self.name = name
+        self.failure_rate = failure_rate
+        self.min_calls = min_calls
+        self.window = window
+        self.base_open_seconds = open_seconds
+        self.max_open_seconds = max_open_seconds
+        self.probes = probes
+
+        # calls and failures are counted in `buckets` slices of the window
+        self.bucket_seconds = window / buckets
+        self._store = state
+        self._lastState = None
+        self._lock = threading.Lock()
+        STATE.set(0, breaker=name)
+
+    @property
+    def store(self):
+        return self._store or get_state()
+
+    def _key(self, part):
+        return f'breaker:{self.name}:{part}'
+
+    # (start, seconds) of the current opening, or None while closed
+    async def _opening(self, store):
+        opened = await store.get(self._key('opened'))
+        return None if opened is None else (opened['at'], opened['seconds'])
+
+    # closed, open or half-open, as seen by every process
+    async def current_state(self):
+        store = self.store
+        opening = await self._opening(store)
+        if opening is None:
+            state = CLOSED
+        elif store.now() - opening[0] < opening[1]:
+            state = OPEN
+        else:
+            state = HALF_OPEN
+        self._seen(state)
+        return state
+
+    # update this process's gauge and log when the shared state changes
+    def _seen(self, state):
+        with self._lock:
+            if state == self._lastState:
+                return
+            self._lastState = state
+        STATE.set(STATE_VALUES[state], breaker=self.name)
+        if state == HALF_OPEN:
+            logger.info(f'Circuit breaker {self.name} is half-open, probing', extra=dict(breaker=self.name))
+
+    async def _open_seconds(self, store):
+        opening = await self._opening(store)
+        return self.base_open_seconds if opening is None else opening[1]
+
+    def _bucket(self, store):
+        return int(store.now() // self.bucket_seconds)
+
+    async def _record(self, store, ok):
+        bucket = self._bucket(store)
+        ttl = self.window + self.bucket_seconds
+        await store.incr(self._key(f'calls:{bucket}'), 1, ttl=ttl)
+        if not ok:
+            await store.incr(self._key(f'failures:{bucket}'), 1, ttl=ttl)
+
+    # (calls, failures) in the window
+    async def _counts(self, store):
+        last = self._bucket(store)
+        buckets = range(last - int(self.window // self.bucket_seconds) + 1, last + 1)
+        values = await store.get_many([self._key(f'{kind}:{b}') for kind in ('calls', 'failures') for b in buckets], default=0)
+        return sum(values[:len(buckets)]), sum(values[len(buckets):])
+
+    async def _clear_window(self, store):
+        last = self._bucket(store)
+        buckets = range(last - int(self.window // self.bucket_seconds), last + 1)
+        await store.delete(*[self._key(f'{kind}:{b}') for kind in ('calls', 'failures') for b in buckets])
+
+    # called before each attempt; raises CircuitOpenError instead of letting it through
+    ## returns True if the attempt is a half-open probe
+    async def before_call(self) -> bool:
+        state = await self.current_state()
+        if state == OPEN:
+            REJECTED.inc(breaker=self.name)
+            raise CircuitOpenError(self, state)
+        if state == HALF_OPEN:
+            store = self.store
+            # ttl frees the probe slots of a process that died mid-call
+            if await store.incr(self._key('probes'), 1, ttl=self.max_open_seconds) > self.probes:
+                await store.incr(self._key('probes'), -1)
+                REJECTED.inc(breaker=self.name)
+                raise CircuitOpenError(self, state)
+            return True
+        return False
+
+    async def on_success(self, probe=False):
+        store = self.store
+        if probe:
+            await self._probe_done(store)
+        if await self.current_state() == HALF_OPEN:
+            await store.delete(self._key('opened'), self._key('probes'))
+            await self._clear_window(store)
+            self._seen(CLOSED)
+            logger.info(f'Circuit breaker {self.name} closed', extra=dict(breaker=self.name))
+        await self._record(store, True)
+
+    async def on_failure(self, probe=False):
+        store = self.store
+        if probe:
+            await self._probe_done(store)
+        state = await self.current_state()
+        if state == HALF_OPEN:
+            # the probe failed, so wait longer before the next one
+            await self._open(store, min(await self._open_seconds(store) * 2, self.max_open_seconds))
+            return
+        if state == OPEN:
+            return
+        await self._record(store, False)
+        calls, failures = await self._counts(store)
+        if calls >= self.min_calls and failures / calls >= self.failure_rate:
+            await self._open(store, self.base_open_seconds)
+
+    # the attempt was cancelled before it finished
+    async def on_cancel(self, probe=False):
+        if probe:
+            await self._probe_done(self.store)
+
+    async def _probe_done(self, store):
+        # the count was reset if the breaker closed or reopened meanwhile
+        if await store.incr(self._key('probes'), -1) < 0:
+            await store.delete(self._key('probes'))
+
+    async def _open(self, store, seconds):
+        await store.set(self._key('opened'), dict(at=store.now(), seconds=seconds))
+        await store.delete(self._key('probes'))
+        self._seen(OPEN)
+        TRIPS.inc(breaker=self.name)
+        logger.warning(
+            f'Circuit breaker {self.name} opened for {seconds:.1f}s',
+            extra=dict(breaker=self.name, open_seconds=seconds),
+        )
+
+    async def reset(self):
+        store = self.store
+        await store.delete(self._key('opened'), self._key('probes'))
+        await self._clear_window(store)
+        self._seen(CLOSED)
+
+
+########################################################
+# Shared breakers                                      #
+########################################################
+
+_BREAKERS = {}
+_BREAKERS_LOCK = threading.Lock()
+
+# the breaker with this name, created on first use
+def get_breaker(name, **kwargs) -> CircuitBreaker:
+    with _BREAKERS_LOCK:
+        breaker = _BREAKERS.get(name)
+        if breaker is None:
+            breaker = _BREAKERS[name] = CircuitBreaker(name, **kwargs)
+        return breaker
+
+def all_breakers() -> dict:
+    return dict(_BREAKERS)
@@ -0,0 +1,104 @@
+"""
+Stop bot generation when the participant's page goes away.
+
+oTree handles a live message by awaiting the live method inside the
+websocket's receive loop, so it doesn't notice that the socket has closed
+until the live method returns. If the participant closes the tab, or the
+chat page's timeout moves them on to the next page, a pending runGPT or
+runVoiceAPI keeps running. Its reply is then saved to MessageData and
+cachedMessages for nobody, and it keeps using tokens and worker slots.
+
+``install_live_cancellation()`` puts a wrapper around oTree's /live websocket.
+The wrapper keeps listening to the socket while a live method runs. If the
+socket closes, it cancels the live method: the pending HTTP request is
+aborted at whatever ``await`` it was in, and the database changes made while
+handling that message are rolled back instead of committed. Messages that
+arrive while a live method is running are queued and handled afterwards, as
+before.
+
+Work already handed to a thread (``asyncio.to_thread``, e.g. ElevenLabs or
+S3 uploads) can't be interrupted. It finishes in the background, and its
+result is dropped.
+"""
+
+import asyncio
+import collections
+
+from shared.log import get_logger, log_context
+from shared.metrics import REGISTRY
+
+logger = get_logger(__name__)
+
+CANCELLED = REGISTRY.counter('live_cancelled_total', 'Live method messages cancelled because the page went away', ('reason',))
+
+_CONSUMER = None
+
+
+# serve oTree's /live websocket with the cancelling consumer
+## called once from settings.py (see shared.server), so it is in place whenever the server starts
+def install_live_cancellation(path='/live'):
+    from shared.routes import add_websocket_route
+    add_websocket_route(path, watched_live_consumer)
+
+
+# oTree's LiveConsumer, extended to watch for disconnects while a live method runs
+def watched_live_consumer():
+    global _CONSUMER
+    if _CONSUMER is not None:
+        return _CONSUMER
+
+    from otree.channels.consumers import LiveConsumer
+
+    class WatchedLiveConsumer(LiveConsumer):
+
+        def __init__(self, scope, receive, send):
+            self._raw_receive = receive
+            self._next = None
+            self._pending = collections.deque()
+            super().__init__(scope, self._receive, send)
+
+        # task waiting for the next message from the socket
+        def _listen(self):
+            if self._next is None:
+                self._next = asyncio.ensure_future(self._raw_receive())
+            return self._next
+
+        def _take(self):
+            message = self._next.result()
+            self._next = None
+            return message
+
+        # what oTree's receive loop reads: queued messages first, then the socket
+        async def _receive(self):
+            if self._pending:
+                return self._pending.popleft()
+            await self._listen()
+            return self._take()
+
+        async def on_receive(self, websocket, data):
+            work = asyncio.ensure_future(super().on_receive(websocket, data))
+            try:
+                while not work.done():
+                    await asyncio.wait({work, self._listen()}, return_when=asyncio.FIRST_COMPLETED)
+                    if work.done() or not self._next.done():
+                        break
+                    message = self._take()
+                    self._pending.append(message)
+                    if message['type'] == 'websocket.disconnect':
+                        log_context(participant_code=self.cleaned_kwargs.get('participant_code'))
+                        logger.info('Page closed during a live method, cancelling it', extra=dict(page=self.cleaned_kwargs.get('page_name')))
+                        CANCELLED.inc(reason='disconnect')
+                        work.cancel()
+                        try:
+                            await work
+                        except asyncio.CancelledError:
+                            pass
+                        return
+                return await work
+            finally:
+                # the receive loop itself was cancelled (e.g. server shutdown)
+                if not work.done():
+                    work.cancel()
+
+    _CONSUMER = WatchedLiveConsumer
+    return _CONSUMER
@@ -0,0 +1,288 @@
+"""
+Live latency dashboard for running sessions.
+
+shared.llm reports every API call here, tagged with the session it was made
+for. The dashboard keeps the calls from the last few minutes and shows, for
+each session and app: rolling latency percentiles, calls in flight, error
+rate and token spend, plus the depth of any registered queues (retry backoff,
+recording writes, ...). The page refreshes itself every few seconds, so an
+experimenter can see a session slowing down well before participants hit the
+300 second timeout on the chat page. A session is dropped from the dashboard
+once it has had no calls for longer than the window.
+
+``install_dashboard_route()`` (called from settings.py, see shared.server)
+serves the page at /live_dashboard (JSON at /live_dashboard/data). Like
+/metrics, it is only served if METRICS_TOKEN is set, and asks for that token.
+
+Settings (environment variables):
+- DASHBOARD_WINDOW: seconds of calls to include in the percentiles (default 300)
+- DASHBOARD_SLOW_SECONDS: p95 latency that marks a row as slow (default 30)
+- DASHBOARD_ERROR_RATE: error rate that marks a row as failing (default 0.1)
+"""
+
+import collections
+import threading
+import time
+from os import environ
+
+WINDOW_SECONDS = float(environ.get('DASHBOARD_WINDOW', 300))
+SLOW_SECONDS = float(environ.get('DASHBOARD_SLOW_SECONDS', 30))
+ERROR_RATE = float(environ.get('DASHBOARD_ERROR_RATE', 0.1))
+
+# at most this many calls are kept per session and app
+MAX_SAMPLES = 5000
+
+
+########################################################
+# Rolling stats                                        #
+########################################################
+
+class SessionStats:
+
+    def __init__(self):
+        # (time, seconds, ok) for recent calls
+        self.samples = collections.deque(maxlen=MAX_SAMPLES)
+        self.in_flight = 0
+        self.calls = 0
+        self.errors = 0
+        self.tokens = 0
+        self.cost = 0.0
+        self.last_call = None
+        # last time a call started, finished or was cancelled
+        self.last_active = time.time()
+
+
+class LiveStats:
+
+    def __init__(self, window=WINDOW_SECONDS):
+        self.window = window
+        self._stats = {}
+        self._queues = {}
+        self._lock = threading.Lock()
+        self._lastPrune = time.time()
+
+    def _get(self, session, app):
+        key = (session or '-', app)
+        stats = self._stats.get(key)
+        if stats is None:
+            stats = self._stats[key] = SessionStats()
+        stats.last_active = time.time()
+        return stats
+
+    # drop sessions with nothing in flight and no calls for longer than the window,
+    # so the dashboard (and its memory) doesn't keep every session the server has run
+    ## runs on every snapshot, and at most once a minute as calls start (when nobody watches the page)
+    def _prune(self, now):
+        self._lastPrune = now
+        cutoff = now - self.window
+        for key in [k for k, s in self._stats.items() if s.in_flight <= 0 and s.last_active < cutoff]:
+            del self._stats[key]
+
+    def started(self, session, app):
+        now = time.time()
+        with self._lock:
+            if now - self._lastPrune > 60:
+                self._prune(now)
+            self._get(session, app).in_flight += 1
+
+    def finished(self, session, app, seconds, ok=True, tokens=0, cost=0.0):
+        now = time.time()
+        with self._lock:
+            stats = self._get(session, app)
+            stats.in_flight -= 1
+            stats.samples.append((now, seconds, ok))
+            stats.calls += 1
+            stats.errors += 0 if ok else 1
+            stats.tokens += tokens
+            stats.cost += cost
+            stats.last_call = now
+
+    # the call was cancelled, so it counts toward neither latency nor errors
+    def cancelled(self, session, app):
+        with self._lock:
+            self._get(session, app).in_flight -= 1
+
+    # show a queue's depth on the dashboard; `depth` is a function returning an int
+    def register_queue(self, name, depth):
+        self._queues[name] = depth
+
+    def queue_depths(self) -> dict:
+        depths = {}
+        for name, depth in list(self._queues.items()):
+            try:
+                depths[name] = int(depth())
+            except Exception:
+                depths[name] = None
+        return depths
+
+    def snapshot(self) -> dict:
+        now = time.time()
+        cutoff = now - self.window
+        rows = []
+        with self._lock:
+            self._prune(now)
+            items = [(key, list(s.samples), s.in_flight, s.calls, s.errors, s.tokens, s.cost, s.last_call) for key, s in self._stats.items()]
+        for (session, app), samples, inFlight, calls, errors, tokens, cost, lastCall in items:
+            recent = [(seconds, ok) for t, seconds, ok in samples if t >= cutoff]
+            latencies = sorted(seconds for seconds, ok in recent)
+            recentErrors = sum(1 for seconds, ok in recent if not ok)
+            row = dict(
+                session=session,
+                app=app,
+                in_flight=inFlight,
+                recent_calls=len(recent),
+                p50=_percentile(latencies, 50),
+                p95=_percentile(latencies, 95),
+                p99=_percentile(latencies, 99),
+                max=latencies[-1] if latencies else None,
+                error_rate=recentErrors / len(recent) if recent else 0.0,
+                calls=calls,
+                errors=errors,
+                tokens=tokens,
+                cost_usd=round(cost, 6),
+                idle_seconds=round(now - lastCall, 1) if lastCall else None,
+            )
+            row['status'] = _status(row)
+            rows.append(row)
+        rows.sort(key=lambda r: (r['session'], r['app']))
+        return dict(
+            time=now,
+            window_seconds=self.window,
+            rows=rows,
+            queues=self.queue_depths(),
+            totals=dict(
+                in_flight=sum(r['in_flight'] for r in rows),
+                tokens=sum(r['tokens'] for r in rows),
+                cost_usd=round(sum(r['cost_usd'] for r in rows), 6),
+            ),
+        )
+
+    def clear(self):
+        with self._lock:
+            self._stats.clear()
+
+
+def _percentile(values, pct):
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(pct / 100 * len(values)))]
+
+def _status(row):
+    if row['recent_calls'] and row['error_rate'] >= ERROR_RATE:
+        return 'failing'
+    if row['p95'] is not None and row['p95'] >= SLOW_SECONDS:
+        return 'slow'
+    return 'ok'
+
+
+# stats shared by everything in this process
+LIVE_STATS = LiveStats()
+
+
+########################################################
+# oTree routes                                         #
+########################################################
+
+# serve the dashboard at /live_dashboard on the oTree server (only with METRICS_TOKEN set)
+def install_dashboard_route(path='/live_dashboard'):
+    from shared.routes import add_route, metrics_token
+    if not metrics_token():
+        return
+    add_route(path, dashboard_page, methods=['GET'])
+    add_route(path + '/data', dashboard_data, methods=['GET'])
+
+async def dashboard_data(request):
+    from starlette.responses import JSONResponse, PlainTextResponse
+    from shared.routes import authorized
+
+    if not authorized(request):
+        return PlainTextResponse('unauthorized', status_code=401)
+    return JSONResponse(LIVE_STATS.snapshot())
+
+async def dashboard_page(request):
+    from starlette.responses import HTMLResponse, PlainTextResponse
+    from shared.routes import authorized
+
+    if not authorized(request):
+        return PlainTextResponse('unauthorized', status_code=401)
+    return HTMLResponse(DASHBOARD_HTML)
+
+
+DASHBOARD_HTML = """<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<title>Live sessions</title>
+<style>
+body { font-family: sans-serif; font-size: 14px; margin: 20px; }
+table { border-collapse: collapse; margin-bottom: 16px; }
+th, td { padding: 4px 10px; text-align: right; border-bottom: 1px solid #ddd; }
+th { background: #f3f3f3; }
+td.left, th.left { text-align: left; }
+tr.slow { background: #fff3cd; }
+tr.failing { background: #f8d7da; }
+#updated { color: #777; }
+</style>
+</head>
+<body>
+<h2>Live sessions</h2>
+<p id="updated">Loading...</p>
+<p id="totals"></p>
+<table>
+<thead><tr>
+<th class="left">session</th><th class="left">app</th><th>in flight</th><th>calls</th>
+<th>p50 s</th><th>p95 s</th><th>p99 s</th><th>max s</th><th>error rate</th>
+<th>tokens</th><th>cost $</th><th>idle s</th><th class="left">status</th>
+</tr></thead>
+<tbody id="rows"></tbody>
+</table>
+<h3>Queues</h3>
+<table><tbody id="queues"></tbody></table>
+<script>
+const token = new URLSearchParams(location.search).get('token');
+const dataUrl = location.pathname.replace(/\\/$/, '') + '/data' + (token ? '?token=' + encodeURIComponent(token) : '');
+const fmt = (v, d) => (v === null || v === undefined) ? '-' : Number(v).toFixed(d);
+function cell(text, cls) {
+    const td = document.createElement('td');
+    td.textContent = text;
+    if (cls) td.className = cls;
+    return td;
+}
+async function refresh() {
+    try {
+        const resp = await fetch(dataUrl);
+        const data = await resp.json();
+        const rows = document.getElementById('rows');
+        rows.replaceChildren();
+        for (const r of data.rows) {
+            const tr = document.createElement('tr');
+            tr.className = r.status;
+            tr.append(
+                cell(r.session, 'left'), cell(r.app, 'left'), cell(r.in_flight), cell(r.recent_calls),
+                cell(fmt(r.p50, 2)), cell(fmt(r.p95, 2)), cell(fmt(r.p99, 2)), cell(fmt(r.max, 2)),
+                cell(fmt(100 * r.error_rate, 1) + '%'), cell(r.tokens), cell(fmt(r.cost_usd, 4)),
+                cell(fmt(r.idle_seconds, 0)), cell(r.status, 'left'),
+            );
+            rows.append(tr);
+        }
+        const queues = document.getElementById('queues');
+        queues.replaceChildren();
+        for (const [name, depth] of Object.entries(data.queues)) {
+            const tr = document.createElement('tr');
+            tr.append(cell(name, 'left'), cell(depth === null ? '?' : depth));
+            queues.append(tr);
+        }
+        document.getElementById('totals').textContent =
+            `${data.totals.in_flight} calls in flight, ${data.totals.tokens} tokens, $${fmt(data.totals.cost_usd, 4)} spent`;
+        document.getElementById('updated').textContent =
+            `Percentiles over the last ${data.window_seconds} s. Updated ${new Date(data.time * 1000).toLocaleTimeString()}.`;
+    } catch (e) {
+        document.getElementById('updated').textContent = 'Could not load data: ' + e;
+    }
+}
+refresh();
+setInterval(refresh, 2000);
+</script>
+</body>
+</html>
+"""
@@ -0,0 +1,140 @@
+"""
+Hedged requests: send a second copy of a slow API call.
+
+Most calls come back quickly, but now and then one takes many times longer
+and holds up the chat page. With hedging on, call_llm waits for the usual
+response time of the model (a percentile of recent calls). If the response
+still hasn't arrived by then, it sends the same request again. Whichever
+copy finishes first is used, and the other one is cancelled.
+
+Hedging costs extra tokens, so each app's policy has a cost cap (extra USD
+spent on hedged calls) and a cap on the share of calls that may be hedged.
+The share also keeps hedges from doubling the load when the API is
+overloaded and everything is slow. Both caps are counted in shared.state, so
+they hold over all server processes, and start over every `period` (an hour
+by default), so reaching a cap pauses hedging until the next period.
+
+The usual response time is that of the first copy. When the hedge wins, the
+first copy is cancelled at once, and the time it had taken by then is recorded
+(it would have taken at least that long). Recording the winner's time instead
+would make the percentile look faster than the API is, and hedge more.
+
+A hedged call is counted against the cost cap for both copies, each at the
+winner's cost: the cancelled copy has usually been billed for its prompt and
+part of its reply by the time it is cancelled.
+
+Metrics: llm_hedges_total (hedge rate = hedges / requests) and
+llm_hedge_wins_total (win rate = wins / hedges).
+"""
+
+import asyncio
+import collections
+import threading
+
+from shared.metrics import REGISTRY
+from shared.state import get_state
+
+HEDGES = REGISTRY.counter('llm_hedges_total', 'Calls that sent a second (hedged) request', ('app', 'model'))
+HEDGE_WINS = REGISTRY.counter('llm_hedge_wins_total', 'Hedged requests that finished first', ('app', 'model'))
+HEDGE_SKIPPED = REGISTRY.counter('llm_hedges_skipped_total', 'Slow calls not hedged because a cap was reached', ('app', 'model', 'reason'))
+HEDGE_COST = REGISTRY.counter('llm_hedge_cost_usd_total', 'Estimated cost of hedged calls in USD', ('app', 'model'))
+
+
+class HedgePolicy:
+
+    def __init__(self, app, percentile=95, max_cost=1.0, max_rate=0.2, min_delay=0.5, default_delay=4.0, min_samples=20, samples=500, period=3600):
+        self.app = app
+        self.percentile = percentile
+        self.max_cost = max_cost
+        self.max_rate = max_rate
+        self.min_delay = min_delay
+        self.default_delay = default_delay
+        self.min_samples = min_samples
+        self.period = period
+
+        self._latencies = collections.defaultdict(lambda: collections.deque(maxlen=samples))
+        self._lock = threading.Lock()
+
+    # seconds to wait for a response before hedging
+    def delay(self, model) -> float:
+        with self._lock:
+            latencies = sorted(self._latencies[model])
+        if len(latencies) < self.min_samples:
+            return self.default_delay
+        idx = min(len(latencies) - 1, int(self.percentile / 100 * len(latencies)))
+        return max(self.min_delay, latencies[idx])
+
+    def observe(self, model, seconds):
+        with self._lock:
+            self._latencies[model].append(seconds)
+
+    # counters for the current period; they expire after it
+    def _key(self, part):
+        window = int(get_state().now() // self.period)
+        return f'hedge:{self.app}:{window}:{part}'
+
+    async def _incr(self, part, amount=1):
+        return await get_state().incr(self._key(part), amount, ttl=self.period * 2)
+
+    # totals for this period over all server processes (shared.state):
+    ## {'spent': USD, 'calls': calls, 'hedged': hedged calls}
+    async def totals(self) -> dict:
+        parts = ['spent', 'calls', 'hedged']
+        values = await get_state().get_many([self._key(part) for part in parts], default=0)
+        return dict(zip(parts, values))
+
+    # whether a slow call may be hedged now
+    async def allow(self, model) -> bool:
+        state = get_state()
+        spent, calls = await state.get_many([self._key('spent'), self._key('calls')], default=0)
+        if spent >= self.max_cost:
+            reason = 'cost'
+        else:
+            hedged = await self._incr('hedged')
+            if calls and hedged / calls <= self.max_rate:
+                return True
+            await self._incr('hedged', -1)
+            reason = 'rate'
+        HEDGE_SKIPPED.inc(app=self.app, model=model, reason=reason)
+        return False
+
+    # count a hedged call against the cost cap: both copies, each estimated at `cost` (the winner's)
+    async def spend(self, model, cost):
+        await self._incr('spent', cost * 2)
+        HEDGE_COST.inc(cost * 2, app=self.app, model=model)
+
+    # run one attempt of `request`, hedging it if it is slow
+    ## returns (response, hedged)
+    async def run(self, request, model):
+        loop = asyncio.get_running_loop()
+        await self._incr('calls')
+        start = loop.time()
+        first = asyncio.ensure_future(request())
+        tasks = {first}
+        hedged = False
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=self.delay(model))
+            if not done and await self.allow(model):
+                hedged = True
+                HEDGES.inc(app=self.app, model=model)
+                tasks.add(asyncio.ensure_future(request()))
+
+            error = None
+            while tasks:
+                done, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is first:
+                            self.observe(model, loop.time() - start)
+                        else:
+                            HEDGE_WINS.inc(app=self.app, model=model)
+                            if first in tasks:
+                                # the first copy took at least this long; it is cancelled below
+                                self.observe(model, loop.time() - start)
+                        return task.result(), hedged
+                    error = task.exception()
+            raise error
+        finally:
+            # the loser, or both copies if the call itself was cancelled
+            for task in tasks:
+                task.cancel()
@@ -0,0 +1,404 @@
+"""
+Calls to LLM, speech-to-text and text-to-speech APIs, with retries and metrics.
+
+Every app used to carry its own copy of the retry loop around the OpenAI
+client. ``call_llm`` is that loop in one place: exponential backoff with
+jitter, honouring "Please try again in Xs" hints from the API, and a
+warning (through shared.log) for each retry. It also records, for each call, labelled by kind
+(llm/stt/tts), app, bot and model:
+
+- queue wait: time from the call until the attempt that succeeded was sent
+  (includes retry backoff, the wait for a scheduler slot and any wait for a
+  worker thread)
+- time to first token (the whole response for non-streamed calls)
+- end-to-end latency, retries and errors
+- prompt, completion and cached tokens, and an estimated cost in USD
+
+Calls to a kind and model share a circuit breaker (shared.breaker): while it
+is open they fail fast. ``call_model_chain`` tries a list of models in turn
+within a deadline, so a bot turn never takes longer than that, and
+``fallback_chain`` supplies a canned reply if they all fail. Slow requests
+can also be hedged (shared.hedge). Each attempt waits for a slot from the
+priority scheduler (shared.scheduler), so replies participants are waiting
+for go ahead of moderator and background calls.
+
+Streaming code can mark the first token with ``current_call().first_token()``.
+When tracing is on (shared.tracing), each call is also a span in the
+message's trace. Calls are also reported, by session, to the live dashboard
+(shared.dashboard).
+"""
+
+import asyncio
+import contextlib
+import contextvars
+import math
+import random
+import re
+import time
+from types import SimpleNamespace
+
+from shared.breaker import OPEN, CircuitBreaker, CircuitOpenError, get_breaker
+from shared.dashboard import LIVE_STATS
+from shared.log import SESSION_CODE, get_logger
+from shared.metrics import REGISTRY
+from shared.scheduler import INTERACTIVE, SCHEDULER, current_priority, lower
+from shared.tracing import span
+
+logger = get_logger(__name__)
+
+MAX_RETRIES = 9
+
+# price per million tokens in USD: (input, cached input, output)
+## https://platform.openai.com/docs/pricing (update if prices change)
+PRICES = {
+    'gpt-4o-mini': (0.15, 0.075, 0.60),
+    'gpt-4o': (2.50, 1.25, 10.00),
+    'gpt-4.1-nano': (0.10, 0.025, 0.40),
+    'gpt-4.1-mini': (0.40, 0.10, 1.60),
+    'gpt-4.1': (2.00, 0.50, 8.00),
+    'gpt-5-nano': (0.05, 0.005, 0.40),
+    'gpt-5-mini': (0.25, 0.025, 2.00),
+    'gpt-5': (1.25, 0.125, 10.00),
+}
+
+
+########################################################
+# Metrics                                              #
+########################################################
+
+LABELS = ('kind', 'app', 'bot', 'model')
+
+REQUESTS = REGISTRY.counter('llm_requests_total', 'API calls by outcome', LABELS + ('outcome',))
+RETRIES = REGISTRY.counter('llm_retries_total', 'Retried API attempts', LABELS)
+IN_FLIGHT = REGISTRY.gauge('llm_in_flight', 'API calls currently running', ('kind', 'app', 'model'))
+QUEUE_WAIT = REGISTRY.histogram('llm_queue_wait_seconds', 'Time before the successful attempt was sent', LABELS)
+TTFT = REGISTRY.histogram('llm_ttft_seconds', 'Time to first token of the successful attempt', LABELS)
+LATENCY = REGISTRY.histogram('llm_latency_seconds', 'End-to-end call time including retries', LABELS)
+TOKENS = REGISTRY.counter('llm_tokens_total', 'Tokens used, by type (prompt, completion, cached)', LABELS + ('type',))
+CHARACTERS = REGISTRY.counter('llm_characters_total', 'Characters sent to text-to-speech', LABELS)
+COST = REGISTRY.counter('llm_cost_usd_total', 'Estimated API cost in USD', LABELS)
+TIMEOUTS = REGISTRY.counter('llm_timeouts_total', 'Calls cancelled for taking longer than their share of the deadline', ('app', 'bot', 'model'))
+FALLTHROUGH = REGISTRY.counter('llm_chain_fallthrough_total', 'Times a model chain moved on to its next model', ('app', 'bot', 'model'))
+BACKOFF = REGISTRY.gauge('llm_backoff', 'API calls waiting to retry', ('kind', 'app', 'model'))
+
+LIVE_STATS.register_queue('api calls waiting to retry', BACKOFF.total)
+
+
+########################################################
+# Call tracking                                        #
+########################################################
+
+class Call:
+
+    def __init__(self, kind, app, bot, model):
+        self.labels = dict(kind=kind, app=app, bot=bot, model=model)
+        self.start = time.perf_counter()
+        self.sent_at = None
+        self.first_token_at = None
+        self.attempts = 0
+        self.hedged = False
+
+    # the request is leaving now (called at each attempt, or by a worker thread once it starts)
+    def sent(self):
+        self.sent_at = time.perf_counter()
+        self.first_token_at = None
+
+    # the first streamed token arrived
+    def first_token(self):
+        if self.first_token_at is None:
+            self.first_token_at = time.perf_counter()
+
+
+_CURRENT_CALL = contextvars.ContextVar('llm_call', default=None)
+
+# the call being made in this task (or worker thread), if any
+def current_call():
+    return _CURRENT_CALL.get()
+
+
+########################################################
+# Usage and cost                                       #
+########################################################
+
+# (prompt, completion, cached) tokens from a responses or chat completions result
+def token_usage(response):
+    usage = getattr(response, 'usage', None)
+    if usage is None:
+        return 0, 0, 0
+    prompt = getattr(usage, 'input_tokens', None) or getattr(usage, 'prompt_tokens', None) or 0
+    completion = getattr(usage, 'output_tokens', None) or getattr(usage, 'completion_tokens', None) or 0
+    details = getattr(usage, 'input_tokens_details', None) or getattr(usage, 'prompt_tokens_details', None)
+    cached = getattr(details, 'cached_tokens', None) or 0
+    return prompt, completion, cached
+
+def estimate_cost(model, prompt, completion, cached=0):
+    # match dated snapshots such as gpt-4o-mini-2024-07-18 to their base model
+    name = max((m for m in PRICES if model.startswith(m)), key=len, default=None)
+    if name is None:
+        return 0.0
+    inputPrice, cachedPrice, outputPrice = PRICES[name]
+    return ((prompt - cached) * inputPrice + cached * cachedPrice + completion * outputPrice) / 1_000_000
+
+# record tokens and cost, and return the cost
+def record_usage(call: Call, prompt=0, completion=0, cached=0, characters=0):
+    labels = call.labels
+    for kind, count in (('prompt', prompt), ('completion', completion), ('cached', cached)):
+        if count:
+            TOKENS.inc(count, type=kind, **labels)
+    if characters:
+        CHARACTERS.inc(characters, **labels)
+    cost = estimate_cost(labels['model'], prompt, completion, cached)
+    if cost:
+        COST.inc(cost, **labels)
+    return cost
+
+
+########################################################
+# Retries                                              #
+########################################################
+
+# exponential backoff with larger delays and jitter; honor server hint if present
+def retry_delay(attempt, error):
+    base_delay = min(64, 2 ** (attempt + 1))
+    m = re.search(r"Please try again in\s+([0-9]+(?:\.[0-9]+)?)s", str(error))
+    hinted = float(m.group(1)) if m else 0
+    return max(base_delay, hinted) + random.uniform(0, 1.0)
+
+# errors marked `retryable = False` (e.g. shared.replay.ReplayMiss) would fail again,
+## also when the client wrapped them in its own error
+def _retryable(error):
+    while error is not None:
+        if getattr(error, 'retryable', True) is False:
+            return False
+        error = error.__cause__ or error.__context__
+    return True
+
+# loop time at which call_model_chain cancels the call to the current model
+_MODEL_DEADLINE = contextvars.ContextVar('model_deadline', default=None)
+
+# whether a cancellation came from a model chain's time limit (not, e.g., the participant leaving)
+def _deadline_passed():
+    deadline = _MODEL_DEADLINE.get()
+    return deadline is not None and asyncio.get_running_loop().time() >= deadline
+
+# run `request` until it succeeds, the retries run out or the breaker opens
+async def _with_retries(request, call: Call, breaker: CircuitBreaker, name, max_retries, hedge=None, priority=INTERACTIVE, key=None):
+    labels = call.labels
+    bot = labels['bot']
+    gaugeLabels = dict(kind=labels['kind'], app=labels['app'], model=labels['model'])
+    for attempt in range(max_retries):
+        call.attempts = attempt + 1
+        # each attempt holds a scheduler slot while it runs, but not while it waits to retry
+        async with SCHEDULER.slot(priority, key):
+            probe = await breaker.before_call()
+            call.sent()
+            try:
+                if hedge is not None:
+                    response, hedged = await hedge.run(request, labels['model'])
+                    call.hedged = call.hedged or hedged
+                else:
+                    response = await request()
+            except Exception as e:
+                await breaker.on_failure(probe)
+                error = e
+            except BaseException:
+                # a model that hangs until its time in a chain runs out counts as failing
+                if _deadline_passed():
+                    await breaker.on_failure(probe)
+                else:
+                    await breaker.on_cancel(probe)
+                raise
+            else:
+                await breaker.on_success(probe)
+                return response
+
+        # the service looks down, so stop retrying and fail fast
+        if await breaker.current_state() == OPEN:
+            raise CircuitOpenError(breaker) from error
+        if attempt == max_retries - 1 or not _retryable(error):
+            logger.error(
+                f"{name} for {bot or 'UNKNOWN'}: giving up after {attempt + 1} attempts. Last error: {error}",
+                extra=dict(labels, attempt=attempt + 1),
+            )
+            raise error
+        delay = retry_delay(attempt, error)
+        RETRIES.inc(**labels)
+        logger.warning(
+            f"{name} for {bot or 'UNKNOWN'}: {error}. Retrying in {delay:.1f}s (attempt {attempt+1}/{max_retries})",
+            extra=dict(labels, attempt=attempt + 1, delay=round(delay, 2)),
+        )
+        BACKOFF.inc(**gaugeLabels)
+        try:
+            await asyncio.sleep(delay)
+        finally:
+            BACKOFF.dec(**gaugeLabels)
+
+# run `request` (an async function with no arguments) with retries and metrics
+## `usage` can map the result to record_usage keyword arguments, for apis without token usage
+## calls fail fast while the breaker for this kind and model is open; `fallback` (an async
+## function taking the error) then supplies the response instead, see fallback_chain
+## `hedge` (a shared.hedge.HedgePolicy) sends a second copy of slow requests
+## `priority` is the scheduler class of the call (shared.scheduler), lowered by any priority() block around it
+async def call_llm(request, *, app, bot='', model='', kind='llm', name='runGPT', usage=None, max_retries=MAX_RETRIES, breaker=None, fallback=None, hedge=None, priority=None):
+    call = Call(kind, app, bot, model)
+    priority = lower(priority, current_priority())
+    breaker = breaker or get_breaker(f'{kind}:{model}')
+    traceSpan = span(f'{kind}.{name}', kind=kind, app=app, bot=bot, model=model, priority=priority)
+    session = SESSION_CODE.get()
+    labels = call.labels
+    gaugeLabels = dict(kind=kind, app=app, model=model)
+    finished = False
+    with traceSpan:
+        IN_FLIGHT.inc(**gaugeLabels)
+        LIVE_STATS.started(session, app)
+        ctxToken = _CURRENT_CALL.set(call)
+        try:
+            try:
+                response = await _with_retries(request, call, breaker, name, max_retries, hedge, priority, session or app)
+            except Exception as e:
+                end = time.perf_counter()
+                LATENCY.observe(end - call.start, **labels)
+                LIVE_STATS.finished(session, app, end - call.start, ok=False)
+                finished = True
+                traceSpan.set(attempts=call.attempts, breaker=await breaker.current_state())
+                if fallback is None:
+                    REQUESTS.inc(outcome='error', **labels)
+                    raise
+                REQUESTS.inc(outcome='fallback', **labels)
+                logger.warning(f"{name} for {bot or 'UNKNOWN'}: using fallback after {e}", extra=dict(labels))
+                traceSpan.add_event('fallback', error=str(e))
+                return await fallback(e)
+
+            end = time.perf_counter()
+            REQUESTS.inc(outcome='success', **labels)
+            QUEUE_WAIT.observe(call.sent_at - call.start, **labels)
+            TTFT.observe((call.first_token_at or end) - call.sent_at, **labels)
+            LATENCY.observe(end - call.start, **labels)
+            if usage is not None:
+                tokens = 0
+                cost = record_usage(call, **usage(response))
+            else:
+                prompt, completion, cached = token_usage(response)
+                tokens = prompt + completion
+                cost = record_usage(call, prompt, completion, cached)
+                traceSpan.set(prompt_tokens=prompt, completion_tokens=completion, cached_tokens=cached)
+            if call.hedged:
+                await hedge.spend(model, cost)
+            LIVE_STATS.finished(session, app, end - call.start, tokens=tokens, cost=cost)
+            finished = True
+            traceSpan.set(hedged=call.hedged, attempts=call.attempts, ttft_ms=round(((call.first_token_at or end) - call.sent_at) * 1000, 1))
+            return response
+        finally:
+            _CURRENT_CALL.reset(ctxToken)
+            IN_FLIGHT.dec(**gaugeLabels)
+            # cancelled before it finished
+            if not finished:
+                LIVE_STATS.cancelled(session, app)
+
+
+########################################################
+# Fallbacks                                            #
+########################################################
+
+# a stand-in for an api response, for canned replies
+## has the fields apps read from both the responses and chat completions apis
+def canned_response(parsed=None, text=None):
+    if text is None and parsed is not None:
+        text = parsed.model_dump_json() if hasattr(parsed, 'model_dump_json') else str(parsed)
+    message = SimpleNamespace(content=text)
+    return SimpleNamespace(
+        output_parsed=parsed,
+        output_text=text,
+        choices=[SimpleNamespace(message=message)],
+        usage=None,
+    )
+
+# raised by a 'thinking' fallback: the app should show the bot as still thinking and try again in `retry_after` seconds
+class BotThinking(Exception):
+
+    def __init__(self, error, retry_after):
+        super().__init__(f'bot is thinking, retry in {retry_after}s ({error})')
+        self.error = error
+        self.retry_after = retry_after
+
+# fallback for call_llm / call_model_chain that tries each option in `modes` in order
+## 'thinking': raise BotThinking, so a live method can send a pending state and call again after `retry_after` seconds
+## 'canned': return `canned` (see canned_response)
+## if none of them applies, the original error is raised
+def fallback_chain(modes, *, canned=None, retry_after=15.0):
+    async def fallback(error):
+        for mode in modes:
+            if mode == 'thinking':
+                raise BotThinking(error, retry_after)
+            if mode == 'canned' and canned is not None:
+                return canned
+        raise error
+    return fallback
+
+
+########################################################
+# Model chains and deadlines                           #
+########################################################
+
+class DeadlineExceeded(asyncio.TimeoutError):
+    pass
+
+_DEADLINES = contextvars.ContextVar('deadlines', default=True)
+
+# run model chains in this block without their time limits
+## for offline runs (e.g. batch simulations) where a reply can take hours; each model
+## in the chain still gets tried in turn if the one before it fails
+@contextlib.contextmanager
+def without_deadlines():
+    token = _DEADLINES.set(False)
+    try:
+        yield
+    finally:
+        _DEADLINES.reset(token)
+
+# try each (model, seconds) in `chain` in turn, within `deadline` seconds overall
+## `request_for(model)` makes the request for one model. A model that fails, or
+## takes longer than its seconds (None: whatever is left), is cancelled and the
+## next one is tried. Once the deadline passes, the call is cancelled and
+## `fallback` (if any) supplies the response; otherwise DeadlineExceeded is raised.
+async def call_model_chain(request_for, chain, *, deadline, app, bot='', name='runGPT', fallback=None, **kwargs):
+    if not _DEADLINES.get():
+        chain = [(model, None) for model, _ in chain]
+        deadline = math.inf
+    start = time.perf_counter()
+    error = None
+    with span(f'llm.{name}.chain', app=app, bot=bot, deadline=deadline) as chainSpan:
+        for step, (model, seconds) in enumerate(chain):
+            remaining = deadline - (time.perf_counter() - start)
+            if remaining <= 0:
+                break
+            budget = remaining if seconds is None else min(seconds, remaining)
+            deadlineToken = _MODEL_DEADLINE.set(None if budget == math.inf else asyncio.get_running_loop().time() + budget)
+            try:
+                response = await asyncio.wait_for(
+                    call_llm(lambda: request_for(model), app=app, bot=bot, model=model, name=name, **kwargs),
+                    timeout=None if budget == math.inf else budget,
+                )
+            except asyncio.TimeoutError:
+                error = DeadlineExceeded(f'{model} took longer than {budget:.1f}s')
+                TIMEOUTS.inc(app=app, bot=bot, model=model)
+            except Exception as e:
+                error = e
+            else:
+                chainSpan.set(model=model, step=step)
+                return response
+            finally:
+                _MODEL_DEADLINE.reset(deadlineToken)
+            if step < len(chain) - 1:
+                logger.warning(
+                    f"{name} for {bot or 'UNKNOWN'}: {model} failed ({error}), trying {chain[step + 1][0]}",
+                    extra=dict(app=app, bot=bot, model=model, step=step),
+                )
+                FALLTHROUGH.inc(app=app, bot=bot, model=model)
+
+        if error is None or (time.perf_counter() - start) >= deadline:
+            error = DeadlineExceeded(f'{name} for {bot or "UNKNOWN"} passed its {deadline}s deadline')
+        chainSpan.set(error=str(error))
+        if fallback is None:
+            raise error
+        return await fallback(error)
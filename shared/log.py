@@ -0,0 +1,180 @@
+"""
+Structured, leveled logging that never blocks the event loop.
+
+Records go onto a bounded queue and a background thread writes them out, so a
+slow terminal or log collector can't stall live pages. If the queue is full,
+records are dropped and counted instead of waiting.
+
+Each record carries the current session code, participant code and message
+id (set with ``log_context``), and extra fields passed with ``extra={...}``.
+High-frequency events can be sampled with ``extra={'sample': 0.01}``, which
+keeps about 1% of them.
+
+Settings (environment variables):
+- LOG_LEVEL: DEBUG, INFO (default), WARNING, ...
+- LOG_FORMAT: 'text' (default) or 'json' (one object per line)
+- LOG_QUEUE_SIZE: maximum queued records (default 10000)
+"""
+
+import atexit
+import contextvars
+import json
+import logging
+import logging.handlers
+import queue
+import random
+import sys
+import time
+from os import environ
+
+ROOT_LOGGER = 'otree_gpt'
+
+# correlation ids for the message being handled
+SESSION_CODE = contextvars.ContextVar('session_code', default=None)
+PARTICIPANT_CODE = contextvars.ContextVar('participant_code', default=None)
+MSG_ID = contextvars.ContextVar('msg_id', default=None)
+
+# attributes every LogRecord has, so anything else is an extra field
+_STANDARD_ATTRS = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime', 'sample'}
+
+
+########################################################
+# Correlation ids                                      #
+########################################################
+
+# tag log records from here on with this player's session and participant (and message id)
+## call at the start of a live method; ids stay set for the rest of the task
+def log_context(player=None, msgId=None, session_code=None, participant_code=None):
+    if player is not None:
+        session_code = player.session.code
+        participant_code = player.participant.code
+    if session_code is not None:
+        SESSION_CODE.set(session_code)
+    if participant_code is not None:
+        PARTICIPANT_CODE.set(participant_code)
+    MSG_ID.set(msgId)
+
+def set_msg_id(msgId):
+    MSG_ID.set(msgId)
+
+
+########################################################
+# Filters and formatters                               #
+########################################################
+
+class ContextFilter(logging.Filter):
+
+    def filter(self, record):
+        # sample high-frequency records before they are queued
+        rate = getattr(record, 'sample', None)
+        if rate is not None and random.random() >= rate:
+            return False
+        record.session = SESSION_CODE.get()
+        record.participant = PARTICIPANT_CODE.get()
+        record.msgId = MSG_ID.get()
+        return True
+
+
+def _extra_fields(record):
+    return {k: v for k, v in vars(record).items() if k not in _STANDARD_ATTRS and k not in ('session', 'participant', 'msgId')}
+
+
+class JsonFormatter(logging.Formatter):
+
+    def format(self, record):
+        data = dict(
+            ts=round(record.created, 6),
+            level=record.levelname,
+            logger=record.name,
+            msg=record.getMessage(),
+            session=getattr(record, 'session', None),
+            participant=getattr(record, 'participant', None),
+            msgId=getattr(record, 'msgId', None),
+        )
+        data.update(_extra_fields(record))
+        if record.exc_info:
+            data['exc'] = self.formatException(record.exc_info)
+        return json.dumps({k: v for k, v in data.items() if v is not None}, default=str, ensure_ascii=False)
+
+
+class TextFormatter(logging.Formatter):
+
+    def format(self, record):
+        ids = ' '.join(
+            f'{name}={value}' for name, value in (
+                ('session', getattr(record, 'session', None)),
+                ('participant', getattr(record, 'participant', None)),
+                ('msg', getattr(record, 'msgId', None)),
+            ) if value
+        )
+        fields = ' '.join(f'{k}={v}' for k, v in _extra_fields(record).items())
+        stamp = time.strftime('%H:%M:%S', time.localtime(record.created))
+        line = f'{stamp} {record.levelname:7s} {record.name}: {record.getMessage()}'
+        if ids:
+            line += f' [{ids}]'
+        if fields:
+            line += f' {fields}'
+        if record.exc_info:
+            line += '\n' + self.formatException(record.exc_info)
+        return line
+
+
+########################################################
+# Queue handler                                        #
+########################################################
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+
+    def __init__(self, q):
+        super().__init__(q)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def prepare(self, record):
+        # format the message now, while the arguments still have their current values
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+
+_HANDLER = None
+_LISTENER = None
+
+# set up the queue and writer thread (done automatically by get_logger)
+def setup_logging(level=None, fmt=None, stream=None, queue_size=None):
+    global _HANDLER, _LISTENER
+    if _HANDLER is not None:
+        return _HANDLER
+
+    level = level or environ.get('LOG_LEVEL', 'INFO')
+    fmt = fmt or environ.get('LOG_FORMAT', 'text')
+    queue_size = queue_size or int(environ.get('LOG_QUEUE_SIZE', 10000))
+
+    output = logging.StreamHandler(stream or sys.stdout)
+    output.setFormatter(JsonFormatter() if fmt == 'json' else TextFormatter())
+
+    _HANDLER = DroppingQueueHandler(queue.Queue(maxsize=queue_size))
+    _HANDLER.addFilter(ContextFilter())
+    _LISTENER = logging.handlers.QueueListener(_HANDLER.queue, output, respect_handler_level=False)
+    _LISTENER.start()
+    atexit.register(_LISTENER.stop)
+
+    root = logging.getLogger(ROOT_LOGGER)
+    root.setLevel(level.upper() if isinstance(level, str) else level)
+    root.addHandler(_HANDLER)
+    root.propagate = False
+    return _HANDLER
+
+# logger for a module, e.g. get_logger(__name__)
+def get_logger(name):
+    setup_logging()
+    return logging.getLogger(f'{ROOT_LOGGER}.{name}')
+
+# number of records dropped because the queue was full
+def dropped_records():
+    return _HANDLER.dropped if _HANDLER is not None else 0
@@ -0,0 +1,187 @@
+"""
+In-process metrics with Prometheus text output.
+
+Counters, gauges and histograms are kept in memory and labelled (for example
+by app, bot and model). ``render()`` returns them in the Prometheus text
+exposition format, and ``install_metrics_route()`` serves that from the oTree
+server at /metrics (only if METRICS_TOKEN is set, see shared.server).
+"""
+
+import bisect
+import threading
+
+# default histogram buckets in seconds, from fast api calls to slow retries
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2, 4, 8, 16, 32, 64, 128)
+
+
+########################################################
+# Metric types                                         #
+########################################################
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        return tuple(str(labels.get(name, '')) for name in self.labelnames)
+
+    def _label_text(self, key, extra=()):
+        pairs = list(zip(self.labelnames, key)) + list(extra)
+        if not pairs:
+            return ''
+        return '{' + ','.join(f'{k}="{_escape(v)}"' for k, v in pairs) + '}'
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self._values.get(self._key(labels), 0)
+
+    # sum over all label values matching the given labels
+    def total(self, **labels):
+        idx = [(self.labelnames.index(k), str(v)) for k, v in labels.items()]
+        with self._lock:
+            return sum(v for key, v in self._values.items() if all(key[i] == want for i, want in idx))
+
+    def samples(self):
+        with self._lock:
+            items = list(self._values.items())
+        return [(self.name + self._label_text(key), value) for key, value in items]
+
+
+class Gauge(Counter):
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            idx = bisect.bisect_left(self.buckets, value)
+            if idx < len(self.buckets):
+                state[0][idx] += 1
+            state[1] += value
+            state[2] += 1
+
+    def samples(self):
+        with self._lock:
+            items = [(key, (list(s[0]), s[1], s[2])) for key, s in self._values.items()]
+        out = []
+        for key, (counts, total, count) in items:
+            cumulative = 0
+            for bound, n in zip(self.buckets, counts):
+                cumulative += n
+                out.append((f'{self.name}_bucket' + self._label_text(key, [('le', _fmt(bound))]), cumulative))
+            out.append((f'{self.name}_bucket' + self._label_text(key, [('le', '+Inf')]), count))
+            out.append((f'{self.name}_sum' + self._label_text(key), total))
+            out.append((f'{self.name}_count' + self._label_text(key), count))
+        return out
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+def _fmt(value):
+    return repr(float(value))
+
+
+########################################################
+# Registry                                             #
+########################################################
+
+class Registry:
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    # return the existing metric with this name, or register a new one
+    def _get(self, cls, name, help, labelnames, **kwargs):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(name, help, labelnames, **kwargs)
+            elif not isinstance(metric, cls):
+                raise ValueError(f'metric {name} is already registered as a {metric.kind}')
+            return metric
+
+    def counter(self, name, help, labelnames=()):
+        return self._get(Counter, name, help, labelnames)
+
+    def gauge(self, name, help, labelnames=()):
+        return self._get(Gauge, name, help, labelnames)
+
+    def histogram(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        return self._get(Histogram, name, help, labelnames, buckets=buckets)
+
+    def get(self, name):
+        return self._metrics.get(name)
+
+    # prometheus text exposition format
+    def render(self) -> str:
+        lines = []
+        for metric in list(self._metrics.values()):
+            lines.append(f'# HELP {metric.name} {metric.help}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            for sample, value in metric.samples():
+                lines.append(f'{sample} {value}')
+        return '\n'.join(lines) + '\n'
+
+
+# registry shared by everything in this process
+REGISTRY = Registry()
+
+def render() -> str:
+    return REGISTRY.render()
+
+
+########################################################
+# oTree route                                          #
+########################################################
+
+# serve the metrics at /metrics on the oTree server
+## only with METRICS_TOKEN set, which requests must send as "Authorization: Bearer <token>" (or ?token=)
+def install_metrics_route(path='/metrics'):
+    from shared.routes import add_route, metrics_token
+    if metrics_token():
+        add_route(path, metrics_endpoint, methods=['GET'])
+
+async def metrics_endpoint(request):
+    from starlette.responses import PlainTextResponse
+    from shared.routes import authorized
+
+    if not authorized(request):
+        return PlainTextResponse('unauthorized', status_code=401)
+    return PlainTextResponse(render(), media_type='text/plain; version=0.0.4')
@@ -0,0 +1,167 @@
+"""
+Prompt templates that are filled in once per player, not on every turn.
+
+A bot's system prompt is mostly the same on every turn. Only some parts change
+between players (the topic, the stance the bot argues for), and a few change on
+every call (a message id). A ``PromptTemplate`` is the prompt written once with
+``{fields}``, as in str.format. ``compile()`` fills in the fields that stay the
+same for a player and returns a ``CompiledPrompt``. Its ``render()`` only fills
+in what is left, and ``text`` is the whole prompt if nothing is left.
+
+``PROMPTS`` keeps the templates by name and caches compiled prompts by the
+values filled in, so players with the same topic and stance share one. Apps can
+compile a player's prompts as soon as they are known (e.g. chat_japanese after
+the pre-chat question), so the chat page only renders the volatile parts.
+
+Each compiled prompt knows its size in tokens (``tokens``, for the compiled
+part), and ``PROMPTS.token_counts()`` lists them all. Tokens are counted with
+tiktoken if it is installed, otherwise estimated.
+"""
+
+import collections
+import functools
+import string
+import threading
+
+_FORMATTER = string.Formatter()
+
+
+########################################################
+# Token counts                                         #
+########################################################
+
+@functools.lru_cache(maxsize=None)
+def _encoding(model):
+    try:
+        import tiktoken
+    except ImportError:
+        return None
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        return tiktoken.get_encoding('o200k_base')
+
+# tokens in `text` for `model` (estimated without tiktoken: ~4 ascii characters, or 1 other character, per token)
+def count_tokens(text, model='gpt-4o-mini') -> int:
+    encoding = _encoding(model)
+    if encoding is not None:
+        return len(encoding.encode(text))
+    asciiChars = sum(1 for c in text if c.isascii())
+    return (asciiChars + 3) // 4 + (len(text) - asciiChars)
+
+
+########################################################
+# Templates                                            #
+########################################################
+
+class CompiledPrompt:
+
+    def __init__(self, name, static, parts):
+        self.name = name
+        self.static = static
+        # literal strings and (field, format_spec, conversion) for the fields left to fill
+        self.parts = parts
+        self.fields = tuple(dict.fromkeys(p[0] for p in parts if isinstance(p, tuple)))
+        literal = ''.join(p for p in parts if isinstance(p, str))
+        self.text = literal if not self.fields else None
+        self.tokens = count_tokens(literal)
+
+    def render(self, **values) -> str:
+        if not self.fields:
+            return self.text
+        out = []
+        for part in self.parts:
+            if isinstance(part, str):
+                out.append(part)
+            else:
+                field, spec, conversion = part
+                value = _FORMATTER.convert_field(values[field], conversion)
+                out.append(_FORMATTER.format_field(value, spec))
+        return ''.join(out)
+
+
+class PromptTemplate:
+
+    def __init__(self, name, text):
+        self.name = name
+        self.text = text
+        # (literal text, field, format_spec, conversion) as parsed by string.Formatter
+        self._parsed = list(_FORMATTER.parse(text))
+        self.fields = tuple(dict.fromkeys(f for _, f, _, _ in self._parsed if f is not None))
+
+    # fill in `static` and keep the other fields for render()
+    def compile(self, **static) -> CompiledPrompt:
+        unknown = set(static) - set(self.fields)
+        if unknown:
+            raise KeyError(f'{self.name} has no fields {sorted(unknown)}')
+        parts = []
+        for literal, field, spec, conversion in self._parsed:
+            if literal:
+                parts.append(literal)
+            if field is None:
+                continue
+            if field in static:
+                value = _FORMATTER.convert_field(static[field], conversion)
+                parts.append(_FORMATTER.format_field(value, spec or ''))
+            else:
+                parts.append((field, spec or '', conversion))
+        # join neighbouring literals, so render() has less to do
+        merged = []
+        for part in parts:
+            if isinstance(part, str) and merged and isinstance(merged[-1], str):
+                merged[-1] += part
+            else:
+                merged.append(part)
+        return CompiledPrompt(self.name, static, merged)
+
+
+########################################################
+# Registry                                             #
+########################################################
+
+class PromptRegistry:
+
+    def __init__(self, max_compiled=1024):
+        self.max_compiled = max_compiled
+        self._templates = {}
+        # (name, static values) -> CompiledPrompt, least recently used first
+        self._compiled = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def register(self, name, text) -> PromptTemplate:
+        template = PromptTemplate(name, text)
+        with self._lock:
+            self._templates[name] = template
+            for key in [k for k in self._compiled if k[0] == name]:
+                del self._compiled[key]
+        return template
+
+    def get(self, name) -> PromptTemplate:
+        return self._templates[name]
+
+    # template `name` with `static` filled in, compiled once for each set of values (which must be hashable)
+    def compile(self, name, **static) -> CompiledPrompt:
+        key = (name, tuple(sorted(static.items())))
+        with self._lock:
+            compiled = self._compiled.get(key)
+            if compiled is not None:
+                self._compiled.move_to_end(key)
+                return compiled
+        compiled = self._templates[name].compile(**static)
+        with self._lock:
+            self._compiled[key] = compiled
+            while len(self._compiled) > self.max_compiled:
+                self._compiled.popitem(last=False)
+        return compiled
+
+    # {template name: [(static values, tokens), ...]} for the compiled prompts
+    def token_counts(self) -> dict:
+        with self._lock:
+            compiled = list(self._compiled.values())
+        counts = {}
+        for c in compiled:
+            counts.setdefault(c.name, []).append((c.static, c.tokens))
+        return counts
+
+
+PROMPTS = PromptRegistry()
@@ -0,0 +1,132 @@
+"""
+Non-blocking local storage for audio recordings.
+
+Files are handed to a bounded queue and written by background workers in a
+thread, so slow disks never stall the event loop that serves live pages.
+Each file is written to a temporary name and renamed into place once it is
+complete, so the browser never sees a half-written recording.
+"""
+
+import asyncio
+import os
+
+from shared.log import get_logger
+
+logger = get_logger(__name__)
+
+########################################################
+# fsync policies                                       #
+########################################################
+
+## 'none': leave flushing to the operating system (fastest)
+## 'file': fsync each file before it is renamed into place
+## 'full': also fsync the directory so the rename itself survives a crash
+FSYNC_NONE = 'none'
+FSYNC_FILE = 'file'
+FSYNC_FULL = 'full'
+FSYNC_POLICIES = (FSYNC_NONE, FSYNC_FILE, FSYNC_FULL)
+
+
+########################################################
+# Recording store                                      #
+########################################################
+
+class RecordingStore:
+
+    def __init__(self, directory, max_queue=64, workers=2, fsync=FSYNC_FILE):
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError(f'fsync must be one of {FSYNC_POLICIES}, not {fsync!r}')
+        self.directory = directory
+        self.max_queue = max_queue
+        self.num_workers = workers
+        self.fsync = fsync
+
+        # queue and workers are created lazily on the running event loop
+        self._queue = None
+        self._workers = []
+
+        # counters for health checks
+        self.written = 0
+        self.failed = 0
+
+    # start queue and worker tasks if needed
+    def _ensure_workers(self):
+        if self._queue is None:
+            self._queue = asyncio.Queue(maxsize=self.max_queue)
+        self._workers = [t for t in self._workers if not t.done()]
+        while len(self._workers) < self.num_workers:
+            self._workers.append(asyncio.create_task(self._worker()))
+
+    # queue a file for writing and return a future that resolves to its path
+    ## if the queue is full, this waits until there is room (backpressure)
+    async def submit(self, filename: str, data: bytes) -> asyncio.Future:
+        self._ensure_workers()
+        fut = asyncio.get_running_loop().create_future()
+        fut.add_done_callback(_report_failure)
+        await self._queue.put((os.path.basename(filename), data, fut))
+        return fut
+
+    # queue a file and wait until it is on disk
+    async def save(self, filename: str, data: bytes) -> str:
+        fut = await self.submit(filename, data)
+        return await fut
+
+    # wait for all queued writes to finish
+    async def drain(self):
+        if self._queue is not None:
+            await self._queue.join()
+
+    # current queue depth and counters
+    def health(self) -> dict:
+        return dict(
+            queue_depth=self.queue_depth,
+            max_queue=self.max_queue,
+            workers=len([t for t in self._workers if not t.done()]),
+            written=self.written,
+            failed=self.failed,
+        )
+
+    @property
+    def queue_depth(self) -> int:
+        return self._queue.qsize() if self._queue is not None else 0
+
+    async def _worker(self):
+        while True:
+            filename, data, fut = await self._queue.get()
+            try:
+                path = await asyncio.to_thread(self._write, filename, data)
+                self.written += 1
+                if not fut.done():
+                    fut.set_result(path)
+            except Exception as e:
+                self.failed += 1
+                if not fut.done():
+                    fut.set_exception(e)
+            finally:
+                self._queue.task_done()
+
+    # blocking write, runs in a worker thread
+    def _write(self, filename: str, data: bytes) -> str:
+        path = os.path.join(self.directory, filename)
+        tmpPath = path + '.part'
+        with open(tmpPath, 'wb') as f:
+            f.write(data)
+            if self.fsync != FSYNC_NONE:
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(tmpPath, path)
+
+        # make the rename durable as well
+        if self.fsync == FSYNC_FULL and hasattr(os, 'O_DIRECTORY'):
+            dirFd = os.open(self.directory, os.O_RDONLY | os.O_DIRECTORY)
+            try:
+                os.fsync(dirFd)
+            finally:
+                os.close(dirFd)
+        return path
+
+
+# log failed writes, including fire-and-forget ones nobody awaits
+def _report_failure(fut: asyncio.Future):
+    if not fut.cancelled() and fut.exception() is not None:
+        logger.error(f'Error saving recording: {fut.exception()}')
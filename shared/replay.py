@@ -0,0 +1,325 @@
+"""
+Record and replay API responses.
+
+Rerunning an app's bots (to debug a transcript, or in a test or benchmark)
+calls the API again and gets different replies each time. With replay on, the
+HTTP requests to the LLM, speech-to-text and text-to-speech APIs go through
+``ReplayTransport``, which keeps each response in a local store:
+
+- 'record': send every request and save its response
+- 'replay': answer every request from the store, without any network; a
+  request that was never recorded fails with ReplayMiss
+- 'auto': answer from the store when the request was recorded, otherwise
+  send it and save the response
+
+Requests are looked up by a hash of the normalized request: method, path,
+query and body. The body includes the model, messages, schema, temperature,
+etc. Headers (API keys), the host (real API or stub server) and values that
+change on every run (timestamps such as the ones in message ids) are left out.
+Identical requests are answered in the order they were recorded.
+
+The store is content-addressed. Response bodies are kept once under the hash
+of their content (e.g. the same audio for two requests), and each request hash
+points to the bodies recorded for it:
+
+    <dir>/objects/ab/ab12...   response bodies
+    <dir>/requests/cd/cd34...json   status, content type and body hashes for one request
+
+Settings (environment variables):
+- REPLAY_MODE: 'off' (default), 'record', 'replay' or 'auto'
+- REPLAY_DIR: folder for the store (default _replay)
+
+``install_replay()`` runs once from settings.py (see shared.server), before
+the apps are imported, and routes their OpenAI clients through the store when
+REPLAY_MODE is set. Other httpx clients can use ``replay_transport()`` /
+``sync_replay_transport()``.
+"""
+
+import hashlib
+import json
+import os
+import re
+import threading
+from os import environ
+
+import httpx
+
+from shared.log import get_logger
+from shared.metrics import REGISTRY
+
+logger = get_logger(__name__)
+
+OFF = 'off'
+RECORD = 'record'
+REPLAY = 'replay'
+AUTO = 'auto'
+MODES = (OFF, RECORD, REPLAY, AUTO)
+
+DEFAULT_DIR = '_replay'
+
+## body fields that don't change the reply
+IGNORED_FIELDS = {'user', 'metadata', 'safety_identifier', 'prompt_cache_key'}
+
+## unix timestamps (seconds, with or without a fraction, or milliseconds) and iso datetimes
+VOLATILE = re.compile(
+    r'\b1[5-9]\d{8}(?:\.\d+|\d{3})?\b'
+    r'|\d{4}-\d\d-\d\d[T ]\d\d:\d\d:\d\d(?:\.\d+)?(?:Z|[+-]\d\d:?\d\d)?'
+)
+
+## response headers kept in the store
+KEPT_HEADERS = ('content-type',)
+
+## headers that describe the body as it was sent, not the decoded body passed on
+BODY_HEADERS = ('content-encoding', 'content-length', 'transfer-encoding')
+
+RESPONSES = REGISTRY.counter('replay_requests_total', 'Requests seen by the replay store, by outcome (hit, miss, recorded)', ('mode', 'outcome'))
+
+
+# a request that replay mode has no recording for
+class ReplayMiss(Exception):
+    # call_llm doesn't retry it: it would miss again
+    retryable = False
+
+
+def replay_mode() -> str:
+    mode = environ.get('REPLAY_MODE', OFF) or OFF
+    if mode not in MODES:
+        raise ValueError(f'REPLAY_MODE must be one of {MODES}, not {mode!r}')
+    return mode
+
+
+########################################################
+# Request keys                                         #
+########################################################
+
+def _scrub(value):
+    if isinstance(value, dict):
+        return {k: _scrub(v) for k, v in value.items() if k not in IGNORED_FIELDS}
+    if isinstance(value, list):
+        return [_scrub(v) for v in value]
+    if isinstance(value, str):
+        return VOLATILE.sub('<time>', value)
+    return value
+
+# (hash, normalized request) for an httpx request whose body has been read
+def request_key(request: httpx.Request):
+    contentType = request.headers.get('content-type', '')
+    content = request.content
+    if 'json' in contentType:
+        body = _scrub(json.loads(content or b'null'))
+    elif 'multipart' in contentType:
+        # the boundary is random, the parts (e.g. the audio to transcribe) are not
+        boundary = contentType.split('boundary=')[-1].encode()
+        body = 'sha256:' + hashlib.sha256(content.replace(boundary, b'<boundary>')).hexdigest()
+    elif content:
+        body = 'sha256:' + hashlib.sha256(content).hexdigest()
+    else:
+        body = None
+    normalized = dict(
+        method=request.method,
+        path=request.url.path,
+        query=sorted(request.url.params.multi_items()),
+        body=body,
+    )
+    text = json.dumps(normalized, sort_keys=True, ensure_ascii=False, separators=(',', ':'))
+    return hashlib.sha256(text.encode()).hexdigest(), normalized
+
+
+########################################################
+# Store                                                #
+########################################################
+
+class ReplayStore:
+
+    def __init__(self, directory=DEFAULT_DIR):
+        self.directory = directory
+        self._lock = threading.Lock()
+        # request hash -> times it was answered in this process
+        self._served = {}
+        # request hashes recorded by this process, whose older recordings were replaced
+        self._recorded = set()
+
+    def _path(self, kind, digest, suffix=''):
+        return os.path.join(self.directory, kind, digest[:2], digest + suffix)
+
+    def _write(self, path, data: bytes):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, path)
+
+    def _entry(self, key):
+        try:
+            with open(self._path('requests', key, '.json'), encoding='utf-8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    # the recorded response for the next occurrence of `key`, or None
+    def load(self, key):
+        with self._lock:
+            entry = self._entry(key)
+            if not entry or not entry['responses']:
+                return None
+            n = self._served.get(key, 0)
+            self._served[key] = n + 1
+        # identical requests get the recorded responses in order, then the last one again
+        item = entry['responses'][min(n, len(entry['responses']) - 1)]
+        with open(self._path('objects', item['body']), 'rb') as f:
+            content = f.read()
+        return httpx.Response(item['status'], headers=item['headers'], content=content)
+
+    # save one response to `key`; the first save in a process replaces older recordings
+    def save(self, key, normalized, status, headers, content: bytes):
+        digest = hashlib.sha256(content).hexdigest()
+        objectPath = self._path('objects', digest)
+        if not os.path.exists(objectPath):
+            self._write(objectPath, content)
+        item = dict(status=status, headers=headers, body=digest)
+        with self._lock:
+            entry = self._entry(key)
+            if entry is None or key not in self._recorded:
+                entry = dict(request=normalized, responses=[])
+                self._recorded.add(key)
+            entry['responses'].append(item)
+            self._write(self._path('requests', key, '.json'), json.dumps(entry, ensure_ascii=False, indent=1).encode())
+
+
+_STORES = {}
+_STORES_LOCK = threading.Lock()
+
+# one store per folder (default REPLAY_DIR), shared by every transport in this process
+def get_store(directory=None) -> ReplayStore:
+    directory = directory or environ.get('REPLAY_DIR', DEFAULT_DIR)
+    with _STORES_LOCK:
+        if directory not in _STORES:
+            _STORES[directory] = ReplayStore(directory)
+        return _STORES[directory]
+
+
+########################################################
+# Transports                                           #
+########################################################
+
+class _Replay:
+
+    def __init__(self, inner, store=None, mode=None):
+        self.inner = inner
+        self.store = store or get_store()
+        self.mode = mode or replay_mode()
+
+    # the stored response, or None if the request should be sent
+    def _lookup(self, request):
+        key, normalized = request_key(request)
+        if self.mode != RECORD:
+            response = self.store.load(key)
+            if response is not None:
+                RESPONSES.inc(mode=self.mode, outcome='hit')
+                return key, normalized, response
+            if self.mode == REPLAY:
+                RESPONSES.inc(mode=self.mode, outcome='miss')
+                logger.error(f'No recording for {request.method} {request.url.path} ({key[:12]}) in {self.store.directory}')
+                raise ReplayMiss(f'no recording for {request.method} {request.url.path} ({key[:12]})')
+        return key, normalized, None
+
+    # keep successful responses; errors and rate limits are left to be retried
+    def _save(self, key, normalized, response, content):
+        if response.status_code >= 500 or response.status_code == 429:
+            return
+        headers = {k: response.headers[k] for k in KEPT_HEADERS if k in response.headers}
+        self.store.save(key, normalized, response.status_code, headers, content)
+        RESPONSES.inc(mode=self.mode, outcome='recorded')
+
+    # a response with the body that was read from `response`
+    @staticmethod
+    def _copy(response, content):
+        headers = [(k, v) for k, v in response.headers.multi_items() if k.lower() not in BODY_HEADERS]
+        return httpx.Response(response.status_code, headers=headers, content=content)
+
+
+# httpx transport for async clients (the OpenAI SDK, shared.stt)
+class ReplayTransport(_Replay, httpx.AsyncBaseTransport):
+
+    def __init__(self, inner=None, store=None, mode=None):
+        super().__init__(inner or httpx.AsyncHTTPTransport(), store, mode)
+
+    async def handle_async_request(self, request):
+        await request.aread()
+        key, normalized, response = self._lookup(request)
+        if response is not None:
+            return response
+        response = await self.inner.handle_async_request(request)
+        content = await response.aread()
+        self._save(key, normalized, response, content)
+        return self._copy(response, content)
+
+    async def aclose(self):
+        await self.inner.aclose()
+
+
+# httpx transport for sync clients (e.g. text-to-speech in a worker thread)
+class SyncReplayTransport(_Replay, httpx.BaseTransport):
+
+    def __init__(self, inner=None, store=None, mode=None):
+        super().__init__(inner or httpx.HTTPTransport(), store, mode)
+
+    def handle_request(self, request):
+        request.read()
+        key, normalized, response = self._lookup(request)
+        if response is not None:
+            return response
+        response = self.inner.handle_request(request)
+        content = response.read()
+        self._save(key, normalized, response, content)
+        return self._copy(response, content)
+
+    def close(self):
+        self.inner.close()
+
+
+# transport for an httpx.AsyncClient: `inner` wrapped in a ReplayTransport if REPLAY_MODE is set
+## with replay off, returns `inner` as is (None for httpx's default)
+def replay_transport(inner=None):
+    if replay_mode() == OFF:
+        return inner
+    return ReplayTransport(inner)
+
+# the same for an httpx.Client
+def sync_replay_transport(inner=None):
+    if replay_mode() == OFF:
+        return inner
+    return SyncReplayTransport(inner)
+
+
+########################################################
+# Apps                                                 #
+########################################################
+
+# route the apps' OpenAI clients through the replay store if REPLAY_MODE is set
+## replaces openai.AsyncOpenAI with a subclass that uses a replaying http client, so it
+## has to run before the apps import it; clients given their own http client (a stub,
+## tools.simulate, chat_voice's replay_transport()) keep it
+def install_replay():
+    import openai
+
+    mode = replay_mode()
+    if mode == OFF or issubclass(openai.AsyncOpenAI, _ReplayClient):
+        return
+
+    class ReplayingAsyncOpenAI(_ReplayClient, openai.AsyncOpenAI):
+
+        def __init__(self, *args, **kwargs):
+            if kwargs.get('http_client') is None:
+                kwargs['http_client'] = httpx.AsyncClient(transport=ReplayTransport())
+                if mode == REPLAY:
+                    # a miss would only miss again
+                    kwargs.setdefault('max_retries', 0)
+            super().__init__(*args, **kwargs)
+
+    openai.AsyncOpenAI = ReplayingAsyncOpenAI
+    logger.info(f'API calls in {mode} mode, store {get_store().directory}')
+
+# marks the AsyncOpenAI that install_replay put in place
+class _ReplayClient:
+    pass
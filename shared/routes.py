@@ -0,0 +1,127 @@
+"""
+Extra HTTP routes on the oTree server.
+
+oTree builds its web app (otree.asgi) when the server starts, after importing
+settings.py and the apps. Importing otree.asgi any earlier would import the
+apps' pages from inside settings, so routes added before then are kept until
+otree.asgi has been imported, and added to its router right after. Routes
+added later (e.g. from a live method) go in right away. Adding the same path
+twice does nothing. Websocket routes can also take over one of oTree's paths
+(see shared.connection), and ``add_startup()`` runs a function on the
+server's event loop when it starts.
+
+Server-wide routes and hooks are installed once from settings.py (see
+shared.server), so they are in place every time the server starts.
+"""
+
+import importlib.abc
+import importlib.util
+import sys
+from os import environ
+
+from shared.log import get_logger
+
+logger = get_logger(__name__)
+
+APP_MODULE = 'otree.asgi'
+
+# functions waiting for oTree's web app
+_PENDING = []
+
+
+def _app_ready():
+    module = sys.modules.get(APP_MODULE)
+    return module is not None and hasattr(module, 'app')
+
+# oTree's routes (from sys.modules, as otree.asgi may still be finishing its import)
+def _routes():
+    return sys.modules[APP_MODULE].app.router.routes
+
+def _run(fn):
+    try:
+        fn()
+    except Exception:
+        # a broken route shouldn't keep the server from starting
+        logger.exception('Could not add a route to the oTree server')
+
+def _run_pending():
+    while _PENDING:
+        _run(_PENDING.pop(0))
+
+
+# runs the functions in _PENDING once otree.asgi has been imported
+class _AppImportHook(importlib.abc.MetaPathFinder):
+
+    def find_spec(self, name, path, target=None):
+        if name != APP_MODULE:
+            return None
+        sys.meta_path.remove(self)
+        spec = importlib.util.find_spec(name)
+        if spec is None or spec.loader is None:
+            return spec
+        execModule = spec.loader.exec_module
+
+        def exec_module(module):
+            execModule(module)
+            _run_pending()
+
+        spec.loader.exec_module = exec_module
+        return spec
+
+_HOOK = _AppImportHook()
+
+
+# call `fn` once oTree's web app exists (right away if it already does)
+def when_app_ready(fn):
+    if _app_ready():
+        _run(fn)
+        return
+    _PENDING.append(fn)
+    if _HOOK not in sys.meta_path:
+        sys.meta_path.insert(0, _HOOK)
+
+
+def add_route(path, endpoint, methods=('GET',)):
+    def add():
+        from starlette.routing import Route
+
+        routes = _routes()
+        if any(getattr(route, 'path', None) == path for route in routes):
+            return
+        # put it first so it isn't shadowed by oTree's own patterns
+        routes.insert(0, Route(path, endpoint, methods=list(methods)))
+
+    when_app_ready(add)
+
+# serve a websocket path with the endpoint `make_endpoint()` returns, in front of oTree's own route for it (if any)
+## the endpoint is made once the app exists, since it may subclass one of oTree's consumers
+def add_websocket_route(path, make_endpoint):
+    def add():
+        from starlette.routing import WebSocketRoute
+
+        endpoint = make_endpoint()
+        routes = _routes()
+        if any(getattr(route, 'path', None) == path and getattr(route, 'endpoint', None) is endpoint for route in routes):
+            return
+        routes.insert(0, WebSocketRoute(path, endpoint))
+
+    when_app_ready(add)
+
+# run `fn` (a coroutine function) when the server starts, on the server's event loop
+def add_startup(fn):
+    def add():
+        sys.modules[APP_MODULE].app.router.on_startup.append(fn)
+
+    when_app_ready(add)
+
+# the METRICS_TOKEN, or None if it isn't set (then the routes that need it are not served)
+def metrics_token():
+    return environ.get('METRICS_TOKEN') or None
+
+# check the METRICS_TOKEN ("Authorization: Bearer <token>" or ?token=); without a token nobody is let in
+def authorized(request):
+    token = metrics_token()
+    if not token:
+        return False
+    supplied = request.headers.get('authorization', '').removeprefix('Bearer ').strip() or request.query_params.get('token')
+    return supplied == token
@@ -0,0 +1,232 @@
+"""
+Priority scheduling for API calls.
+
+Without it, every call goes to the provider as soon as it is made, so a
+participant waiting for a reply competes with moderator feedback and with
+background work such as pre-generated greetings. When the server is busy,
+all of them slow down together.
+
+Each call made through shared.llm now waits for a slot from the scheduler.
+Calls belong to a priority class:
+
+- INTERACTIVE: a reply a participant is waiting for (the default)
+- GREETING: greetings generated ahead of time (shared.warmup)
+- MODERATOR: moderator feedback
+- BACKGROUND: simulations, batch jobs and other work nobody is waiting for
+
+When a slot frees up, it goes to the highest class that has waiting calls and
+is under its cap. Each class has a cap on the calls it can run at once, and
+the lower classes have smaller caps. On top of that, ``reserve`` slots are
+only used by interactive replies: the other classes together never run more
+than concurrency - reserve calls, so an interactive reply can start at once
+even when greetings, moderators and background work fill everything else.
+Within a class, sessions take turns (weighted fair queuing), so one busy
+session can't hold up the others.
+
+Set the class of the calls in a block with ``with priority(GREETING): ...``,
+or pass ``priority=`` to call_llm / call_model_chain. If both are given, the
+lower of the two is used.
+
+Settings (environment variables):
+- SCHEDULER_CONCURRENCY: API calls running at once over all classes (default 32, 0 turns scheduling off)
+- SCHEDULER_CAP_INTERACTIVE, SCHEDULER_CAP_GREETING, SCHEDULER_CAP_MODERATOR,
+  SCHEDULER_CAP_BACKGROUND: calls running at once per class
+  (defaults: all of SCHEDULER_CONCURRENCY, 1/2, 1/2 and 1/4 of it)
+- SCHEDULER_RESERVE: slots only interactive replies can use (default 1/4 of SCHEDULER_CONCURRENCY)
+"""
+
+import asyncio
+import contextlib
+import contextvars
+import heapq
+import itertools
+import threading
+import time
+from os import environ
+
+from shared.dashboard import LIVE_STATS
+from shared.metrics import REGISTRY
+
+INTERACTIVE = 'interactive'
+GREETING = 'greeting'
+MODERATOR = 'moderator'
+BACKGROUND = 'background'
+
+## highest priority first
+CLASSES = (INTERACTIVE, GREETING, MODERATOR, BACKGROUND)
+
+QUEUED = REGISTRY.gauge('scheduler_queued', 'API calls waiting for a slot', ('priority',))
+RUNNING = REGISTRY.gauge('scheduler_running', 'API calls holding a slot', ('priority',))
+WAIT = REGISTRY.histogram('scheduler_wait_seconds', 'Time API calls waited for a slot', ('priority',))
+
+LIVE_STATS.register_queue('api calls waiting for a slot', QUEUED.total)
+
+_PRIORITY = contextvars.ContextVar('priority', default=None)
+
+
+# run the calls made in this block with a priority class
+@contextlib.contextmanager
+def priority(cls):
+    token = _PRIORITY.set(lower(cls, _PRIORITY.get()))
+    try:
+        yield
+    finally:
+        _PRIORITY.reset(token)
+
+# the lower of two priority classes (None counts as INTERACTIVE)
+def lower(*classes):
+    return max((cls or INTERACTIVE for cls in classes), key=CLASSES.index)
+
+def current_priority():
+    return _PRIORITY.get() or INTERACTIVE
+
+
+class _Waiter:
+
+    def __init__(self, loop, tag):
+        self.loop = loop
+        self.future = loop.create_future()
+        self.tag = tag
+        self.granted = False
+        self.cancelled = False
+
+
+class Scheduler:
+
+    def __init__(self, concurrency=32, caps=None, reserve=None):
+        self.concurrency = concurrency
+        # at least one slot is left to the other classes
+        if reserve is None:
+            reserve = max(1, concurrency // 4)
+        self.reserve = max(0, min(reserve, concurrency - 1))
+        self.caps = {
+            INTERACTIVE: concurrency,
+            GREETING: max(1, concurrency // 2),
+            MODERATOR: max(1, concurrency // 2),
+            BACKGROUND: max(1, concurrency // 4),
+        }
+        self.caps.update(caps or {})
+
+        self.running = dict.fromkeys(CLASSES, 0)
+        self._queues = {cls: [] for cls in CLASSES}
+        # virtual time of each class, and the finish tag of the last call queued per (class, key)
+        self._virtual = dict.fromkeys(CLASSES, 0.0)
+        self._finish = {}
+        self._order = itertools.count()
+        self._lock = threading.Lock()
+
+    # hold a slot for one API call
+    ## `key` is what takes turns within a class (the session code); `weight` is its share
+    @contextlib.asynccontextmanager
+    async def slot(self, cls=INTERACTIVE, key=None, weight=1.0):
+        if not self.concurrency:
+            yield
+            return
+        await self._acquire(cls, key, weight)
+        try:
+            yield
+        finally:
+            self._release(cls)
+
+    async def _acquire(self, cls, key, weight):
+        with self._lock:
+            if self._can_start(cls):
+                self._start(cls)
+                return
+            # weighted fair queuing: a key's calls are spaced 1/weight apart in virtual time
+            tag = max(self._virtual[cls], self._finish.get((cls, key), 0.0)) + 1 / weight
+            self._finish[(cls, key)] = tag
+            waiter = _Waiter(asyncio.get_running_loop(), tag)
+            heapq.heappush(self._queues[cls], (tag, next(self._order), waiter))
+            QUEUED.inc(priority=cls)
+
+        start = time.perf_counter()
+        try:
+            await waiter.future
+        except asyncio.CancelledError:
+            with self._lock:
+                if waiter.granted:
+                    # cancelled just after being given a slot, so pass it on
+                    self._running_dec(cls)
+                    self._dispatch()
+                else:
+                    waiter.cancelled = True
+                    QUEUED.dec(priority=cls)
+            raise
+        WAIT.observe(time.perf_counter() - start, priority=cls)
+
+    # whether a call of `cls` is under the limits (total, its cap, and the reserve for interactive replies)
+    def _has_room(self, cls):
+        if sum(self.running.values()) >= self.concurrency or self.running[cls] >= self.caps[cls]:
+            return False
+        if cls != INTERACTIVE and sum(self.running.values()) - self.running[INTERACTIVE] >= self.concurrency - self.reserve:
+            return False
+        return True
+
+    # whether a new call can start at once, without overtaking queued calls of the same or a higher class
+    def _can_start(self, cls):
+        if not self._has_room(cls):
+            return False
+        for other in CLASSES[:CLASSES.index(cls) + 1]:
+            if any(not w.cancelled for _, _, w in self._queues[other]):
+                return False
+        return True
+
+    def _start(self, cls):
+        self.running[cls] += 1
+        RUNNING.inc(priority=cls)
+
+    def _running_dec(self, cls):
+        self.running[cls] -= 1
+        RUNNING.dec(priority=cls)
+
+    def _release(self, cls):
+        with self._lock:
+            self._running_dec(cls)
+            self._dispatch()
+
+    # give free slots to queued calls, highest class first (call with the lock held)
+    def _dispatch(self):
+        while sum(self.running.values()) < self.concurrency:
+            for cls in CLASSES:
+                queue = self._queues[cls]
+                while queue and queue[0][2].cancelled:
+                    heapq.heappop(queue)
+                if queue and self._has_room(cls):
+                    tag, _, waiter = heapq.heappop(queue)
+                    self._virtual[cls] = tag
+                    self._start(cls)
+                    waiter.granted = True
+                    QUEUED.dec(priority=cls)
+                    waiter.loop.call_soon_threadsafe(_wake, waiter.future)
+                    break
+            else:
+                break
+        # forget finish tags that are behind their class's virtual time
+        if len(self._finish) > 1000:
+            self._finish = {k: t for k, t in self._finish.items() if t > self._virtual[k[0]]}
+
+    def queued(self) -> dict:
+        with self._lock:
+            return {cls: sum(1 for _, _, w in self._queues[cls] if not w.cancelled) for cls in CLASSES}
+
+
+def _wake(future):
+    if not future.done():
+        future.set_result(None)
+
+
+def _caps_from_env():
+    caps = {}
+    for cls in CLASSES:
+        value = environ.get(f'SCHEDULER_CAP_{cls.upper()}')
+        if value:
+            caps[cls] = int(value)
+    return caps
+
+# the scheduler shared by all apps in the process
+SCHEDULER = Scheduler(
+    int(environ.get('SCHEDULER_CONCURRENCY', 32)),
+    _caps_from_env(),
+    int(environ['SCHEDULER_RESERVE']) if environ.get('SCHEDULER_RESERVE') else None,
+)
@@ -0,0 +1,297 @@
+"""
+Reuse bot replies for near-identical participant messages.
+
+In a large study, many participants open with almost the same message ("hi",
+"hello, how are you?") to the same persona, and each of them waits for an API
+call that gives much the same reply. A ``SemanticCache`` keeps the replies to
+early turns. When a new message is close enough in meaning to one already
+answered in the same context, it serves the cached reply instead.
+
+The context is the system prompt, the condition (e.g. chat_simple's botParty)
+and the short history before the message, and must match exactly. Within it,
+messages are compared by the cosine similarity of their embeddings:
+
+- ``SentenceTransformerEmbedder``: a small local model on the CPU
+  (pip install sentence-transformers), run in a thread; without the package,
+  creating the cache raises an ImportError
+- ``HashingEmbedder``: character trigrams hashed into a vector, with no
+  extra package; it only matches messages that are spelled almost the same
+
+Cached messages are found with ``LSHIndex``, an approximate nearest-neighbour
+index (random hyperplanes), so a lookup doesn't compare against every entry.
+A reply is served if its message is at least ``threshold`` similar, was cached
+less than ``ttl`` seconds ago, and the new message is within the first
+``max_turns`` turns of the chat.
+
+Serving the same reply to several participants takes away variation between
+them, so the cache is off unless an app turns it on (C.SEMANTIC_CACHE).
+Entries are kept in this process's memory.
+
+Metrics: semantic_cache_lookups_total, by outcome ('hit', 'miss', 'skipped',
+'error').
+"""
+
+import asyncio
+import collections
+import functools
+import hashlib
+import importlib.util
+import json
+import math
+import random
+import re
+import threading
+import time
+
+from shared.log import get_logger
+from shared.metrics import REGISTRY
+from shared.tracing import span
+
+logger = get_logger(__name__)
+
+LOOKUPS = REGISTRY.counter('semantic_cache_lookups_total', 'Semantic cache lookups by outcome', ('app', 'outcome'))
+
+DEFAULT_MODEL = 'sentence-transformers/all-MiniLM-L6-v2'
+
+
+def _normalize(vector):
+    norm = math.sqrt(sum(x * x for x in vector)) or 1.0
+    return [x / norm for x in vector]
+
+def _dot(a, b):
+    return sum(x * y for x, y in zip(a, b))
+
+
+########################################################
+# Embedders                                            #
+########################################################
+
+# character trigrams hashed into `dim` buckets, ignoring case and punctuation
+class HashingEmbedder:
+    threaded = False
+
+    def __init__(self, dim=256):
+        self.dim = dim
+
+    def embed(self, text) -> list:
+        text = re.sub(r'[^\w\s]', '', text.lower())
+        text = '  ' + re.sub(r'\s+', ' ', text).strip() + '  '
+        vector = [0.0] * self.dim
+        for i in range(len(text) - 2):
+            digest = hashlib.blake2b(text[i:i + 3].encode(), digest_size=8).digest()
+            vector[int.from_bytes(digest[:4], 'little') % self.dim] += 1.0 if digest[4] & 1 else -1.0
+        return _normalize(vector)
+
+
+# a sentence-transformers model on the CPU, loaded on first use
+## if loading fails, later calls raise the same error instead of trying again
+class SentenceTransformerEmbedder:
+    threaded = True
+
+    def __init__(self, model=DEFAULT_MODEL):
+        self.model_name = model
+        self._model = None
+        self._error = None
+        self._lock = threading.Lock()
+
+    def embed(self, text) -> list:
+        with self._lock:
+            if self._error is not None:
+                raise self._error
+            if self._model is None:
+                try:
+                    from sentence_transformers import SentenceTransformer
+                    self._model = SentenceTransformer(self.model_name, device='cpu')
+                except Exception as e:
+                    self._error = e
+                    raise
+        return _normalize(self._model.encode(text).tolist())
+
+# 'hashing' or the name of a sentence-transformers model
+## a model needs sentence-transformers; hashing is only used when asked for, since
+## its similarities are on a different scale (a threshold set for a model doesn't fit it)
+def make_embedder(name):
+    if name == 'hashing':
+        return HashingEmbedder()
+    if importlib.util.find_spec('sentence_transformers') is None:
+        raise ImportError(f"The semantic cache's embedding model {name} needs sentence-transformers (pip install sentence-transformers), or use 'hashing'")
+    return SentenceTransformerEmbedder(name)
+
+
+########################################################
+# Nearest-neighbour index                              #
+########################################################
+
+@functools.lru_cache(maxsize=None)
+def _planes(dim, tables, bits, seed):
+    rng = random.Random(seed)
+    return [[[rng.gauss(0, 1) for _ in range(dim)] for _ in range(bits)] for _ in range(tables)]
+
+# approximate nearest neighbours of unit vectors by cosine similarity
+## each of `tables` hashes a vector to the side of `bits` random hyperplanes it
+## falls on; only vectors sharing a bucket in some table are compared exactly
+class LSHIndex:
+
+    def __init__(self, dim, tables=6, bits=8, seed=0):
+        self._planes = _planes(dim, tables, bits, seed)
+        self._buckets = [collections.defaultdict(set) for _ in range(tables)]
+        self._vectors = {}
+
+    def _hashes(self, vector):
+        return [
+            sum(1 << b for b, plane in enumerate(planes) if _dot(plane, vector) >= 0)
+            for planes in self._planes
+        ]
+
+    def __len__(self):
+        return len(self._vectors)
+
+    def add(self, id, vector):
+        hashes = self._hashes(vector)
+        self._vectors[id] = (vector, hashes)
+        for table, h in zip(self._buckets, hashes):
+            table[h].add(id)
+
+    def remove(self, id):
+        vector, hashes = self._vectors.pop(id)
+        for table, h in zip(self._buckets, hashes):
+            table[h].discard(id)
+            if not table[h]:
+                del table[h]
+
+    # (id, similarity) of the closest vector found, or None
+    def nearest(self, vector):
+        candidates = set()
+        for table, h in zip(self._buckets, self._hashes(vector)):
+            candidates |= table.get(h, set())
+        best = None
+        for id in candidates:
+            similarity = _dot(vector, self._vectors[id][0])
+            if best is None or similarity > best[1]:
+                best = (id, similarity)
+        return best
+
+
+########################################################
+# Cache                                                #
+########################################################
+
+class SemanticCache:
+
+    def __init__(self, app, embedder='hashing', threshold=0.9, ttl=3600, max_turns=1, history=4, max_entries=5000):
+        self.app = app
+        self.embedder = make_embedder(embedder) if isinstance(embedder, str) else embedder
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_turns = max_turns
+        self.history = history
+        self.max_entries = max_entries
+
+        # context key -> LSHIndex
+        self._indexes = {}
+        # entry id -> (context key, reply, expires at), oldest first
+        self._entries = collections.OrderedDict()
+        self._ids = 0
+        self._lock = threading.Lock()
+        # recent text -> embedding, so a lookup and the add after it embed once
+        self._embeddings = collections.OrderedDict()
+        # whether an embedding error has been logged (it's only logged the first time)
+        self._failed = False
+
+    # (context key, text to match), or None if the message is past max_turns
+    ## `messages` is a chat in the openai format, ending with the participant's message
+    def _split(self, messages, condition):
+        if not messages or messages[-1].get('role') != 'user':
+            return None
+        if sum(1 for m in messages if m.get('role') == 'user') > self.max_turns:
+            return None
+        system = [m['content'] for m in messages if m.get('role') == 'system']
+        history = [(m.get('role'), m.get('content')) for m in messages[:-1] if m.get('role') != 'system']
+        history = history[-self.history:] if self.history else []
+        context = json.dumps([self.app, system, condition, history], ensure_ascii=False, default=str)
+        return hashlib.sha256(context.encode()).hexdigest(), str(messages[-1]['content'])
+
+    async def _embed(self, text):
+        with self._lock:
+            vector = self._embeddings.get(text)
+        if vector is None:
+            if self.embedder.threaded:
+                vector = await asyncio.to_thread(self.embedder.embed, text)
+            else:
+                vector = self.embedder.embed(text)
+            with self._lock:
+                self._embeddings[text] = vector
+                while len(self._embeddings) > 256:
+                    self._embeddings.popitem(last=False)
+        return vector
+
+    def _drop(self, id):
+        context, _, _ = self._entries.pop(id)
+        index = self._indexes[context]
+        index.remove(id)
+        if not len(index):
+            del self._indexes[context]
+
+    # drop entries older than ttl (the oldest come first)
+    def _expire(self):
+        now = time.time()
+        while self._entries:
+            id, (_, _, expires) = next(iter(self._entries.items()))
+            if expires > now:
+                break
+            self._drop(id)
+
+    # the cached reply to a message like the last one in `messages`, or None
+    async def lookup(self, messages, condition=None):
+        split = self._split(messages, condition)
+        if split is None:
+            LOOKUPS.inc(app=self.app, outcome='skipped')
+            return None
+        context, text = split
+        with span('semantic_cache.lookup', app=self.app) as lookupSpan:
+            try:
+                vector = await self._embed(text)
+            except Exception:
+                # e.g. the embedding model couldn't be loaded; the bot answers as usual
+                if not self._failed:
+                    self._failed = True
+                    logger.exception('Semantic cache could not embed the message')
+                LOOKUPS.inc(app=self.app, outcome='error')
+                return None
+            with self._lock:
+                self._expire()
+                index = self._indexes.get(context)
+                found = index.nearest(vector) if index is not None else None
+                reply = None
+                if found is not None and found[1] >= self.threshold:
+                    reply = self._entries[found[0]][1]
+            lookupSpan.set(hit=reply is not None, similarity=round(found[1], 3) if found else None)
+        LOOKUPS.inc(app=self.app, outcome='miss' if reply is None else 'hit')
+        return reply
+
+    # cache `reply` as the answer to the last message in `messages`
+    ## only for replies from the model, not fallbacks (which would be served to later participants)
+    async def add(self, messages, reply, condition=None):
+        split = self._split(messages, condition)
+        if split is None:
+            return
+        context, text = split
+        try:
+            vector = await self._embed(text)
+        except Exception:
+            return
+        with self._lock:
+            self._ids += 1
+            index = self._indexes.get(context)
+            if index is None:
+                index = self._indexes[context] = LSHIndex(len(vector))
+            index.add(self._ids, vector)
+            self._entries[self._ids] = (context, reply, time.time() + self.ttl)
+            while len(self._entries) > self.max_entries:
+                self._drop(next(iter(self._entries)))
+
+    def clear(self):
+        with self._lock:
+            self._indexes.clear()
+            self._entries.clear()
+            self._embeddings.clear()
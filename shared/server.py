@@ -0,0 +1,54 @@
+"""
+Server-wide routes and hooks for all apps.
+
+settings.py calls ``install()`` once. oTree imports settings.py before the
+apps and before it builds its web app, so everything here is in place every
+time the server starts (including after a restart), not only once a session
+has been created:
+
+- /metrics (shared.metrics) and /live_dashboard (shared.dashboard), served
+  only if METRICS_TOKEN is set, and only to requests that send it
+- the /live websocket that cancels bot replies when a participant's page
+  closes (shared.connection)
+- recording or replaying API responses if REPLAY_MODE is set (shared.replay)
+- recording the server's event loop, where greetings are generated ahead of
+  time (shared.warmup)
+"""
+
+from shared.log import get_logger
+
+logger = get_logger(__name__)
+
+_INSTALLED = False
+
+
+def install():
+    global _INSTALLED
+    if _INSTALLED:
+        return
+    _INSTALLED = True
+
+    from shared.connection import install_live_cancellation
+    from shared.dashboard import install_dashboard_route
+    from shared.metrics import install_metrics_route
+    from shared.replay import install_replay
+    from shared.routes import metrics_token
+    from shared.warmup import install_warmup
+
+    # serve api call metrics at /metrics (prometheus format)
+    install_metrics_route()
+
+    # live latency dashboard for experimenters at /live_dashboard
+    install_dashboard_route()
+
+    if not metrics_token():
+        logger.info('METRICS_TOKEN is not set, so /metrics and /live_dashboard are not served')
+
+    # cancel bot replies that are still running when a participant's page closes
+    install_live_cancellation()
+
+    # record or replay api responses if REPLAY_MODE is set (see shared/replay.py)
+    install_replay()
+
+    # generate greetings ahead of time on the server's event loop (see shared/warmup.py)
+    install_warmup()
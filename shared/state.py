@@ -0,0 +1,302 @@
+"""
+State shared by every server process: counters, caches, locks and limits.
+
+Circuit breakers, hedging caps and caches used to live in each process's
+memory. With more than one web process (e.g. several Heroku dynos), each
+process had its own copy: a breaker opened in one process let calls through
+in another, and a cost cap could be spent once per process. The classes here
+keep that state in one place:
+
+- ``LocalState``: in this process's memory (the default, fine for one process)
+- ``RedisState``: in Redis, or anything that speaks its protocol (Valkey, KeyDB),
+  so all processes see the same state
+- ``FakeState``: in memory, with a clock that only moves when told to, for tests
+
+All three have the same methods. They are coroutines (``await state.get(key)``)
+except ``now()``: RedisState uses redis.asyncio, so a round trip to Redis
+never blocks the event loop that runs every live method in the process.
+Values must be JSON-serializable, and times are wall-clock seconds
+(``now()``), so they mean the same in every process. Use ``get_state()`` to
+get the one for this process, and ``set_state()`` to swap in another (e.g. a
+FakeState in a test).
+
+Built on it: ``RateLimiter`` (at most n events per period over all processes)
+and ``lock()`` (only one process runs a block at a time).
+
+Settings (environment variables):
+- STATE_BACKEND: 'local' (default) or 'redis'
+- REDIS_URL: Redis server for 'redis' (default redis://localhost:6379/0)
+- STATE_PREFIX: prefix for every key, to share one Redis between projects (default otree_gpt:)
+
+RedisState needs the redis package (pip install redis).
+"""
+
+import asyncio
+import contextlib
+import json
+import secrets
+import threading
+import time
+from os import environ
+
+from shared.log import get_logger
+
+logger = get_logger(__name__)
+
+
+class LockTimeout(Exception):
+    pass
+
+
+########################################################
+# In-process state                                     #
+########################################################
+
+class LocalState:
+
+    def __init__(self):
+        # key -> (value, expires at or None)
+        self._data = {}
+        self._lock = threading.Lock()
+
+    def now(self) -> float:
+        return time.time()
+
+    def _live(self, key):
+        item = self._data.get(key)
+        if item is not None and item[1] is not None and item[1] <= self.now():
+            del self._data[key]
+            return None
+        return item
+
+    def _expiry(self, ttl):
+        return None if ttl is None else self.now() + ttl
+
+    async def get(self, key, default=None):
+        with self._lock:
+            item = self._live(key)
+        return default if item is None else item[0]
+
+    # values for several keys at once (default for missing ones)
+    async def get_many(self, keys, default=None) -> list:
+        with self._lock:
+            items = [self._live(key) for key in keys]
+        return [default if item is None else item[0] for item in items]
+
+    async def set(self, key, value, ttl=None):
+        with self._lock:
+            self._data[key] = (value, self._expiry(ttl))
+
+    # set `key` only if it has no value; returns whether it was set
+    async def add(self, key, value, ttl=None) -> bool:
+        with self._lock:
+            if self._live(key) is not None:
+                return False
+            self._data[key] = (value, self._expiry(ttl))
+            return True
+
+    async def delete(self, *keys):
+        with self._lock:
+            for key in keys:
+                self._data.pop(key, None)
+
+    # delete `key` only if its value is still `value`; returns whether it was deleted
+    async def delete_if(self, key, value) -> bool:
+        with self._lock:
+            item = self._live(key)
+            if item is None or item[0] != value:
+                return False
+            del self._data[key]
+            return True
+
+    # add `amount` to a number and return the new value
+    ## `ttl` is set when the key is created and kept after that
+    async def incr(self, key, amount=1, ttl=None):
+        with self._lock:
+            item = self._live(key)
+            if item is None:
+                item = (0, self._expiry(ttl))
+            value = item[0] + amount
+            self._data[key] = (value, item[1])
+            return value
+
+    async def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+# LocalState with a clock that only moves when told to
+## e.g. state = FakeState(); set_state(state); ...; state.advance(30)
+class FakeState(LocalState):
+
+    def __init__(self, start=1_000_000.0):
+        super().__init__()
+        self.clock = start
+
+    def now(self) -> float:
+        return self.clock
+
+    def advance(self, seconds):
+        self.clock += seconds
+
+
+########################################################
+# Redis                                                #
+########################################################
+
+# compare-and-delete, so a lock is only released by the process holding it
+_DELETE_IF = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+# incrbyfloat that sets an expiry only on a new key
+_INCR = """
+local value = redis.call('incrbyfloat', KEYS[1], ARGV[1])
+if tonumber(ARGV[2]) > 0 and redis.call('pttl', KEYS[1]) == -1 then
+    redis.call('pexpire', KEYS[1], ARGV[2])
+end
+return value
+"""
+
+
+# `client` is a redis.asyncio.Redis (or a compatible fake)
+class RedisState:
+
+    def __init__(self, url=None, prefix=None, client=None):
+        if client is None:
+            import redis.asyncio
+            client = redis.asyncio.Redis.from_url(url or environ.get('REDIS_URL', 'redis://localhost:6379/0'))
+        self.client = client
+        self.prefix = environ.get('STATE_PREFIX', 'otree_gpt:') if prefix is None else prefix
+        self._deleteIf = client.register_script(_DELETE_IF)
+        self._incr = client.register_script(_INCR)
+
+    def now(self) -> float:
+        return time.time()
+
+    def _key(self, key):
+        return self.prefix + key
+
+    @staticmethod
+    def _ms(ttl):
+        return None if ttl is None else max(1, int(ttl * 1000))
+
+    @staticmethod
+    def _load(raw, default):
+        return default if raw is None else json.loads(raw)
+
+    async def get(self, key, default=None):
+        return self._load(await self.client.get(self._key(key)), default)
+
+    async def get_many(self, keys, default=None) -> list:
+        keys = list(keys)
+        if not keys:
+            return []
+        return [self._load(raw, default) for raw in await self.client.mget([self._key(k) for k in keys])]
+
+    async def set(self, key, value, ttl=None):
+        await self.client.set(self._key(key), json.dumps(value), px=self._ms(ttl))
+
+    async def add(self, key, value, ttl=None) -> bool:
+        return bool(await self.client.set(self._key(key), json.dumps(value), px=self._ms(ttl), nx=True))
+
+    async def delete(self, *keys):
+        if keys:
+            await self.client.delete(*[self._key(k) for k in keys])
+
+    async def delete_if(self, key, value) -> bool:
+        return bool(await self._deleteIf(keys=[self._key(key)], args=[json.dumps(value)]))
+
+    async def incr(self, key, amount=1, ttl=None):
+        value = float(await self._incr(keys=[self._key(key)], args=[amount, self._ms(ttl) or 0]))
+        return int(value) if value.is_integer() and isinstance(amount, int) else value
+
+    async def clear(self):
+        async for key in self.client.scan_iter(match=self.prefix + '*'):
+            await self.client.delete(key)
+
+
+########################################################
+# The state for this process                           #
+########################################################
+
+_STATE = None
+_STATE_LOCK = threading.Lock()
+
+def get_state():
+    global _STATE
+    with _STATE_LOCK:
+        if _STATE is None:
+            backend = environ.get('STATE_BACKEND', 'local')
+            if backend == 'redis':
+                _STATE = RedisState()
+            elif backend == 'local':
+                _STATE = LocalState()
+            else:
+                raise ValueError(f"STATE_BACKEND must be 'local' or 'redis', not {backend!r}")
+            logger.info(f'Shared state: {type(_STATE).__name__}')
+        return _STATE
+
+# use `state` from now on (e.g. a FakeState in tests), and return the one it replaces
+def set_state(state):
+    global _STATE
+    with _STATE_LOCK:
+        old, _STATE = _STATE, state
+    return old
+
+
+########################################################
+# Locks and rate limits                                #
+########################################################
+
+# hold `name` while the block runs, so only one process runs it at a time
+## waits up to `wait` seconds for the lock (0 to fail at once), raising LockTimeout;
+## `ttl` frees the lock if its holder dies without releasing it
+@contextlib.asynccontextmanager
+async def lock(name, ttl=30, wait=10, poll=0.05, state=None):
+    state = state or get_state()
+    key = f'lock:{name}'
+    token = secrets.token_hex(8)
+    deadline = time.monotonic() + wait
+    while not await state.add(key, token, ttl=ttl):
+        if time.monotonic() >= deadline:
+            raise LockTimeout(f'lock {name} is held elsewhere')
+        await asyncio.sleep(poll)
+    try:
+        yield
+    finally:
+        await state.delete_if(key, token)
+
+
+# at most `limit` events per `period` seconds, counted over all processes
+## counts in fixed windows, so up to 2x `limit` can pass around a window boundary
+class RateLimiter:
+
+    def __init__(self, name, limit, period=60.0, state=None):
+        self.name = name
+        self.limit = limit
+        self.period = period
+        self._state = state
+
+    @property
+    def state(self):
+        return self._state or get_state()
+
+    # take `cost` from this window if there is room; returns whether it was taken
+    async def try_acquire(self, cost=1) -> bool:
+        state = self.state
+        window = int(state.now() // self.period)
+        key = f'rate:{self.name}:{window}'
+        if await state.incr(key, cost, ttl=self.period * 2) <= self.limit:
+            return True
+        await state.incr(key, -cost)
+        return False
+
+    # wait until `cost` can be taken
+    async def acquire(self, cost=1):
+        while not await self.try_acquire(cost):
+            state = self.state
+            await asyncio.sleep(max(0.01, self.period - state.now() % self.period))
@@ -0,0 +1,119 @@
+"""
+Speech-to-text backends.
+
+Every backend has the same async ``transcribe(audio, filename)`` method, so an
+app can switch between the OpenAI Whisper API and a local CPU model with a
+single setting. The local backend runs faster-whisper in a process pool so
+inference never blocks the event loop.
+"""
+
+import asyncio
+import io
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from os import environ
+
+import httpx
+
+# default api root, can be pointed at a proxy or local stub server
+OPENAI_BASE_URL = environ.get('OPENAI_BASE_URL', 'https://api.openai.com/v1')
+
+
+########################################################
+# Backend interface                                    #
+########################################################
+
+class TranscriptionBackend:
+    name = None
+    model = None
+
+    # return the text spoken in the recording
+    async def transcribe(self, audio: bytes, filename: str, content_type: str = 'audio/webm') -> str:
+        raise NotImplementedError
+
+    # release any resources (process pools, etc.)
+    def close(self):
+        pass
+
+
+########################################################
+# OpenAI Whisper API                                   #
+########################################################
+
+class OpenAIWhisperBackend(TranscriptionBackend):
+    name = 'openai'
+
+    def __init__(self, client: httpx.AsyncClient, api_key: str, model='whisper-1', base_url=None, timeout=60):
+        self.client = client
+        self.api_key = api_key
+        self.model = model
+        self.base_url = (base_url or OPENAI_BASE_URL).rstrip('/')
+        self.timeout = timeout
+
+    async def transcribe(self, audio, filename, content_type='audio/webm'):
+        resp = await self.client.post(
+            f'{self.base_url}/audio/transcriptions',
+            headers={'Authorization': f'Bearer {self.api_key}'},
+            data={'model': self.model},
+            files={'file': (filename, audio, content_type)},
+            timeout=self.timeout,
+        )
+        resp.raise_for_status()
+        return resp.json()['text']
+
+
+########################################################
+# Local CPU model (faster-whisper)                     #
+########################################################
+
+# model loaded once in each worker process
+_LOCAL_MODEL = None
+
+def _load_local_model(modelSize, computeType, cpuThreads):
+    global _LOCAL_MODEL
+    from faster_whisper import WhisperModel
+    _LOCAL_MODEL = WhisperModel(
+        modelSize,
+        device='cpu',
+        compute_type=computeType,
+        cpu_threads=cpuThreads,
+    )
+
+def _transcribe_local(audio, language):
+    segments, info = _LOCAL_MODEL.transcribe(io.BytesIO(audio), language=language, beam_size=1)
+    return ''.join(segment.text for segment in segments).strip()
+
+
+class LocalWhisperBackend(TranscriptionBackend):
+    name = 'local'
+
+    def __init__(self, model_size='base', workers=2, compute_type='int8', cpu_threads=2, language=None):
+        self.model_size = model_size
+        self.model = f'faster-whisper-{model_size}'
+        self.workers = workers
+        self.compute_type = compute_type
+        self.cpu_threads = cpu_threads
+        self.language = language
+        self._pool = None
+
+    # start worker processes on first use
+    ## 'spawn' avoids forking a process that is running an event loop and threads
+    def _get_pool(self):
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=multiprocessing.get_context('spawn'),
+                initializer=_load_local_model,
+                initargs=(self.model_size, self.compute_type, self.cpu_threads),
+            )
+        return self._pool
+
+    async def transcribe(self, audio, filename, content_type='audio/webm'):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._get_pool(), _transcribe_local, audio, self.language)
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+
@@ -0,0 +1,318 @@
+"""
+OpenTelemetry-style tracing for live methods.
+
+Each live method message becomes a trace. The root span covers the whole
+message, and child spans cover each stage: decoding the history cache,
+database writes, API calls (added by shared.llm.call_llm) and encoding the
+cache again. Finished spans are exported in the background, either as JSON
+lines to a file (view them with ``python -m tools.trace_viewer``) or as
+OTLP/HTTP JSON to a collector such as Jaeger or the OpenTelemetry Collector.
+
+Settings (environment variables):
+- TRACE_EXPORT: 'none' (default), 'json' or 'otlp'
+- TRACE_FILE: file for the json exporter (default _traces/spans.jsonl)
+- OTEL_EXPORTER_OTLP_ENDPOINT: collector url for otlp (default http://localhost:4318)
+- OTEL_SERVICE_NAME: service name reported to the collector (default otree_gpt)
+
+When tracing is off, ``span()`` does nothing and costs almost nothing.
+"""
+
+import asyncio
+import atexit
+import contextvars
+import functools
+import json
+import os
+import queue
+import secrets
+import threading
+import time
+import urllib.request
+from os import environ
+
+from shared.log import get_logger
+
+logger = get_logger(__name__)
+
+_CURRENT_SPAN = contextvars.ContextVar('span', default=None)
+
+
+########################################################
+# Spans                                                #
+########################################################
+
+class Span:
+
+    def __init__(self, name, traceId, parentId=None, attributes=None):
+        self.name = name
+        self.traceId = traceId
+        self.spanId = secrets.token_hex(8)
+        self.parentId = parentId
+        self.attributes = dict(attributes or {})
+        self.events = []
+        self.status = 'ok'
+        self.start = time.time_ns()
+        self.end = None
+        self._token = None
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    # a point in time inside the span, e.g. when a reply was sent
+    def add_event(self, name, **attributes):
+        self.events.append(dict(name=name, time=time.time_ns(), attributes=attributes))
+
+    def __enter__(self):
+        self._token = _CURRENT_SPAN.set(self)
+        return self
+
+    def __exit__(self, excType, exc, tb):
+        self.end = time.time_ns()
+        if isinstance(exc, asyncio.CancelledError):
+            self.status = 'cancelled'
+        elif exc is not None and not isinstance(exc, GeneratorExit):
+            self.status = 'error'
+            self.attributes['error'] = f'{excType.__name__}: {exc}'
+        try:
+            _CURRENT_SPAN.reset(self._token)
+        except ValueError:
+            # exited in a different context (e.g. a generator closed by another task)
+            _CURRENT_SPAN.set(None)
+        _EXPORTER.export(self)
+        return False
+
+    def to_dict(self):
+        return dict(
+            name=self.name,
+            traceId=self.traceId,
+            spanId=self.spanId,
+            parentId=self.parentId,
+            start=self.start,
+            end=self.end,
+            status=self.status,
+            attributes=self.attributes,
+            events=self.events,
+        )
+
+
+class _NoSpan:
+
+    def set(self, **attributes):
+        pass
+
+    def add_event(self, name, **attributes):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+NO_SPAN = _NoSpan()
+
+
+def enabled():
+    return _EXPORTER.active
+
+def current_span():
+    return _CURRENT_SPAN.get()
+
+# child span of the current span (does nothing outside a trace or when tracing is off)
+def span(name, **attributes):
+    parent = _CURRENT_SPAN.get()
+    if parent is None or not _EXPORTER.active:
+        return NO_SPAN
+    return Span(name, parent.traceId, parent.spanId, attributes)
+
+# root span for a new trace
+def start_trace(name, **attributes):
+    if not _EXPORTER.active:
+        return NO_SPAN
+    return Span(name, secrets.token_hex(16), None, attributes)
+
+
+########################################################
+# Live method decorator                                #
+########################################################
+
+# trace every message handled by a live method
+## put it under @staticmethod:
+##     @staticmethod
+##     @trace_live_method(__name__)
+##     async def live_method(player, data): ...
+def trace_live_method(app):
+    def decorate(func):
+        @functools.wraps(func)
+        async def live_method(player, data):
+            if not _EXPORTER.active:
+                async for reply in func(player, data):
+                    yield reply
+                return
+            event = (data.get('event') or data.get('type')) if isinstance(data, dict) and data else 'refresh'
+            with start_trace(
+                f'{app}.{event}',
+                app=app,
+                event=str(event),
+                session=player.session.code,
+                participant=player.participant.code,
+            ) as root:
+                async for reply in func(player, data):
+                    root.add_event('reply')
+                    yield reply
+        return live_method
+    return decorate
+
+
+########################################################
+# Exporters                                            #
+########################################################
+
+class Exporter:
+    active = False
+
+    def export(self, span):
+        pass
+
+
+# hands spans to a background thread in batches
+class BackgroundExporter(Exporter):
+    active = True
+
+    def __init__(self, max_queue=10000, batch_size=256, interval=1.0):
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.batch_size = batch_size
+        self.interval = interval
+        self.dropped = 0
+        self._thread = threading.Thread(target=self._run, name=type(self).__name__, daemon=True)
+        self._thread.start()
+        atexit.register(self.flush)
+
+    def export(self, span):
+        try:
+            self.queue.put_nowait(span)
+        except queue.Full:
+            self.dropped += 1
+
+    def _take_batch(self, timeout):
+        batch = []
+        try:
+            batch.append(self.queue.get(timeout=timeout))
+            while len(batch) < self.batch_size:
+                batch.append(self.queue.get_nowait())
+        except queue.Empty:
+            pass
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._take_batch(self.interval)
+            if batch:
+                self._send_safely(batch)
+
+    def _send_safely(self, batch):
+        try:
+            self.send(batch)
+        except Exception as e:
+            logger.warning(f'Could not export {len(batch)} spans: {e}')
+
+    # write out whatever is still queued (at exit)
+    def flush(self):
+        while True:
+            batch = self._take_batch(0)
+            if not batch:
+                return
+            self._send_safely(batch)
+
+    def send(self, spans):
+        raise NotImplementedError
+
+
+class JsonFileExporter(BackgroundExporter):
+
+    def __init__(self, path, **kwargs):
+        self.path = path
+        self._lock = threading.Lock()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        super().__init__(**kwargs)
+
+    def send(self, spans):
+        lines = ''.join(json.dumps(s.to_dict(), default=str, ensure_ascii=False) + '\n' for s in spans)
+        with self._lock, open(self.path, 'a') as f:
+            f.write(lines)
+
+
+class OTLPExporter(BackgroundExporter):
+
+    def __init__(self, endpoint, service='otree_gpt', timeout=5, **kwargs):
+        self.url = endpoint.rstrip('/') + '/v1/traces'
+        self.service = service
+        self.timeout = timeout
+        super().__init__(**kwargs)
+
+    def send(self, spans):
+        body = json.dumps(otlp_payload(spans, self.service)).encode()
+        request = urllib.request.Request(self.url, data=body, headers={'Content-Type': 'application/json'})
+        with urllib.request.urlopen(request, timeout=self.timeout) as resp:
+            resp.read()
+
+
+def _otlp_value(value):
+    if isinstance(value, bool):
+        return {'boolValue': value}
+    if isinstance(value, int):
+        return {'intValue': str(value)}
+    if isinstance(value, float):
+        return {'doubleValue': value}
+    return {'stringValue': str(value)}
+
+def _otlp_attributes(attributes):
+    return [{'key': k, 'value': _otlp_value(v)} for k, v in attributes.items() if v is not None]
+
+# OTLP/JSON trace export request
+def otlp_payload(spans, service='otree_gpt'):
+    return {'resourceSpans': [{
+        'resource': {'attributes': _otlp_attributes({'service.name': service})},
+        'scopeSpans': [{
+            'scope': {'name': 'shared.tracing'},
+            'spans': [
+                {
+                    'traceId': s.traceId,
+                    'spanId': s.spanId,
+                    'parentSpanId': s.parentId or '',
+                    'name': s.name,
+                    'kind': 1,
+                    'startTimeUnixNano': str(s.start),
+                    'endTimeUnixNano': str(s.end),
+                    'attributes': _otlp_attributes(s.attributes),
+                    'events': [
+                        {'timeUnixNano': str(e['time']), 'name': e['name'], 'attributes': _otlp_attributes(e['attributes'])}
+                        for e in s.events
+                    ],
+                    'status': {'code': 2 if s.status == 'error' else 1},
+                }
+                for s in spans
+            ],
+        }],
+    }]}
+
+
+def _make_exporter():
+    mode = environ.get('TRACE_EXPORT', 'none').lower()
+    if mode == 'json':
+        return JsonFileExporter(environ.get('TRACE_FILE', '_traces/spans.jsonl'))
+    if mode == 'otlp':
+        return OTLPExporter(
+            environ.get('OTEL_EXPORTER_OTLP_ENDPOINT', 'http://localhost:4318'),
+            service=environ.get('OTEL_SERVICE_NAME', 'otree_gpt'),
+        )
+    return Exporter()
+
+_EXPORTER = _make_exporter()
+
+# replace the exporter (e.g. in scripts or benchmarks)
+def set_exporter(exporter: Exporter):
+    global _EXPORTER
+    _EXPORTER = exporter
@@ -0,0 +1,204 @@
+"""
+Generate bot replies ahead of time, so they are ready when the page asks.
+
+Some bot messages don't depend on anything the participant does. For
+example, the greetings in chat_multiple_agents and chat_2humans1bot only
+depend on the system prompt and the tone set in creating_session. A
+``Warmup`` starts generating them in the background as soon as the session is
+created (or the group is complete). When the page sends its ``botMsg`` with
+``isGreeting``, the live method takes the finished reply instead of waiting
+for the API.
+
+creating_session and wait pages run in a worker thread, outside the server's
+event loop, but replies are generated on that loop: the API clients, and the
+shared state behind breakers and hedging (a Redis connection with
+STATE_BACKEND=redis), belong to the loop that uses them. The server's loop is
+recorded when the server starts (``install_warmup()``, called from
+settings.py, see shared.server), or else by the first live method that takes
+a reply. Replies scheduled before then wait and start once it is known.
+
+Each Warmup runs at most ``concurrency`` requests at a time, so a large
+session doesn't send every greeting at once. Their API calls are scheduled as
+GREETING (shared.scheduler), behind replies participants are waiting for.
+
+``take()`` returns None if there is nothing for that key, or if generating it
+failed. The live method then generates the reply as usual. If the reply is
+still being generated, ``take()`` waits for it rather than sending a second
+request. Replies nobody takes (e.g. for participants who never load the page)
+are dropped ``ttl`` seconds after they were scheduled.
+
+Metrics: warmup_replies_total, by outcome ('ready', 'waited', 'failed',
+'missing').
+"""
+
+import asyncio
+import concurrent.futures
+import threading
+import time
+
+from shared.log import get_logger
+from shared.metrics import REGISTRY
+from shared.scheduler import GREETING, priority
+from shared.tracing import start_trace
+
+logger = get_logger(__name__)
+
+REPLIES = REGISTRY.counter('warmup_replies_total', 'Pre-generated replies asked for by live methods', ('app', 'outcome'))
+PENDING = REGISTRY.gauge('warmup_pending', 'Replies being generated ahead of time', ('app',))
+
+_LOOP = None
+_LOOP_LOCK = threading.Lock()
+# (warmup, key, make_reply, future) scheduled before the server's loop was known
+_WAITING = []
+
+
+########################################################
+# Server loop                                          #
+########################################################
+
+def _server_loop():
+    with _LOOP_LOCK:
+        return _LOOP if _LOOP is not None and not _LOOP.is_closed() else None
+
+# generate replies on `loop` from now on, starting any that were waiting for it
+def _use_loop(loop):
+    global _LOOP
+    with _LOOP_LOCK:
+        if _LOOP is loop:
+            return
+        _LOOP = loop
+        waiting = list(_WAITING)
+        _WAITING.clear()
+    for warmup, key, make_reply, future in waiting:
+        warmup._start(key, make_reply, future, loop)
+
+async def _record_server_loop():
+    _use_loop(asyncio.get_running_loop())
+
+# record the server's event loop when it starts
+def install_warmup():
+    from shared.routes import add_startup
+
+    add_startup(_record_server_loop)
+
+
+########################################################
+# Warmup                                               #
+########################################################
+
+class Warmup:
+
+    def __init__(self, app, concurrency=4, priority=GREETING, ttl=3600):
+        self.app = app
+        self.concurrency = concurrency
+        self.priority = priority
+        self.ttl = ttl
+        # key -> (concurrent future, time scheduled)
+        self._futures = {}
+        self._semaphore = None
+        self._lock = threading.Lock()
+
+    # start generating a reply in the background
+    ## make_reply is called with no arguments and returns the coroutine to run, e.g. lambda: runGPT(inputDat)
+    def schedule(self, key, make_reply):
+        self._expire()
+        future = concurrent.futures.Future()
+        with self._lock:
+            if key in self._futures:
+                return
+            PENDING.inc(app=self.app)
+            self._futures[key] = (future, time.monotonic())
+        with _LOOP_LOCK:
+            loop = _LOOP if _LOOP is not None and not _LOOP.is_closed() else None
+            if loop is None:
+                _WAITING.append((self, key, make_reply, future))
+        if loop is not None:
+            self._start(key, make_reply, future, loop)
+
+    # run the reply on `loop` and pass its outcome to `future`
+    def _start(self, key, make_reply, future, loop):
+        def start():
+            if future.cancelled():
+                PENDING.dec(app=self.app)
+                return
+            task = loop.create_task(self._run(key, make_reply))
+
+            def copy(task):
+                if future.cancelled():
+                    return
+                if task.cancelled():
+                    future.cancel()
+                elif task.exception() is not None:
+                    future.set_exception(task.exception())
+                else:
+                    future.set_result(task.result())
+
+            task.add_done_callback(copy)
+            future.add_done_callback(lambda f: f.cancelled() and loop.call_soon_threadsafe(task.cancel))
+
+        loop.call_soon_threadsafe(start)
+
+    async def _run(self, key, make_reply):
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+        try:
+            async with self._semaphore:
+                with start_trace(f'{self.app}.warmup', app=self.app, key=str(key)), priority(self.priority):
+                    return await make_reply()
+        except Exception:
+            logger.exception('Generating a reply ahead of time failed', extra=dict(app=self.app, key=str(key)))
+            raise
+        finally:
+            PENDING.dec(app=self.app)
+
+    # drop replies scheduled more than ttl seconds ago
+    def _expire(self):
+        cutoff = time.monotonic() - self.ttl
+        with self._lock:
+            expired = [key for key, (_, scheduled) in self._futures.items() if scheduled < cutoff]
+            futures = [self._futures.pop(key)[0] for key in expired]
+        for future in futures:
+            future.cancel()
+        self._drop_waiting()
+
+    # forget cancelled replies that were still waiting for the server's loop
+    def _drop_waiting(self):
+        with _LOOP_LOCK:
+            dropped = [item for item in _WAITING if item[0] is self and item[3].cancelled()]
+            _WAITING[:] = [item for item in _WAITING if item not in dropped]
+        for _ in dropped:
+            PENDING.dec(app=self.app)
+
+    # the reply generated for `key`, or None if there isn't one
+    ## each reply is handed out once
+    async def take(self, key):
+        # live methods run on the server's loop
+        if _server_loop() is None:
+            _use_loop(asyncio.get_running_loop())
+        self._expire()
+        with self._lock:
+            entry = self._futures.pop(key, None)
+        if entry is None:
+            REPLIES.inc(app=self.app, outcome='missing')
+            return None
+        future = entry[0]
+        outcome = 'ready' if future.done() else 'waited'
+        try:
+            # shielded so that a cancelled live method doesn't cancel the generation
+            reply = await asyncio.shield(asyncio.wrap_future(future))
+        except asyncio.CancelledError:
+            if not future.cancelled():
+                raise
+            reply, outcome = None, 'failed'
+        except Exception:
+            reply, outcome = None, 'failed'
+        REPLIES.inc(app=self.app, outcome=outcome)
+        return reply
+
+    # stop and forget replies nobody took
+    def clear(self):
+        with self._lock:
+            futures, self._futures = self._futures, {}
+        for future, _ in futures.values():
+            future.cancel()
+        self._drop_waiting()
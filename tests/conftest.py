@@ -0,0 +1,7 @@
+import os
+import sys
+
+# the apps and shared/ are imported from the project root, as oTree does
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
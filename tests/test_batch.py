@@ -0,0 +1,118 @@
+import asyncio
+import glob
+import json
+import os
+
+import httpx
+
+from tools.batch import BatchTransport, LocalBatchBackend
+from tools.stub_server import StubServer, digest, stub_text
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+def stub_transport():
+    return httpx.ASGITransport(app=StubServer().app())
+
+def read_lines(path):
+    with open(path, encoding='utf-8') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+def chat_body(text, model='gpt-4o-mini'):
+    return dict(model=model, messages=[{'role': 'user', 'content': text}])
+
+# what the stub replies to `body` (sent straight to it, not in a batch)
+def stub_reply(body):
+    return stub_text(digest([body['model'], body['messages']]))
+
+# send every (path, body) through `transport` at once and return the responses in order
+async def send_all(transport, requests):
+    async with httpx.AsyncClient(transport=transport, base_url='http://stub') as client:
+        responses = await asyncio.gather(*(client.post(path, json=body) for path, body in requests))
+    await transport.aclose()
+    return responses
+
+
+# LocalBatchBackend whose batches expire with only the first `keep` lines answered
+class ExpiringBackend(LocalBatchBackend):
+
+    def __init__(self, directory, transport, keep):
+        super().__init__(directory, transport)
+        self.keep = keep
+        self._firstIds = {}
+
+    async def submit(self, endpoint, lines):
+        batchId = await super().submit(endpoint, lines)
+        self._firstIds[batchId] = {line['custom_id'] for line in lines[:self.keep]}
+        return batchId
+
+    async def status(self, batchId):
+        status = await super().status(batchId)
+        return 'expired' if status == 'completed' else status
+
+    async def results(self, batchId):
+        results = await super().results(batchId)
+        return {k: v for k, v in results.items() if k in self._firstIds[batchId]}
+
+
+########################################################
+# Tests                                                #
+########################################################
+
+def test_each_caller_gets_the_reply_to_its_own_request(tmp_path):
+    backend = LocalBatchBackend(str(tmp_path), stub_transport())
+    transport = BatchTransport(backend, window=0.05, poll=0.01)
+    bodies = [chat_body(f'message number {i}') for i in range(8)]
+
+    responses = run(send_all(transport, [('/v1/chat/completions', body) for body in bodies]))
+
+    assert [r.status_code for r in responses] == [200] * len(bodies)
+    assert [r.json()['choices'][0]['message']['content'] for r in responses] == [stub_reply(b) for b in bodies]
+    assert transport.requests == len(bodies)
+    assert transport.batches == 1
+
+    # the job's input and output use the Batch API's formats, matched by custom_id
+    [inputPath] = glob.glob(os.path.join(tmp_path, '*.input.jsonl'))
+    inputs = read_lines(inputPath)
+    outputs = read_lines(inputPath.replace('.input.jsonl', '.output.jsonl'))
+    bodyById = {line['custom_id']: line['body'] for line in inputs}
+    assert len(bodyById) == len(bodies)
+    assert sorted(bodyById.values(), key=json.dumps) == sorted(bodies, key=json.dumps)
+    replyById = {line['custom_id']: line['response']['body']['choices'][0]['message']['content'] for line in outputs}
+    assert replyById == {customId: stub_reply(body) for customId, body in bodyById.items()}
+
+def test_requests_are_split_by_endpoint(tmp_path):
+    backend = LocalBatchBackend(str(tmp_path), stub_transport())
+    transport = BatchTransport(backend, window=0.05, poll=0.01)
+    requests = [
+        ('/v1/chat/completions', chat_body('first chat')),
+        ('/v1/responses', dict(model='gpt-4o-mini', input=[{'role': 'user', 'content': 'first response'}])),
+        ('/v1/chat/completions', chat_body('second chat')),
+        ('/v1/responses', dict(model='gpt-4o-mini', input=[{'role': 'user', 'content': 'second response'}])),
+    ]
+
+    responses = run(send_all(transport, requests))
+
+    assert [r.status_code for r in responses] == [200] * 4
+    assert [r.json()['object'] for r in responses] == ['chat.completion', 'response', 'chat.completion', 'response']
+    assert transport.batches == 2
+    urls = sorted(
+        sorted({line['url'] for line in read_lines(path)})
+        for path in glob.glob(os.path.join(tmp_path, '*.input.jsonl'))
+    )
+    assert urls == [['/v1/chat/completions'], ['/v1/responses']]
+
+def test_requests_missing_from_an_expired_batch_are_errors(tmp_path):
+    backend = ExpiringBackend(str(tmp_path), stub_transport(), keep=2)
+    transport = BatchTransport(backend, window=0.05, poll=0.01)
+    bodies = [chat_body(f'message number {i}') for i in range(5)]
+
+    responses = run(send_all(transport, [('/v1/chat/completions', body) for body in bodies]))
+
+    assert sorted(r.status_code for r in responses) == [200, 200, 500, 500, 500]
+    for response, body in zip(responses, bodies):
+        if response.status_code == 200:
+            assert response.json()['choices'][0]['message']['content'] == stub_reply(body)
+        else:
+            assert 'expired' in response.json()['error']['message']
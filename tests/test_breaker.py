@@ -0,0 +1,172 @@
+import asyncio
+
+import pytest
+
+from shared.breaker import CLOSED, HALF_OPEN, OPEN, CircuitBreaker, CircuitOpenError
+from shared.llm import BotThinking, DeadlineExceeded, call_model_chain, canned_response, fallback_chain
+from shared.state import FakeState
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+def make_breaker(**kwargs):
+    state = FakeState(start=0.0)
+    options = dict(failure_rate=0.5, min_calls=4, window=30, open_seconds=10, max_open_seconds=40, probes=1)
+    options.update(kwargs)
+    return CircuitBreaker('test', state=state, **options), state
+
+async def fail(breaker, times):
+    for _ in range(times):
+        await breaker.on_failure(await breaker.before_call())
+
+async def succeed(breaker, times):
+    for _ in range(times):
+        await breaker.on_success(await breaker.before_call())
+
+
+########################################################
+# States                                               #
+########################################################
+
+def test_stays_closed_below_min_calls():
+    breaker, _ = make_breaker()
+
+    async def main():
+        await fail(breaker, 3)
+        assert await breaker.current_state() == CLOSED
+    run(main())
+
+def test_stays_closed_below_failure_rate():
+    breaker, _ = make_breaker()
+
+    async def main():
+        await succeed(breaker, 5)
+        await fail(breaker, 4)
+        assert await breaker.current_state() == CLOSED
+    run(main())
+
+def test_opens_and_fails_fast():
+    breaker, _ = make_breaker()
+
+    async def main():
+        await succeed(breaker, 2)
+        await fail(breaker, 2)
+        assert await breaker.current_state() == OPEN
+        with pytest.raises(CircuitOpenError):
+            await breaker.before_call()
+    run(main())
+
+def test_old_failures_leave_the_window():
+    breaker, state = make_breaker()
+
+    async def main():
+        await fail(breaker, 3)
+        state.advance(31)
+        await fail(breaker, 1)
+        assert await breaker.current_state() == CLOSED
+    run(main())
+
+def test_half_open_lets_probes_through_and_closes_on_success():
+    breaker, state = make_breaker()
+
+    async def main():
+        await fail(breaker, 4)
+        state.advance(10)
+        assert await breaker.current_state() == HALF_OPEN
+        probe = await breaker.before_call()
+        assert probe
+        # only `probes` calls at once
+        with pytest.raises(CircuitOpenError):
+            await breaker.before_call()
+        await breaker.on_success(probe)
+        assert await breaker.current_state() == CLOSED
+        # the failures before it opened were cleared
+        await fail(breaker, 1)
+        assert await breaker.current_state() == CLOSED
+    run(main())
+
+def test_failed_probe_reopens_for_longer():
+    breaker, state = make_breaker()
+
+    async def main():
+        await fail(breaker, 4)
+        state.advance(10)
+        await fail(breaker, 1)
+        assert await breaker.current_state() == OPEN
+        state.advance(19)
+        assert await breaker.current_state() == OPEN
+        state.advance(1)
+        assert await breaker.current_state() == HALF_OPEN
+    run(main())
+
+def test_cancelled_probe_frees_its_slot():
+    breaker, state = make_breaker()
+
+    async def main():
+        await fail(breaker, 4)
+        state.advance(10)
+        await breaker.on_cancel(await breaker.before_call())
+        assert await breaker.current_state() == HALF_OPEN
+        assert await breaker.before_call()
+    run(main())
+
+def test_reset_closes():
+    breaker, _ = make_breaker()
+
+    async def main():
+        await fail(breaker, 4)
+        await breaker.reset()
+        assert await breaker.current_state() == CLOSED
+        await breaker.before_call()
+    run(main())
+
+
+########################################################
+# Model chains                                         #
+########################################################
+
+async def hang():
+    await asyncio.sleep(3600)
+
+def test_model_timeouts_count_as_failures():
+    breaker, _ = make_breaker(min_calls=1)
+
+    async def main():
+        with pytest.raises(DeadlineExceeded):
+            await call_model_chain(lambda model: hang(), [('test-model', 0.05)], deadline=0.05, app='tests', breaker=breaker)
+        assert await breaker.current_state() == OPEN
+    run(main())
+
+def test_cancelled_calls_are_not_failures():
+    breaker, _ = make_breaker(min_calls=1)
+
+    async def main():
+        task = asyncio.ensure_future(
+            call_model_chain(lambda model: hang(), [('test-model', 60)], deadline=60, app='tests', breaker=breaker)
+        )
+        await asyncio.sleep(0.05)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        assert await breaker.current_state() == CLOSED
+        assert await breaker._counts(breaker.store) == (0, 0)
+    run(main())
+
+
+########################################################
+# Fallbacks                                            #
+########################################################
+
+def test_fallback_chain_tries_modes_in_order():
+    canned = canned_response(text='one moment')
+    error = DeadlineExceeded('too slow')
+
+    async def main():
+        assert await fallback_chain(['canned'], canned=canned)(error) is canned
+        with pytest.raises(BotThinking) as thinking:
+            await fallback_chain(['thinking', 'canned'], canned=canned, retry_after=5)(error)
+        assert thinking.value.retry_after == 5 and thinking.value.error is error
+        with pytest.raises(DeadlineExceeded):
+            await fallback_chain([])(error)
+    run(main())
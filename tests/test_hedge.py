@@ -0,0 +1,151 @@
+import asyncio
+
+import pytest
+
+from shared.hedge import HedgePolicy
+from shared.state import FakeState, set_state
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+@pytest.fixture
+def state():
+    state = FakeState(start=0.0)
+    old = set_state(state)
+    yield state
+    set_state(old)
+
+def make_policy(**kwargs):
+    options = dict(min_delay=0.01, default_delay=0.05, min_samples=1000, max_rate=1.0, max_cost=1.0)
+    options.update(kwargs)
+    return HedgePolicy('tests', **options)
+
+# a request whose copies take the given seconds in turn, and records how each ended
+class Copies:
+
+    def __init__(self, *seconds):
+        self.seconds = list(seconds)
+        self.started = 0
+        self.cancelled = []
+        self.finished = []
+
+    def __call__(self):
+        n = self.started
+        self.started += 1
+        return self._copy(n, self.seconds[n])
+
+    async def _copy(self, n, seconds):
+        try:
+            await asyncio.sleep(seconds)
+        except asyncio.CancelledError:
+            self.cancelled.append(n)
+            raise
+        self.finished.append(n)
+        return f'copy {n}'
+
+
+########################################################
+# Hedging                                              #
+########################################################
+
+def test_fast_call_is_not_hedged(state):
+    policy = make_policy()
+    copies = Copies(0.01)
+
+    async def main():
+        assert await policy.run(copies, 'm') == ('copy 0', False)
+    run(main())
+    assert copies.started == 1
+    assert len(policy._latencies['m']) == 1
+    assert run(policy.totals()) == dict(spent=0, calls=1, hedged=0)
+
+def test_hedge_wins_and_the_first_copy_is_cancelled_at_once(state):
+    policy = make_policy()
+    copies = Copies(10, 0.01)
+
+    async def main():
+        result = await policy.run(copies, 'm')
+        # the loser is cancelled by the time run() returns
+        await asyncio.sleep(0)
+        return result
+    assert run(main()) == ('copy 1', True)
+    assert copies.cancelled == [0]
+    assert copies.finished == [1]
+    # the first copy's time when it lost: at least the delay plus the hedge's time
+    [latency] = policy._latencies['m']
+    assert 0.05 <= latency < 1
+    assert run(policy.totals()) == dict(spent=0, calls=1, hedged=1)
+
+def test_first_copy_can_still_win(state):
+    policy = make_policy()
+    copies = Copies(0.08, 10)
+
+    async def main():
+        result = await policy.run(copies, 'm')
+        await asyncio.sleep(0)
+        return result
+    assert run(main()) == ('copy 0', True)
+    assert copies.cancelled == [1]
+
+def test_cancelling_the_call_cancels_both_copies(state):
+    policy = make_policy()
+    copies = Copies(10, 10)
+
+    async def main():
+        task = asyncio.ensure_future(policy.run(copies, 'm'))
+        await asyncio.sleep(0.1)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+    run(main())
+    assert sorted(copies.cancelled) == [0, 1]
+
+def test_delay_follows_the_percentile(state):
+    policy = make_policy(min_samples=10, percentile=90)
+    for seconds in range(1, 11):
+        policy.observe('m', seconds / 10)
+    assert policy.delay('m') == pytest.approx(1.0)
+    assert policy.delay('other') == 0.05
+
+
+########################################################
+# Caps                                                 #
+########################################################
+
+def test_spend_counts_both_copies_against_the_cost_cap(state):
+    policy = make_policy(max_cost=1.0)
+
+    async def main():
+        await policy._incr('calls')
+        await policy.spend('m', 0.3)
+        assert (await policy.totals())['spent'] == pytest.approx(0.6)
+        assert await policy.allow('m')
+        await policy.spend('m', 0.2)
+        assert not await policy.allow('m')
+    run(main())
+
+def test_rate_cap(state):
+    policy = make_policy(max_rate=0.25)
+
+    async def main():
+        for _ in range(4):
+            await policy._incr('calls')
+        assert await policy.allow('m')
+        assert not await policy.allow('m')
+        # a refused hedge isn't counted
+        assert (await policy.totals())['hedged'] == 1
+    run(main())
+
+def test_caps_start_over_every_period(state):
+    policy = make_policy(max_cost=1.0, period=3600)
+
+    async def main():
+        await policy._incr('calls')
+        await policy.spend('m', 1.0)
+        assert not await policy.allow('m')
+        state.advance(3600)
+        assert await policy.totals() == dict(spent=0, calls=0, hedged=0)
+        await policy._incr('calls')
+        assert await policy.allow('m')
+    run(main())
@@ -0,0 +1,209 @@
+import asyncio
+
+import pytest
+
+from shared.scheduler import BACKGROUND, GREETING, INTERACTIVE, MODERATOR, Scheduler, current_priority, lower, priority
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+# calls that hold their slot until released, recording the order they started in
+class Calls:
+
+    def __init__(self, scheduler):
+        self.scheduler = scheduler
+        self.started = []
+        self._release = asyncio.Event()
+        self._tasks = []
+
+    def make(self, name, cls=INTERACTIVE, key=None, weight=1.0):
+        async def call():
+            async with self.scheduler.slot(cls, key, weight):
+                self.started.append(name)
+                await self._release.wait()
+        task = asyncio.ensure_future(call())
+        self._tasks.append(task)
+        return task
+
+    async def settle(self):
+        for _ in range(5):
+            await asyncio.sleep(0)
+
+    async def release_all(self):
+        self._release.set()
+        await asyncio.gather(*self._tasks)
+
+# queue (name, class, key) calls behind one running call, and return the order they ran in once it ends
+async def run_in_turn(scheduler, queued):
+    order = []
+    gate = asyncio.Event()
+
+    async def holder():
+        async with scheduler.slot(INTERACTIVE):
+            await gate.wait()
+
+    async def call(name, cls, key):
+        async with scheduler.slot(cls, key):
+            order.append(name)
+
+    held = asyncio.ensure_future(holder())
+    await asyncio.sleep(0)
+    tasks = []
+    for name, cls, key in queued:
+        tasks.append(asyncio.ensure_future(call(name, cls, key)))
+        await asyncio.sleep(0)
+    gate.set()
+    await asyncio.gather(held, *tasks)
+    return order
+
+
+########################################################
+# Priority                                             #
+########################################################
+
+def test_higher_classes_go_first():
+    scheduler = Scheduler(concurrency=1)
+
+    async def main():
+        return await run_in_turn(scheduler, [
+            ('background', BACKGROUND, None),
+            ('moderator', MODERATOR, None),
+            ('greeting', GREETING, None),
+            ('interactive', INTERACTIVE, None),
+        ])
+    assert run(main()) == ['interactive', 'greeting', 'moderator', 'background']
+
+def test_interactive_starts_at_once_when_lower_classes_are_saturated():
+    scheduler = Scheduler(concurrency=8)
+
+    async def main():
+        calls = Calls(scheduler)
+        for i in range(10):
+            calls.make(f'greeting {i}', GREETING)
+            calls.make(f'moderator {i}', MODERATOR)
+            calls.make(f'background {i}', BACKGROUND)
+        await calls.settle()
+        # the lower classes together stay below concurrency
+        assert sum(scheduler.running.values()) == 8 - scheduler.reserve
+        calls.make('interactive', INTERACTIVE)
+        await calls.settle()
+        assert 'interactive' in calls.started
+        assert scheduler.running[INTERACTIVE] == 1
+        await calls.release_all()
+    run(main())
+    assert scheduler.reserve == 2
+    assert sum(scheduler.running.values()) == 0
+
+def test_interactive_can_use_every_slot():
+    scheduler = Scheduler(concurrency=4)
+
+    async def main():
+        calls = Calls(scheduler)
+        for i in range(4):
+            calls.make(i)
+        await calls.settle()
+        assert len(calls.started) == 4
+        await calls.release_all()
+    run(main())
+
+def test_class_caps():
+    scheduler = Scheduler(concurrency=8, caps={GREETING: 2})
+
+    async def main():
+        calls = Calls(scheduler)
+        for i in range(4):
+            calls.make(i, GREETING)
+        await calls.settle()
+        assert calls.started == [0, 1]
+        assert scheduler.queued()[GREETING] == 2
+        await calls.release_all()
+    run(main())
+    assert scheduler.queued()[GREETING] == 0
+
+def test_lower_of_nested_priorities():
+    assert lower(None, GREETING) == GREETING
+    assert lower(MODERATOR, GREETING) == MODERATOR
+    with priority(BACKGROUND):
+        with priority(GREETING):
+            assert current_priority() == BACKGROUND
+    assert current_priority() == INTERACTIVE
+
+
+########################################################
+# Fair queuing                                         #
+########################################################
+
+def test_sessions_take_turns_within_a_class():
+    scheduler = Scheduler(concurrency=1)
+
+    async def main():
+        return await run_in_turn(scheduler, [
+            ('a1', INTERACTIVE, 'a'),
+            ('a2', INTERACTIVE, 'a'),
+            ('a3', INTERACTIVE, 'a'),
+            ('b1', INTERACTIVE, 'b'),
+            ('b2', INTERACTIVE, 'b'),
+        ])
+    assert run(main()) == ['a1', 'b1', 'a2', 'b2', 'a3']
+
+def test_weights_share_slots():
+    scheduler = Scheduler(concurrency=1)
+
+    async def main():
+        order = []
+        gate = asyncio.Event()
+
+        async def holder():
+            async with scheduler.slot(INTERACTIVE):
+                await gate.wait()
+
+        async def call(name, key, weight):
+            async with scheduler.slot(INTERACTIVE, key, weight):
+                order.append(name)
+
+        held = asyncio.ensure_future(holder())
+        await asyncio.sleep(0)
+        tasks = [asyncio.ensure_future(call(f'a{i}', 'a', 2.0)) for i in range(4)]
+        tasks += [asyncio.ensure_future(call(f'b{i}', 'b', 1.0)) for i in range(2)]
+        await asyncio.sleep(0)
+        gate.set()
+        await asyncio.gather(held, *tasks)
+        return order
+    # 'a' has twice the weight, so it gets two turns for each of 'b's
+    assert run(main()) == ['a0', 'a1', 'b0', 'a2', 'a3', 'b1']
+
+
+########################################################
+# Cancellation                                         #
+########################################################
+
+def test_cancelled_waiters_give_up_their_place():
+    scheduler = Scheduler(concurrency=1)
+
+    async def main():
+        calls = Calls(scheduler)
+        calls.make('first')
+        waiting = calls.make('cancelled')
+        calls.make('next')
+        await calls.settle()
+        waiting.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiting
+        calls._tasks.remove(waiting)
+        await calls.release_all()
+        return calls.started
+    assert run(main()) == ['first', 'next']
+    assert scheduler.running[INTERACTIVE] == 0
+
+def test_concurrency_zero_turns_scheduling_off():
+    scheduler = Scheduler(concurrency=0)
+
+    async def main():
+        calls = Calls(scheduler)
+        for i in range(50):
+            calls.make(i, BACKGROUND)
+        await calls.settle()
+        assert len(calls.started) == 50
+        await calls.release_all()
+    run(main())
@@ -0,0 +1,140 @@
+import asyncio
+import importlib.util
+import math
+from types import SimpleNamespace
+
+import pytest
+
+import shared.semantic_cache
+from shared.semantic_cache import HashingEmbedder, LSHIndex, SemanticCache, make_embedder
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+def chat(*texts, system='You are a friendly bot.'):
+    messages = [{'role': 'system', 'content': system}]
+    for i, text in enumerate(texts):
+        messages.append({'role': 'user' if i % 2 == 0 else 'assistant', 'content': text})
+    return messages
+
+# unit vectors at a set angle for each text, so similarities are known (cos of the angle between them)
+class AngleEmbedder:
+    threaded = False
+
+    def __init__(self, angles):
+        self.angles = angles
+
+    def embed(self, text):
+        angle = self.angles[text]
+        return [math.cos(angle), math.sin(angle)]
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = SimpleNamespace(now=1000.0)
+    monkeypatch.setattr(shared.semantic_cache, 'time', SimpleNamespace(time=lambda: clock.now))
+    return clock
+
+
+########################################################
+# Lookups                                              #
+########################################################
+
+def test_near_identical_message_is_a_hit(clock):
+    cache = SemanticCache('tests', threshold=0.8)
+
+    async def main():
+        assert await cache.lookup(chat('Hi, how are you?')) is None
+        await cache.add(chat('Hi, how are you?'), 'Great, thanks!')
+        assert await cache.lookup(chat('hi how are you')) == 'Great, thanks!'
+    run(main())
+
+def test_different_message_is_a_miss(clock):
+    cache = SemanticCache('tests', threshold=0.8)
+
+    async def main():
+        await cache.add(chat('Hi, how are you?'), 'Great, thanks!')
+        assert await cache.lookup(chat('What do you think about taxes?')) is None
+    run(main())
+
+def test_threshold(clock):
+    # similarity cos(0.3) = 0.955 to the cached message
+    embedder = AngleEmbedder({'Hi, how are you?': 0.0, 'Hey, how is it going?': 0.3})
+
+    async def main(threshold):
+        cache = SemanticCache('tests', embedder=embedder, threshold=threshold)
+        await cache.add(chat('Hi, how are you?'), 'Great, thanks!')
+        return await cache.lookup(chat('Hey, how is it going?'))
+    assert run(main(0.95)) == 'Great, thanks!'
+    assert run(main(0.96)) is None
+
+def test_context_must_match(clock):
+    cache = SemanticCache('tests', threshold=0.8)
+
+    async def main():
+        await cache.add(chat('Hi, how are you?'), 'Great, thanks!', condition='Democrat')
+        assert await cache.lookup(chat('Hi, how are you?'), condition='Republican') is None
+        assert await cache.lookup(chat('Hi, how are you?', system='You are a grumpy bot.'), condition='Democrat') is None
+        assert await cache.lookup(chat('Hi, how are you?'), condition='Democrat') == 'Great, thanks!'
+    run(main())
+
+def test_only_early_turns_are_cached(clock):
+    cache = SemanticCache('tests', threshold=0.8, max_turns=1)
+    later = chat('Hi', 'Hello!', 'Hi, how are you?')
+
+    async def main():
+        await cache.add(later, 'Great, thanks!')
+        assert await cache.lookup(later) is None
+    run(main())
+
+def test_entries_expire_after_ttl(clock):
+    cache = SemanticCache('tests', threshold=0.8, ttl=60)
+
+    async def main():
+        await cache.add(chat('Hi, how are you?'), 'Great, thanks!')
+        clock.now += 59
+        assert await cache.lookup(chat('Hi, how are you?')) == 'Great, thanks!'
+        clock.now += 1
+        assert await cache.lookup(chat('Hi, how are you?')) is None
+        assert not cache._entries and not cache._indexes
+    run(main())
+
+def test_oldest_entries_are_dropped_past_max_entries(clock):
+    cache = SemanticCache('tests', threshold=0.95, max_entries=2)
+
+    async def main():
+        for text in ('Hello there', 'What is your name?', 'Where are you from?'):
+            await cache.add(chat(text), f'reply to {text}')
+        assert await cache.lookup(chat('Hello there')) is None
+        assert await cache.lookup(chat('Where are you from?')) == 'reply to Where are you from?'
+        assert len(cache._entries) == 2
+    run(main())
+
+
+########################################################
+# Embedders and index                                  #
+########################################################
+
+def test_hashing_embedder_ignores_case_and_punctuation():
+    embedder = HashingEmbedder()
+    assert embedder.embed('Hi, how are you?') == embedder.embed('hi how are you')
+
+def test_index_finds_the_nearest_vector():
+    embedder = HashingEmbedder()
+    index = LSHIndex(embedder.dim)
+    index.add(1, embedder.embed('good morning everyone'))
+    index.add(2, embedder.embed('what time is it'))
+    found = index.nearest(embedder.embed('good morning, everyone!'))
+    assert found[0] == 1 and found[1] == pytest.approx(1.0)
+    index.remove(1)
+    assert len(index) == 1
+    found = index.nearest(embedder.embed('good morning everyone'))
+    assert found is None or found[0] == 2
+
+@pytest.mark.skipif(importlib.util.find_spec('sentence_transformers') is not None, reason='sentence-transformers is installed')
+def test_missing_model_package_fails_at_construction():
+    with pytest.raises(ImportError):
+        make_embedder('sentence-transformers/all-MiniLM-L6-v2')
+    with pytest.raises(ImportError):
+        SemanticCache('tests', embedder='sentence-transformers/all-MiniLM-L6-v2')
+    assert isinstance(make_embedder('hashing'), HashingEmbedder)
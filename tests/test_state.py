@@ -0,0 +1,233 @@
+import asyncio
+
+import pytest
+
+from shared.state import FakeState, LocalState, LockTimeout, RateLimiter, RedisState, lock
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+# RedisState on a fake redis server where a clock can be moved, like FakeState
+class FakeRedisState(RedisState):
+
+    def __init__(self):
+        fakeredis = pytest.importorskip('fakeredis')
+        pytest.importorskip('lupa')
+        super().__init__(client=fakeredis.FakeAsyncRedis(), prefix='test:')
+
+
+@pytest.fixture(params=['local', 'redis'])
+def state(request):
+    if request.param == 'local':
+        return LocalState()
+    return FakeRedisState()
+
+
+########################################################
+# Values                                               #
+########################################################
+
+def test_get_set_delete(state):
+    async def main():
+        assert await state.get('missing') is None
+        assert await state.get('missing', 5) == 5
+        await state.set('a', {'x': [1, 2]})
+        await state.set('b', 'text')
+        assert await state.get('a') == {'x': [1, 2]}
+        assert await state.get_many(['a', 'b', 'c'], default=0) == [{'x': [1, 2]}, 'text', 0]
+        await state.delete('a', 'b')
+        assert await state.get_many(['a', 'b']) == [None, None]
+    run(main())
+
+def test_add_only_sets_missing_keys(state):
+    async def main():
+        assert await state.add('k', 1)
+        assert not await state.add('k', 2)
+        assert await state.get('k') == 1
+    run(main())
+
+def test_delete_if_checks_the_value(state):
+    async def main():
+        await state.set('k', 'mine')
+        assert not await state.delete_if('k', 'theirs')
+        assert await state.get('k') == 'mine'
+        assert await state.delete_if('k', 'mine')
+        assert await state.get('k') is None
+        assert not await state.delete_if('k', 'mine')
+    run(main())
+
+def test_incr(state):
+    async def main():
+        assert await state.incr('n') == 1
+        assert await state.incr('n', 4) == 5
+        assert await state.incr('n', -2) == 3
+        assert await state.incr('cost', 0.25) == pytest.approx(0.25)
+        assert await state.incr('cost', 0.5) == pytest.approx(0.75)
+    run(main())
+
+def test_clear(state):
+    async def main():
+        await state.set('a', 1)
+        await state.incr('b')
+        await state.clear()
+        assert await state.get_many(['a', 'b']) == [None, None]
+    run(main())
+
+
+########################################################
+# Expiry (FakeState clock)                             #
+########################################################
+
+def test_values_expire_after_ttl():
+    state = FakeState()
+
+    async def main():
+        await state.set('k', 'v', ttl=10)
+        await state.set('forever', 'v')
+        state.advance(9.9)
+        assert await state.get('k') == 'v'
+        state.advance(0.1)
+        assert await state.get('k') is None
+        assert await state.get('forever') == 'v'
+        # an expired key can be added again
+        assert await state.add('k', 'new', ttl=5)
+    run(main())
+
+def test_incr_keeps_the_first_ttl():
+    state = FakeState()
+
+    async def main():
+        await state.incr('n', ttl=10)
+        state.advance(6)
+        # a later ttl doesn't extend the key
+        assert await state.incr('n', ttl=10) == 2
+        state.advance(4)
+        assert await state.get('n') is None
+        assert await state.incr('n') == 1
+    run(main())
+
+def test_fake_state_clock_only_moves_when_told():
+    state = FakeState(start=100.0)
+    assert state.now() == 100.0
+    state.advance(2.5)
+    assert state.now() == 102.5
+
+
+########################################################
+# Locks                                                #
+########################################################
+
+def test_lock_is_exclusive(state):
+    inside = []
+
+    async def worker(name):
+        async with lock('job', wait=5, poll=0.001, state=state):
+            inside.append(name)
+            assert len(inside) == 1
+            await asyncio.sleep(0.01)
+            inside.remove(name)
+
+    async def main():
+        await asyncio.gather(*(worker(i) for i in range(5)))
+        assert await state.get('lock:job') is None
+    run(main())
+
+def test_lock_times_out_while_held(state):
+    async def main():
+        async with lock('job', state=state):
+            with pytest.raises(LockTimeout):
+                async with lock('job', wait=0, state=state):
+                    pass
+        # released, so it can be taken again
+        async with lock('job', wait=0, state=state):
+            pass
+    run(main())
+
+def test_lock_is_released_on_error(state):
+    async def main():
+        with pytest.raises(ValueError):
+            async with lock('job', state=state):
+                raise ValueError
+        assert await state.get('lock:job') is None
+    run(main())
+
+def test_lock_of_a_dead_holder_expires():
+    state = FakeState()
+
+    async def main():
+        # another process took the lock and died
+        await state.add('lock:job', 'someone else', ttl=30)
+        with pytest.raises(LockTimeout):
+            async with lock('job', wait=0, state=state):
+                pass
+        state.advance(30)
+        async with lock('job', wait=0, state=state):
+            pass
+    run(main())
+
+def test_lock_is_not_released_by_another_holder():
+    state = FakeState()
+
+    async def main():
+        async with lock('job', ttl=10, state=state):
+            # our lock expired and another process took it
+            state.advance(10)
+            assert await state.add('lock:job', 'other', ttl=10)
+        assert await state.get('lock:job') == 'other'
+    run(main())
+
+
+########################################################
+# Rate limits                                          #
+########################################################
+
+def test_rate_limiter_allows_limit_per_period():
+    state = FakeState(start=0.0)
+    limiter = RateLimiter('api', limit=3, period=60, state=state)
+
+    async def main():
+        assert [await limiter.try_acquire() for _ in range(4)] == [True, True, True, False]
+        state.advance(59)
+        assert not await limiter.try_acquire()
+        # a new window
+        state.advance(1)
+        assert await limiter.try_acquire()
+    run(main())
+
+def test_rate_limiter_refused_cost_is_given_back():
+    state = FakeState(start=0.0)
+    limiter = RateLimiter('api', limit=10, period=60, state=state)
+
+    async def main():
+        assert await limiter.try_acquire(8)
+        assert not await limiter.try_acquire(3)
+        assert await limiter.try_acquire(2)
+        assert not await limiter.try_acquire(1)
+    run(main())
+
+def test_rate_limiters_share_counts_through_the_state():
+    state = FakeState(start=0.0)
+    first = RateLimiter('api', limit=2, period=60, state=state)
+    second = RateLimiter('api', limit=2, period=60, state=state)
+    other = RateLimiter('other', limit=2, period=60, state=state)
+
+    async def main():
+        assert await first.try_acquire()
+        assert await second.try_acquire()
+        assert not await first.try_acquire()
+        assert await other.try_acquire()
+    run(main())
+
+def test_rate_limiter_acquire_waits_for_the_next_window():
+    state = LocalState()
+    limiter = RateLimiter('api', limit=1, period=0.05, state=state)
+
+    async def main():
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        for _ in range(3):
+            await limiter.acquire()
+        assert loop.time() - start >= 0.05
+    run(main())
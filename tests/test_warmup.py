@@ -0,0 +1,82 @@
+import asyncio
+import threading
+
+import pytest
+
+import shared.warmup
+from shared.warmup import Warmup
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+@pytest.fixture(autouse=True)
+def no_server_loop(monkeypatch):
+    monkeypatch.setattr(shared.warmup, '_LOOP', None)
+    monkeypatch.setattr(shared.warmup, '_WAITING', [])
+
+# schedule from another thread, as creating_session and wait pages do
+def schedule_in_thread(warmup, key, make_reply):
+    thread = threading.Thread(target=warmup.schedule, args=(key, make_reply))
+    thread.start()
+    thread.join()
+
+
+def test_replies_scheduled_before_the_loop_is_known_run_on_the_live_methods_loop():
+    warmup = Warmup('tests')
+    loops = []
+
+    async def reply():
+        loops.append(asyncio.get_running_loop())
+        return 'hello'
+
+    schedule_in_thread(warmup, 'a', reply)
+
+    async def main():
+        assert await warmup.take('a') == 'hello'
+        assert loops == [asyncio.get_running_loop()]
+    run(main())
+
+def test_replies_run_on_the_server_loop():
+    warmup = Warmup('tests')
+    loops = []
+
+    async def reply():
+        loops.append(asyncio.get_running_loop())
+        await asyncio.sleep(0.01)
+        return 'hello'
+
+    async def main():
+        await shared.warmup._record_server_loop()
+        await asyncio.to_thread(warmup.schedule, 'a', reply)
+        await asyncio.sleep(0.05)
+        assert await warmup.take('a') == 'hello'
+        assert loops == [asyncio.get_running_loop()]
+        # each reply is handed out once
+        assert await warmup.take('a') is None
+    run(main())
+
+def test_failed_replies_are_none():
+    warmup = Warmup('tests')
+
+    async def reply():
+        raise RuntimeError('api down')
+
+    schedule_in_thread(warmup, 'a', reply)
+    assert run(warmup.take('a')) is None
+
+def test_untaken_replies_expire():
+    warmup = Warmup('tests', ttl=60)
+
+    async def reply():
+        return 'hello'
+
+    schedule_in_thread(warmup, 'a', reply)
+    # scheduled longer than ttl ago
+    future, scheduled = warmup._futures['a']
+    warmup._futures['a'] = (future, scheduled - 61)
+    schedule_in_thread(warmup, 'b', reply)
+    assert list(warmup._futures) == ['b']
+    assert future.cancelled()
+    assert [item[1] for item in shared.warmup._WAITING] == ['b']
+    assert run(warmup.take('a')) is None
@@ -5,8 +5,14 @@ import random
 import json
 from pydantic import BaseModel 
 from datetime import datetime, timezone
+from shared.llm import call_model_chain, canned_response, fallback_chain
+from shared.hedge import HedgePolicy
+from shared.tracing import span, trace_live_method
+from shared.log import get_logger, log_context, set_msg_id
 import math
 
+logger = get_logger(__name__)
+
 doc = """
 LLM chat in 3D environment using threejs
 """
@@ -52,12 +58,34 @@ class C(BaseConstants):
     # Debug settings (coordinates and distance lines)
     DEBUG = False
 
+    # fraction of position updates written to the debug log (they arrive several times a second)
+    POSITION_LOG_SAMPLE = 0.01
+
     ## openAI key
     OPENAI_KEY = environ.get('OPENAI_KEY')
 
     ## model
     MODEL = "gpt-4o-mini"
 
+    ## models to try in order, with the seconds each gets before the next is tried
+    ## None gives a model whatever is left of TURN_DEADLINE
+    FALLBACK_MODEL = "gpt-4.1-nano"
+    MODEL_CHAIN = [(MODEL, 8), (FALLBACK_MODEL, None)]
+
+    ## most seconds a bot turn can take, over all models and retries
+    TURN_DEADLINE = 20
+
+    ## send a second copy of a bot request that is slower than usual (the HEDGE_PERCENTILE of recent calls)
+    ## the copy that finishes first is used; HEDGE_MAX_COST_USD caps the extra spend and HEDGE_MAX_RATE the share of calls hedged, per hour
+    HEDGE = False
+    HEDGE_PERCENTILE = 95
+    HEDGE_MAX_COST_USD = 1.0
+    HEDGE_MAX_RATE = 0.2
+
+    ## if every model fails or the deadline passes: 'canned' replies with FALLBACK_TEXT, [] shows an error
+    FALLBACK = ['canned']
+    FALLBACK_TEXT = "Hmm, give me a moment to think about that."
+
     ## set system prompt for agents
     ## according to OpenAI's documentation, this should be less than ~1500 words
     ## set system prompt for bots
@@ -137,6 +165,14 @@ class C(BaseConstants):
 # OpenAI Setup                                         #
 ########################################################
 
+# hedging for slow bot requests (see C.HEDGE)
+HEDGE_POLICY = HedgePolicy(
+    __name__,
+    percentile=C.HEDGE_PERCENTILE,
+    max_cost=C.HEDGE_MAX_COST_USD,
+    max_rate=C.HEDGE_MAX_RATE,
+) if C.HEDGE else None
+
 # specify json schema for bot messages
 class MsgOutputSchema(BaseModel):
     sender: str
@@ -184,51 +220,39 @@ async def runGPT(inputDat):
 
     # openai client and response creation
     client = AsyncOpenAI(api_key=C.OPENAI_KEY)
+    def request(model):
+        return client.responses.parse(
+            model=model,
+            input=inputMsg,
+            text_format=MsgOutputSchema,
+        )
+
+    # reply to use if the api is down
+    cannedReply = canned_response(MsgOutputSchema(
+        sender=botLabel, msgId=botMsgId, tone=tone, text=C.FALLBACK_TEXT,
+    ))
 
     # responses api with retries in case of rate limits
-    max_retries = 9
-    for attempt in range(max_retries):
-        try:
-            response = await client.responses.parse(
-                model=C.MODEL,
-                input=inputMsg,
-                text_format=MsgOutputSchema,
-            )
-
-            # if model supports reasoning, include, otherwise dont
-            reasoning = {'effort': C.REASONING_LVL} if 'gpt-5' in C.MODEL else None
-            response.reasoning = reasoning
-
-            # if model supports temperature, include, otherwise dont
-            temperature = botTemp if 'gpt-4' in C.MODEL else None
-            response.temperature = temperature
-            return response.output_parsed
-
-        except Exception as e:
-            if attempt < max_retries - 1:
-                # exponential backoff with larger delays and jitter; honor server hint if present
-                base_delay = min(64, 2 ** (attempt + 1))
-                hinted = None
-                try:
-                    m = re.search(r"Please try again in\s+([0-9]+(?:\.[0-9]+)?)s", str(e))
-                    if m:
-                        hinted = float(m.group(1))
-                except Exception:
-                    hinted = None
-                delay = max(base_delay, hinted or 0) + random.uniform(0, 1.0)
-                botLabel = inputDat.get('botLabel', 'UNKNOWN')
-                try:
-                    print(f"[LLM][retry] runGPT for {botLabel}: {e}. Retrying in {delay:.1f}s (attempt {attempt+1}/{max_retries})")
-                except Exception:
-                    pass
-                await asyncio.sleep(delay)
-            else:
-                botLabel = inputDat.get('botLabel', 'UNKNOWN')
-                try:
-                    print(f"[LLM][error] runGPT for {botLabel}: giving up after {max_retries} attempts. Last error: {e}")
-                except Exception:
-                    pass
-                raise
+    ## tries each model in C.MODEL_CHAIN within C.TURN_DEADLINE, then falls back as set in C.FALLBACK
+    response = await call_model_chain(
+        request,
+        C.MODEL_CHAIN,
+        deadline=C.TURN_DEADLINE,
+        hedge=HEDGE_POLICY,
+        app=__name__,
+        bot=inputDat.get('botLabel', 'UNKNOWN'),
+        name='runGPT',
+        fallback=fallback_chain(C.FALLBACK, canned=cannedReply),
+    )
+
+    # if model supports reasoning, include, otherwise dont
+    reasoning = {'effort': C.REASONING_LVL} if 'gpt-5' in C.MODEL else None
+    response.reasoning = reasoning
+
+    # if model supports temperature, include, otherwise dont
+    temperature = botTemp if 'gpt-4' in C.MODEL else None
+    response.temperature = temperature
+    return response.output_parsed
 
 
 
@@ -478,7 +502,11 @@ class chat(Page):
 
     # live method functions
     @staticmethod
+    @trace_live_method(__name__)
     async def live_method(player: Player, data):
+
+        # tag logs from this message with the session and participant
+        log_context(player)
         
         # if no new data, just return cached messages
         if not data:
@@ -488,7 +516,8 @@ class chat(Page):
             )}
         
         # if we have new data, process it and update cache
-        messages = json.loads(player.cachedMessages)
+        with span('cache.decode'):
+            messages = json.loads(player.cachedMessages)
 
         # create current player identifier
         currentPlayer = 'P' + str(player.id_in_group)
@@ -509,32 +538,33 @@ class chat(Page):
                 text = data.get('text', '')
                 posData = data.get('pos', {})
                 currentPlayer = 'P' + str(player.id_in_group)
-                messages = json.loads(player.cachedMessages)
+                with span('cache.decode'):
+                    messages = json.loads(player.cachedMessages)
                 
                 # calculate distance to NPCs
-                print('Player pos:', posData)
                 npcDistances = calculate_npc_distances(posData)
-                print('NPC distances:', npcDistances)
 
                 # determine closest NPC (within 10 units of distance)
                 min_distance = min(npcDistances.values())
                 closestNPC = None if min_distance > 10 else [x for x in npcDistances if npcDistances[x] == min_distance][0]
-                print('Closest NPC:', closestNPC)
+                logger.debug('Player text', extra=dict(pos=posData, npcDistances=npcDistances, closestNPC=closestNPC))
 
                 # create message id
                 dateNow = str(datetime.now(tz=timezone.utc).timestamp())
                 msgId = currentPlayer + '-' + dateNow
+                set_msg_id(msgId)
 
                 # save to database
-                MessageData.create(
-                    player=player,
-                    msgId=msgId,
-                    timestamp=dateNow,
-                    sender=currentPlayer,
-                    tone=tone,
-                    msgText=text,
-                    target=closestNPC,
-                )
+                with span('db.write'):
+                    MessageData.create(
+                        player=player,
+                        msgId=msgId,
+                        timestamp=dateNow,
+                        sender=currentPlayer,
+                        tone=tone,
+                        msgText=text,
+                        target=closestNPC,
+                    )
 
                 # add message to list
                 messages.append({
@@ -545,7 +575,8 @@ class chat(Page):
                 })
                 
                 # update cache
-                player.cachedMessages = json.dumps(messages)
+                with span('cache.encode'):
+                    player.cachedMessages = json.dumps(messages)
                 
                 # yield output to chat.html
                 yield {player.id_in_group: dict(
@@ -580,8 +611,8 @@ class chat(Page):
                     )
                     botText = await runGPT(inputDat)
 
-                    print('botId:', botId)
-                    print('botText:', botText)
+                    set_msg_id(botText.msgId)
+                    logger.debug('Bot reply', extra=dict(botId=botId, text=botText.text))
 
                     # grab bot response data
                     outputText = botText.text
@@ -589,14 +620,15 @@ class chat(Page):
                     botTone = botText.tone
 
                     # save to database
-                    MessageData.create(
-                        player=player,
-                        sender=botId,
-                        msgId=botMsgId,
-                        timestamp=dateNow,
-                        tone=botTone,
-                        msgText=outputText,
-                    )
+                    with span('db.write'):
+                        MessageData.create(
+                            player=player,
+                            sender=botId,
+                            msgId=botMsgId,
+                            timestamp=dateNow,
+                            tone=botTone,
+                            msgText=outputText,
+                        )
 
                     # update cache with bot message
                     messages.append({
@@ -605,7 +637,8 @@ class chat(Page):
                         'msgId': botMsgId,
                         'text': outputText,
                     })
-                    player.cachedMessages = json.dumps(messages)
+                    with span('cache.encode'):
+                        player.cachedMessages = json.dumps(messages)
 
                     # return output to chat.html
                     yield {player.id_in_group: dict(
@@ -621,7 +654,7 @@ class chat(Page):
 
                 # if botId is None, then no NPC is close enough to chat
                 else:
-                    print('Not near any NPCs!')
+                    logger.debug('Not near any NPCs')
             
                 
             
@@ -634,16 +667,20 @@ class chat(Page):
                 # grab position data
                 posData = data["pos"]
 
+                # position updates are frequent, so only log a sample of them
+                logger.debug('Position update', extra=dict(pos=posData, sample=C.POSITION_LOG_SAMPLE))
+
                 # save to database
-                CharPositionData.create(
-                        player=player,
-                        msgId='initial',
-                        timestamp=dateNow,
-                        posPlayer=json.dumps(posData),
-                        posRed='',
-                        posBlack='',
-                        posGreen='',
-                    )
+                with span('db.write'):
+                    CharPositionData.create(
+                            player=player,
+                            msgId='initial',
+                            timestamp=dateNow,
+                            posPlayer=json.dumps(posData),
+                            posRed='',
+                            posBlack='',
+                            posGreen='',
+                        )
 
                 
             # handle phase updates
@@ -658,8 +695,7 @@ class chat(Page):
                     # increment phase
                     currentPhase = 1
                     player.phase = currentPhase
-                    print("Current phase:")
-                    print(currentPhase)
+                    logger.info(f'Current phase: {currentPhase}')
 
                     # get time stamp
                     dateNow = str(datetime.now(tz=timezone.utc).timestamp())
@@ -672,15 +708,16 @@ class chat(Page):
                     playerPos = pos['player']
 
                     # save to database
-                    CharPositionData.create(
-                        player=player,
-                        msgId='initial',
-                        timestamp=dateNow,
-                        posPlayer=json.dumps(playerPos),
-                        posRed=json.dumps(redPos),
-                        posBlack=json.dumps(blackPos),
-                        posGreen=json.dumps(greenPos),
-                    )
+                    with span('db.write'):
+                        CharPositionData.create(
+                            player=player,
+                            msgId='initial',
+                            timestamp=dateNow,
+                            posPlayer=json.dumps(playerPos),
+                            posRed=json.dumps(redPos),
+                            posBlack=json.dumps(blackPos),
+                            posGreen=json.dumps(greenPos),
+                        )
 
                     yield {player.id_in_group: dict(
                         event='phase',
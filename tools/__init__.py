@@ -0,0 +1,3 @@
+"""
+Command line tools for testing the apps outside of a live session.
+"""
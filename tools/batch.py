@@ -0,0 +1,244 @@
+"""
+Batch API mode for offline simulations.
+
+Simulated pilots (tools.simulate) don't need replies within seconds, and the
+OpenAI Batch API runs requests at half the price, with separate, much higher
+rate limits. ``BatchTransport`` is an httpx transport for the apps' OpenAI
+clients. It doesn't send each request. Instead, it collects the requests
+runGPT makes, exactly as they would have been sent. Once no new request has
+arrived for ``window`` seconds, it submits them as a JSONL batch job (one per
+endpoint). It then polls the job until it finishes and hands each caller the
+response from the job's output. The callers, e.g. the live method, then go on
+as if the request had been answered directly: their replies are saved and
+become part of the transcript.
+
+Because each turn of a dialogue depends on the one before it, a simulation
+moves in rounds. Every dialogue's next request goes into one batch, then every
+simulated participant's reply goes into the next one, and so on.
+
+Backends:
+- ``OpenAIBatchBackend``: the OpenAI Batch API (files + batches endpoints)
+- ``LocalBatchBackend``: a stand-in that keeps batches as files in a folder and
+  answers them through another transport (e.g. the stub server), for testing
+  without an API key
+"""
+
+import asyncio
+import itertools
+import json
+import os
+import secrets
+
+import httpx
+
+from shared.log import get_logger
+
+logger = get_logger(__name__)
+
+## batch requests cost this share of the normal price
+## https://platform.openai.com/docs/guides/batch
+BATCH_DISCOUNT = 0.5
+
+## most requests in one batch job
+MAX_BATCH_SIZE = 50000
+
+DONE = {'completed', 'failed', 'expired', 'cancelled'}
+
+
+# {custom_id: (status_code, body)} from the lines of a batch output or error file
+def parse_output(text):
+    results = {}
+    for line in text.splitlines():
+        if not line.strip():
+            continue
+        item = json.loads(line)
+        response = item.get('response')
+        if response:
+            results[item['custom_id']] = (response['status_code'], response['body'])
+        else:
+            error = item.get('error') or {'message': 'no response in batch output'}
+            results[item['custom_id']] = (500, {'error': error})
+    return results
+
+
+########################################################
+# Transport                                            #
+########################################################
+
+class BatchTransport(httpx.AsyncBaseTransport):
+
+    def __init__(self, backend, window=2.0, poll=30.0, max_size=MAX_BATCH_SIZE):
+        self.backend = backend
+        self.window = window
+        self.poll = poll
+        self.max_size = max_size
+        self.batches = 0
+        self.requests = 0
+
+        # (custom_id, endpoint, body, future) waiting to be submitted
+        self._pending = []
+        self._ids = itertools.count()
+        self._lastArrival = 0.0
+        self._flusher = None
+        self._jobs = set()
+
+    async def handle_async_request(self, request):
+        loop = asyncio.get_running_loop()
+        await request.aread()
+        future = loop.create_future()
+        customId = f'req-{next(self._ids)}'
+        self._pending.append((customId, request.url.path, json.loads(request.content or b'{}'), future))
+        self.requests += 1
+        self._lastArrival = loop.time()
+        if len(self._pending) >= self.max_size:
+            self._flush()
+        elif self._flusher is None or self._flusher.done():
+            self._flusher = asyncio.ensure_future(self._flush_when_quiet())
+        status, body = await future
+        return httpx.Response(status, json=body)
+
+    # submit once no request has arrived for `window` seconds
+    async def _flush_when_quiet(self):
+        loop = asyncio.get_running_loop()
+        while self._pending:
+            wait = self._lastArrival + self.window - loop.time()
+            if wait > 0:
+                await asyncio.sleep(wait)
+                continue
+            self._flush()
+
+    def _flush(self):
+        pending, self._pending = self._pending, []
+        byEndpoint = {}
+        for item in pending:
+            byEndpoint.setdefault(item[1], []).append(item)
+        for endpoint, items in byEndpoint.items():
+            job = asyncio.ensure_future(self._run(endpoint, items))
+            self._jobs.add(job)
+            job.add_done_callback(self._jobs.discard)
+
+    async def _run(self, endpoint, items):
+        lines = [
+            dict(custom_id=customId, method='POST', url=endpoint, body=body)
+            for customId, _, body, _ in items
+        ]
+        try:
+            batchId = await self.backend.submit(endpoint, lines)
+            self.batches += 1
+            logger.info(f'Submitted batch {batchId} with {len(lines)} requests to {endpoint}')
+            while True:
+                status = await self.backend.status(batchId)
+                if status in DONE:
+                    break
+                await asyncio.sleep(self.poll)
+            results = await self.backend.results(batchId)
+            logger.info(f'Batch {batchId} {status}: {len(results)} of {len(lines)} results')
+        except Exception as e:
+            logger.exception(f'Batch to {endpoint} failed')
+            for *_, future in items:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for customId, _, _, future in items:
+            if not future.done():
+                # requests missing from an expired or failed batch come back as errors, so call_llm retries them
+                future.set_result(results.get(customId, (500, {'error': {'message': f'batch {batchId} {status} without this request'}})))
+
+    async def aclose(self):
+        for job in list(self._jobs):
+            job.cancel()
+
+
+########################################################
+# Backends                                             #
+########################################################
+
+# the OpenAI Batch API
+class OpenAIBatchBackend:
+
+    def __init__(self, client, completion_window='24h'):
+        self.client = client
+        self.completion_window = completion_window
+
+    async def submit(self, endpoint, lines):
+        data = '\n'.join(json.dumps(line, ensure_ascii=False) for line in lines).encode()
+        file = await self.client.files.create(file=('batch.jsonl', data), purpose='batch')
+        batch = await self.client.batches.create(
+            input_file_id=file.id,
+            endpoint=endpoint,
+            completion_window=self.completion_window,
+        )
+        return batch.id
+
+    async def status(self, batchId):
+        batch = await self.client.batches.retrieve(batchId)
+        return batch.status
+
+    async def results(self, batchId):
+        batch = await self.client.batches.retrieve(batchId)
+        results = {}
+        for fileId in (batch.error_file_id, batch.output_file_id):
+            if fileId:
+                content = await self.client.files.content(fileId)
+                results.update(parse_output(content.text))
+        return results
+
+
+# batches as files in `directory`, answered through `transport`
+## <id>.input.jsonl and <id>.output.jsonl use the Batch API's formats, and <id>.status
+## holds the status, so a batch can also be answered by hand or by another process
+class LocalBatchBackend:
+
+    def __init__(self, directory, transport, concurrency=16):
+        self.directory = directory
+        self.transport = transport
+        self.concurrency = concurrency
+        self._tasks = set()
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, batchId, kind):
+        return os.path.join(self.directory, f'{batchId}.{kind}')
+
+    def _write(self, batchId, kind, text):
+        path = self._path(batchId, kind)
+        with open(path + '.tmp', 'w', encoding='utf-8') as f:
+            f.write(text)
+        os.replace(path + '.tmp', path)
+
+    async def submit(self, endpoint, lines):
+        batchId = f'batch_local_{secrets.token_hex(6)}'
+        self._write(batchId, 'input.jsonl', ''.join(json.dumps(line, ensure_ascii=False) + '\n' for line in lines))
+        self._write(batchId, 'status', 'in_progress')
+        task = asyncio.ensure_future(self._process(batchId, lines))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return batchId
+
+    async def _process(self, batchId, lines):
+        semaphore = asyncio.Semaphore(self.concurrency)
+        async with httpx.AsyncClient(transport=self.transport, base_url='http://batch.local', timeout=None) as http:
+
+            async def one(line):
+                async with semaphore:
+                    try:
+                        resp = await http.request(line['method'], line['url'], json=line['body'])
+                        response = dict(status_code=resp.status_code, request_id=secrets.token_hex(8), body=resp.json())
+                        return dict(id=f'batch_req_{secrets.token_hex(8)}', custom_id=line['custom_id'], response=response, error=None)
+                    except Exception as e:
+                        return dict(id=f'batch_req_{secrets.token_hex(8)}', custom_id=line['custom_id'], response=None,
+                                    error=dict(code='local_error', message=str(e)))
+
+            output = await asyncio.gather(*(one(line) for line in lines))
+        self._write(batchId, 'output.jsonl', ''.join(json.dumps(item, ensure_ascii=False) + '\n' for item in output))
+        self._write(batchId, 'status', 'completed')
+
+    async def status(self, batchId):
+        with open(self._path(batchId, 'status'), encoding='utf-8') as f:
+            return f.read().strip()
+
+    async def results(self, batchId):
+        path = self._path(batchId, 'output.jsonl')
+        if not os.path.exists(path):
+            return {}
+        with open(path, encoding='utf-8') as f:
+            return parse_output(f.read())
@@ -0,0 +1,450 @@
+"""
+Synthetic-participant load generator for the chat apps.
+
+Creates a session for each app through oTree's REST API, walks every
+participant to the app's chat page, and then opens one live-page websocket
+per participant. Each simulated participant replays the same events the app's
+chat.html sends (text, botMsg, reaction, posCheck, phase), waits for the
+reply, and pauses for a sampled think time before the next turn.
+
+At the end it reports p50/p95/p99 live-event latency, error rate and
+throughput per app (and per event type). Events sent without waiting for a
+reply (e.g. posCheck, or a moderator that only answers when it is its turn)
+are counted separately as 'unawaited' and have no latency.
+
+The server needs OTREE_REST_KEY set (and OTREE_AUTH_LEVEL unset or the same
+key passed here). To test without API keys, run it against the stub server:
+
+    python -m tools.stub_server --port 8001 &
+    OPENAI_BASE_URL=http://127.0.0.1:8001/v1 ELEVENLABS_BASE_URL=http://127.0.0.1:8001 \\
+        OPENAI_KEY=stub OTREE_REST_KEY=secret otree prodserver 8000 &
+    python -m tools.loadgen --server http://127.0.0.1:8000 --rest-key secret \\
+        --app chat_complex --participants 200 --turns 5 --think lognormal:4,0.5
+"""
+
+import argparse
+import asyncio
+import base64
+import json
+import random
+import re
+import time
+from collections import defaultdict
+from os import environ
+from urllib.parse import urlencode, urlparse
+
+import httpx
+import websockets
+
+from tools.stub_server import parse_latency
+
+
+########################################################
+# Settings                                             #
+########################################################
+
+# apps the load generator knows how to drive, and the page with the live method
+CHAT_PAGE = 'chat'
+
+# form values for pages before the chat page
+FORM_DATA = {
+    'chat_japanese': {'pre_chat_opinion': '3'},
+}
+
+# participants per group (sessions must be a multiple of this)
+GROUP_SIZE = {
+    'chat_2humans1bot': 2,
+}
+
+EMOJIS = ['👍', '👎', '❤️']
+
+SAMPLE_TEXTS = [
+    'hi, how are you?',
+    'I think that is a fair point, but what about the other side?',
+    'Can you give me an example?',
+    'I am not sure I agree with that.',
+    'Interesting, tell me more.',
+]
+
+# stand-in recording for chat_voice (transcribed by the stub server)
+FAKE_AUDIO = base64.b64encode(bytes(range(256)) * 8).decode()
+
+
+########################################################
+# Results                                              #
+########################################################
+
+class Results:
+
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.sent = defaultdict(int)
+        self.unawaited = defaultdict(int)
+        self.start = None
+        self.end = None
+
+    def record(self, app, event, latency=None, error=False):
+        self.sent[(app, event)] += 1
+        if error:
+            self.errors[(app, event)] += 1
+        elif latency is not None:
+            self.latencies[(app, event)].append(latency)
+
+    def record_unawaited(self, app, event):
+        self.unawaited[(app, event)] += 1
+
+    def report(self) -> dict:
+        duration = max(1e-9, (self.end or time.perf_counter()) - (self.start or 0))
+        report = {}
+        for app in sorted({a for a, e in [*self.sent, *self.unawaited]}):
+            events = sorted({e for a, e in [*self.sent, *self.unawaited] if a == app})
+            allLatencies = [x for e in events for x in self.latencies[(app, e)]]
+            sent = sum(self.sent[(app, e)] for e in events)
+            errors = sum(self.errors[(app, e)] for e in events)
+            report[app] = dict(
+                summarize(allLatencies),
+                events=sent,
+                errors=errors,
+                error_rate=round(errors / sent, 4) if sent else 0.0,
+                throughput_per_s=round(sent / duration, 2),
+                unawaited=sum(self.unawaited[(app, e)] for e in events),
+                by_event={
+                    e: dict(
+                        summarize(self.latencies[(app, e)]),
+                        events=self.sent[(app, e)],
+                        errors=self.errors[(app, e)],
+                        unawaited=self.unawaited[(app, e)],
+                    )
+                    for e in events
+                },
+            )
+        return report
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    values = sorted(values)
+    idx = min(len(values) - 1, max(0, int(round(q / 100 * (len(values) - 1)))))
+    return values[idx]
+
+def summarize(latencies) -> dict:
+    return dict(
+        p50_ms=_ms(percentile(latencies, 50)),
+        p95_ms=_ms(percentile(latencies, 95)),
+        p99_ms=_ms(percentile(latencies, 99)),
+        max_ms=_ms(max(latencies) if latencies else None),
+    )
+
+def _ms(seconds):
+    return None if seconds is None else round(seconds * 1000, 1)
+
+
+# the server answered an event with an error
+class ReplyError(Exception):
+    pass
+
+
+########################################################
+# Simulated participant                                #
+########################################################
+
+class SimParticipant:
+
+    def __init__(self, app, code, sessionCode, idInGroup, args, results, rng):
+        self.app = app
+        self.code = code
+        self.sessionCode = sessionCode
+        self.idInGroup = idInGroup
+        self.playerId = f'P{idInGroup}'
+        self.args = args
+        self.results = results
+        self.rng = rng
+        self.think = parse_latency(args.think)
+        self.ws = None
+        self.reader = None
+        self.inbox = asyncio.Queue()
+        self.lastMsgIds = []
+
+    # open the participant's start link and submit pages until the chat page
+    async def advance_to_chat(self, http: httpx.AsyncClient):
+        resp = await http.get(f'/InitializeParticipant/{self.code}')
+        for _ in range(10):
+            path = urlparse(str(resp.url)).path
+            m = re.match(r'/p/([^/]+)/([^/]+)/([^/]+)/(\d+)', path)
+            if not m:
+                raise RuntimeError(f'{self.code}: unexpected page {path}')
+            pageName, pageIndex = m.group(3), int(m.group(4))
+            if pageName == CHAT_PAGE:
+                return pageName, pageIndex
+            token = re.search(r'name="csrftoken" value="(\d+)"', resp.text)
+            form = dict(FORM_DATA.get(self.app, {}))
+            if token:
+                form['csrftoken'] = token.group(1)
+            resp = await http.post(path, data=form)
+        raise RuntimeError(f'{self.code}: did not reach the {CHAT_PAGE} page')
+
+    async def connect(self, wsBase, pageName, pageIndex):
+        query = urlencode(dict(
+            participant_code=self.code,
+            page_name=pageName,
+            page_index=pageIndex,
+            session_code=self.sessionCode,
+        ))
+        self.ws = await websockets.connect(f'{wsBase}/live?{query}', max_size=None)
+        self.reader = asyncio.create_task(self._reader())
+
+    async def _reader(self):
+        try:
+            async for raw in self.ws:
+                await self.inbox.put(json.loads(raw))
+        except websockets.ConnectionClosed:
+            pass
+
+    # send an event without waiting for a reply
+    ## replies to it are dropped by later requests unless they match what those wait for
+    async def send(self, payload):
+        self.results.record_unawaited(self.app, payload.get('event', payload.get('type', 'load')))
+        await self.ws.send(json.dumps(payload))
+
+    # the next message matching `expect` (and `match`, if given); other messages are dropped
+    ## raises asyncio.TimeoutError after `deadline` and ReplyError if the server sends an error
+    async def receive(self, expect, match=None, deadline=None):
+        while True:
+            msg = await asyncio.wait_for(self.inbox.get(), max(0.0, deadline - time.perf_counter()))
+            if msg.get('otree_success') is False:
+                raise ReplyError(msg)
+            data = msg.get('live_method_payload') or {}
+            if 'error' in data:
+                raise ReplyError(data['error'])
+            if data.get('event', data.get('type')) == expect and (match is None or match(data)):
+                return data
+
+    # send an event and wait for a reply matching `expect` (and `match`, if given)
+    async def request(self, payload, expect, match=None):
+        event = payload.get('event', payload.get('type', 'load'))
+        start = time.perf_counter()
+        await self.ws.send(json.dumps(payload))
+        try:
+            data = await self.receive(expect, match, start + self.args.timeout)
+        except (asyncio.TimeoutError, ReplyError):
+            self.results.record(self.app, event, error=True)
+            return None
+        self.results.record(self.app, event, time.perf_counter() - start)
+        return data
+
+    # wait for a message someone else asked for (e.g. a greeting sent to the whole group)
+    async def wait_for(self, expect, match=None):
+        try:
+            return await self.receive(expect, match, time.perf_counter() + self.args.timeout)
+        except (asyncio.TimeoutError, ReplyError):
+            return None
+
+    async def pause(self):
+        await asyncio.sleep(self.think(self.rng))
+
+    # maybe react to a recent message
+    async def maybe_react(self, target):
+        if self.lastMsgIds and self.rng.random() < self.args.reaction_rate:
+            await self.request(
+                {'event': 'reaction', 'msgId': self.rng.choice(self.lastMsgIds), 'emoji': self.rng.choice(EMOJIS), 'target': target},
+                expect='msgReaction',
+            )
+
+    def remember(self, data, key):
+        if data and data.get(key):
+            self.lastMsgIds = (self.lastMsgIds + [data[key]])[-5:]
+
+    async def close(self):
+        if self.ws is not None:
+            await self.ws.close()
+        if self.reader is not None:
+            self.reader.cancel()
+
+
+########################################################
+# Event streams per app                                #
+########################################################
+
+def own_text(p):
+    return lambda d: d.get('sender') == p.playerId
+
+def sent_by(sender):
+    return lambda d: d.get('sender') == sender
+
+# text -> botMsg turns, as in chat_simple, chat_complex, dictator_game and chat_japanese
+async def run_text_chat(p: SimParticipant, text_payload=None):
+    for turn in range(p.args.turns):
+        payload = text_payload() if text_payload else {'event': 'text', 'text': p.rng.choice(SAMPLE_TEXTS)}
+        data = await p.request(payload, expect='text', match=own_text(p))
+        p.remember(data, 'msgId')
+        data = await p.request({'event': 'botMsg'}, expect='botText')
+        p.remember(data, 'botMsgId')
+        await p.maybe_react(f'B{p.idInGroup}')
+        await p.pause()
+
+async def run_chat_voice(p: SimParticipant):
+    await run_text_chat(p, lambda: {'event': 'text', 'text': FAKE_AUDIO})
+
+# greetings from both bots, then participant bot every turn and moderator every few turns
+async def run_chat_multiple_agents(p: SimParticipant):
+    botLabel, modLabel = f'B{p.idInGroup}', f'M{p.idInGroup}'
+    await p.request({'event': 'phase', 'phase': 0}, expect='phase')
+    await p.request({'event': 'phase', 'phase': 1}, expect='phase')
+    for bot in (botLabel, modLabel):
+        await p.request({'event': 'botMsg', 'botId': bot, 'isGreeting': True}, expect='botText', match=sent_by(bot))
+    for turn in range(p.args.turns):
+        data = await p.request({'event': 'text', 'text': p.rng.choice(SAMPLE_TEXTS)}, expect='text', match=own_text(p))
+        p.remember(data, 'msgId')
+        # a late moderator reply from an earlier turn is not the participant bot's answer
+        data = await p.request({'event': 'botMsg', 'botId': botLabel}, expect='botText', match=sent_by(botLabel))
+        p.remember(data, 'botMsgId')
+        # the moderator only answers when it is its turn, so don't wait for it
+        await p.send({'event': 'botMsg', 'botId': modLabel})
+        await p.maybe_react(botLabel)
+        await p.pause()
+
+# two humans and a moderator; both players chat and poll the moderator
+async def run_chat_2humans1bot(p: SimParticipant):
+    await p.request({'event': 'phase', 'phase': 0}, expect='phase')
+    # player 1 asks for the greeting and both wait for it, so no moderator reply to a later botMsg is taken for it
+    if p.idInGroup == 1:
+        await p.request({'event': 'botMsg', 'isGreeting': True}, expect='botText')
+    else:
+        await p.wait_for('botText')
+    for turn in range(p.args.turns):
+        data = await p.request({'event': 'text', 'text': p.rng.choice(SAMPLE_TEXTS)}, expect='text', match=own_text(p))
+        p.remember(data, 'msgId')
+        await p.send({'event': 'botMsg'})
+        await p.maybe_react(f'P{3 - p.idInGroup}')
+        await p.pause()
+
+# walk around, report positions, and talk to whichever NPC is close
+async def run_threejs(p: SimParticipant):
+    data = await p.request({'event': 'phase', 'phase': 0}, expect='phase')
+    if not data:
+        return
+    npcs = {name: json.loads(data[f'pos{name}']) for name in ('Red', 'Black', 'Green')}
+    for turn in range(p.args.turns):
+        npc = npcs[p.rng.choice(list(npcs))]
+        pos = dict(npc, x=npc['x'] + p.rng.uniform(-1, 1), z=npc['z'] + p.rng.uniform(-1, 1))
+        for _ in range(3):
+            await p.send({'event': 'posCheck', 'pos': pos})
+        data = await p.request({'event': 'text', 'text': p.rng.choice(SAMPLE_TEXTS), 'pos': pos}, expect='text', match=own_text(p))
+        if data and data.get('target'):
+            await p.request({'event': 'botMsg', 'botId': data['target']}, expect='botText')
+        await p.pause()
+
+# load the game and finish after the light turns green
+async def run_traffic_light(p: SimParticipant):
+    data = await p.request({'type': 'load'}, expect='init')
+    await p.pause()
+    await p.request({'type': 'finish', 'reason': 'green'}, expect='finished')
+
+SCENARIOS = {
+    'chat_simple': run_text_chat,
+    'chat_complex': run_text_chat,
+    'dictator_game': run_text_chat,
+    'chat_japanese': run_text_chat,
+    'chat_voice': run_chat_voice,
+    'chat_multiple_agents': run_chat_multiple_agents,
+    'chat_2humans1bot': run_chat_2humans1bot,
+    'threejs': run_threejs,
+    'traffic_light': run_traffic_light,
+}
+
+
+########################################################
+# Runner                                               #
+########################################################
+
+# create a session and return (session code, [(participant code, id in group), ...])
+async def create_session(http: httpx.AsyncClient, configName: str, numParticipants: int):
+    resp = await http.post('/api/sessions', json=dict(session_config_name=configName, num_participants=numParticipants))
+    resp.raise_for_status()
+    sessionCode = resp.json()['code']
+    resp = await http.post(f'/api/get_session/{sessionCode}', json={})
+    resp.raise_for_status()
+    groupSize = GROUP_SIZE.get(configName, 1)
+    participants = [
+        (pp['code'], (pp['id_in_session'] - 1) % groupSize + 1)
+        for pp in sorted(resp.json()['participants'], key=lambda pp: pp['id_in_session'])
+    ]
+    return sessionCode, participants
+
+async def run_app(app, args, results, rng):
+    headers = {'otree-rest-key': args.rest_key} if args.rest_key else {}
+    groupSize = GROUP_SIZE.get(app, 1)
+    numParticipants = max(groupSize, args.participants // groupSize * groupSize)
+
+    async with httpx.AsyncClient(base_url=args.server, headers=headers, timeout=60) as api:
+        sessionCode, participants = await create_session(api, app, numParticipants)
+    print(f'[{app}] session {sessionCode} with {len(participants)} participants')
+
+    wsBase = args.server.replace('http://', 'ws://').replace('https://', 'wss://')
+    sims = [
+        SimParticipant(app, code, sessionCode, idInGroup, args, results, random.Random(rng.random()))
+        for code, idInGroup in participants
+    ]
+
+    async def one(i, sim):
+        # spread connections over the ramp-up period
+        await asyncio.sleep(args.ramp_up * i / max(1, len(sims)))
+        try:
+            async with httpx.AsyncClient(base_url=args.server, follow_redirects=True, timeout=60) as http:
+                pageName, pageIndex = await sim.advance_to_chat(http)
+            await sim.connect(wsBase, pageName, pageIndex)
+            await SCENARIOS[app](sim)
+        except Exception as e:
+            results.record(app, 'connect', error=True)
+            print(f'[{app}] participant {sim.code} failed: {e!r}')
+        finally:
+            await sim.close()
+
+    await asyncio.gather(*(one(i, sim) for i, sim in enumerate(sims)))
+
+async def run(args):
+    results = Results()
+    rng = random.Random(args.seed)
+    apps = list(SCENARIOS) if args.app == ['all'] else args.app
+    results.start = time.perf_counter()
+    if args.sequential:
+        for app in apps:
+            await run_app(app, args, results, rng)
+    else:
+        await asyncio.gather(*(run_app(app, args, results, rng) for app in apps))
+    results.end = time.perf_counter()
+    return results.report()
+
+
+########################################################
+# Command line                                         #
+########################################################
+
+def main():
+    parser = argparse.ArgumentParser(description='Drive live pages with synthetic participants')
+    parser.add_argument('--server', default='http://127.0.0.1:8000')
+    parser.add_argument('--rest-key', default=environ.get('OTREE_REST_KEY'))
+    parser.add_argument('--app', action='append', choices=list(SCENARIOS) + ['all'], help='app to test (repeatable, or "all")')
+    parser.add_argument('--participants', type=int, default=50, help='participants per app')
+    parser.add_argument('--turns', type=int, default=5, help='conversation turns per participant')
+    parser.add_argument('--think', default='lognormal:4,0.5', help='think time between turns (see tools.stub_server)')
+    parser.add_argument('--reaction-rate', type=float, default=0.2, help='chance of an emoji reaction per turn')
+    parser.add_argument('--ramp-up', type=float, default=10.0, help='seconds over which participants connect')
+    parser.add_argument('--timeout', type=float, default=120.0, help='seconds to wait for each reply')
+    parser.add_argument('--sequential', action='store_true', help='test apps one after another instead of at once')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='also write the report to this json file')
+    args = parser.parse_args()
+    args.app = args.app or ['chat_complex']
+
+    report = asyncio.run(run(args))
+    print(json.dumps(report, indent=2, ensure_ascii=False))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+
+
+if __name__ == '__main__':
+    main()
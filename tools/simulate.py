@@ -0,0 +1,341 @@
+"""
+Headless LLM-vs-LLM pilots for the chat apps.
+
+Instead of piloting chat_complex, dictator_game or chat_japanese by chatting
+with the bot by hand, let a simulated participant do it. For each of N
+participants, an LLM playing a participant persona chats with the app's bot
+for a number of turns. The app's own code runs in-process against an
+in-memory oTree database: creating_session, the pages' before_next_page and
+the chat page's live_method, with the app's prompts, MsgOutputSchema and
+model settings. No server or browser is involved. At the end, the app's
+custom_export is written to a CSV file, in the same shape as the data tab.
+
+Dialogues run concurrently (--concurrency). All API requests, from the bots
+and from the simulated participants, share a rate limiter (--rpm), so a large
+pilot stays under the account's rate limit.
+
+    python -m tools.simulate --app chat_complex --participants 500 --turns 6 --rpm 3000
+
+Try it without an API key (and without cost) against the stub server:
+
+    python -m tools.simulate --app dictator_game --participants 50 --stub
+
+The persona of the simulated participant can be changed with --persona
+(text, or @file to read it from a file).
+
+With --batch, requests go to the OpenAI Batch API instead (see tools.batch):
+half the price and no per-minute limit, but each round of turns waits for a
+batch job. With --stub as well, batches are answered by a local, file-based
+stand-in (under _simulations/batches).
+
+--record DIR saves every API response, and --replay DIR reruns the same pilot
+(same --seed) from them without any network, e.g. to debug a transcript (see
+shared.replay). Use --concurrency 1 for an exact rerun: identical requests
+from different dialogues get the recorded replies in the order they arrive.
+"""
+
+import argparse
+import asyncio
+import csv
+import importlib
+import os
+import random
+import time
+from datetime import datetime
+from functools import partial
+from os import environ
+
+import httpx
+
+from tools.batch import BATCH_DISCOUNT, BatchTransport, LocalBatchBackend, OpenAIBatchBackend
+from tools.stub_server import StubServer
+
+
+########################################################
+# Settings                                             #
+########################################################
+
+APPS = ['chat_complex', 'dictator_game', 'chat_japanese']
+
+# chat page with the live method
+CHAT_PAGE = 'chat'
+
+OUTPUT_DIR = '_simulations'
+
+PERSONAS = {
+    'chat_complex': (
+        'You are a participant in an online study, chatting with another person. '
+        'Reply casually in one or two short sentences, like someone typing in a chat box. '
+        'Have your own opinions and sometimes disagree.'
+    ),
+    'dictator_game': (
+        'You are a participant in an economic experiment. Your chat partner decides whether to trust you, '
+        'and you want them to. Reply casually in one or two short sentences, like someone typing in a chat box.'
+    ),
+    'chat_japanese': (
+        'あなたはオンライン調査に参加している一般の日本人です。チャット相手と社会的な争点について話し合います。'
+        'チャット欄に打ち込むように、1〜2文の短くカジュアルな日本語で返信してください。'
+    ),
+}
+
+OPENING = {
+    'chat_complex': 'hi!',
+    'dictator_game': 'hi, nice to meet you',
+    'chat_japanese': 'こんにちは！',
+}
+
+
+########################################################
+# Rate limiting                                        #
+########################################################
+
+# httpx transport that waits for the rate limiter before each request
+class RateLimitedTransport(httpx.AsyncBaseTransport):
+
+    def __init__(self, inner, limiter):
+        self.inner = inner
+        self.limiter = limiter
+
+    async def handle_async_request(self, request):
+        await self.limiter.acquire()
+        return await self.inner.handle_async_request(request)
+
+    async def aclose(self):
+        await self.inner.aclose()
+
+
+########################################################
+# Simulated participant                                #
+########################################################
+
+class SimParticipant:
+
+    def __init__(self, app, player, persona, model, client, rng):
+        self.app = app
+        self.player = player
+        self.persona = persona
+        self.model = model
+        self.client = client
+        self.rng = rng
+        # (speaker, text), speaker is 'participant' or 'bot'
+        self.transcript = []
+
+    # the participant's next chat message
+    async def say(self):
+        from shared.llm import call_llm
+
+        if not self.transcript:
+            return OPENING[self.app]
+        messages = [{'role': 'system', 'content': self.persona}]
+        for speaker, text in self.transcript:
+            messages.append({'role': 'assistant' if speaker == 'participant' else 'user', 'content': text})
+        response = await call_llm(
+            lambda: self.client.chat.completions.create(model=self.model, messages=messages, temperature=1.0),
+            app='simulate',
+            bot='participant',
+            model=self.model,
+            name='participantTurn',
+        )
+        return response.choices[0].message.content.strip()
+
+    # answer a 1-5 opinion question (chat_japanese's pre/post chat questions)
+    async def opinion(self, question):
+        from shared.llm import call_llm
+
+        messages = [{'role': 'system', 'content': self.persona}]
+        for speaker, text in self.transcript:
+            messages.append({'role': 'assistant' if speaker == 'participant' else 'user', 'content': text})
+        messages.append({'role': 'user', 'content': f'{question}\n1: 強く反対 2: やや反対 3: どちらでもない 4: やや賛成 5: 強く賛成\n数字だけで答えてください。'})
+        response = await call_llm(
+            lambda: self.client.chat.completions.create(model=self.model, messages=messages, temperature=1.0),
+            app='simulate',
+            bot='participant',
+            model=self.model,
+            name='participantOpinion',
+        )
+        digits = [c for c in response.choices[0].message.content if c in '12345']
+        return int(digits[0]) if digits else self.rng.randint(1, 5)
+
+
+# send one message to the chat page's live method and return the replies to this player
+async def live(module, player, data):
+    page = getattr(module, CHAT_PAGE)
+    replies = []
+    async for reply in page.live_method(player, data):
+        if player.id_in_group in reply:
+            replies.append(reply[player.id_in_group])
+    return replies
+
+
+########################################################
+# Pages before and after the chat                      #
+########################################################
+
+async def before_chat(module, sim):
+    if sim.app == 'chat_japanese':
+        player = sim.player
+        player.pre_chat_opinion = await sim.opinion(player.topic_title)
+        module.PreChatQuestion.before_next_page(player, False)
+
+async def after_chat(module, sim):
+    if sim.app == 'chat_japanese':
+        player = sim.player
+        player.post_chat_opinion = await sim.opinion(player.topic_title)
+
+
+########################################################
+# Runner                                               #
+########################################################
+
+async def run_dialogue(module, sim, turns, stats):
+    await before_chat(module, sim)
+    for _ in range(turns):
+        text = await sim.say()
+        sim.transcript.append(('participant', text))
+        await live(module, sim.player, {'event': 'text', 'text': text})
+        stats['turns'] += 1
+
+        replies = await live(module, sim.player, {'event': 'botMsg'})
+        botTexts = [r['text'] for r in replies if r.get('event') == 'botText']
+        if not botTexts:
+            raise RuntimeError('the bot did not reply')
+        sim.transcript.append(('bot', botTexts[-1]))
+    await after_chat(module, sim)
+
+async def simulate(args):
+    from benchmarks.harness import setup_otree
+    from shared.llm import without_deadlines
+    from shared.replay import RECORD, REPLAY, ReplayTransport, get_store
+    from shared.scheduler import SCHEDULER
+    from shared.state import RateLimiter
+
+    setup_otree()
+    import openai
+    import otree.session
+
+    # the simulation limits itself with --concurrency and --rpm
+    SCHEDULER.concurrency = 0
+
+    module = importlib.import_module(args.app)
+    if args.stub:
+        inner = httpx.ASGITransport(app=StubServer(latency=args.stub_latency).app())
+        baseUrl = 'http://stub/v1'
+    else:
+        inner = httpx.AsyncHTTPTransport()
+        baseUrl = None
+    if args.batch:
+        # collect requests into batch jobs; the stub answers them through the file-based stand-in
+        if args.stub:
+            backend = LocalBatchBackend(os.path.join(OUTPUT_DIR, 'batches'), inner)
+        else:
+            backend = OpenAIBatchBackend(openai.AsyncOpenAI(api_key=environ.get('OPENAI_KEY')))
+        transport = BatchTransport(backend, window=args.batch_window, poll=args.batch_poll)
+        # call_llm retries failed batch lines, so the client shouldn't as well
+        clientOptions = dict(max_retries=0)
+    else:
+        limiter = RateLimiter(f'simulate:{os.getpid()}', args.rpm, 60.0)
+        transport = RateLimitedTransport(inner, limiter)
+        clientOptions = {}
+    if args.record or args.replay:
+        # answered from the store before the rate limit or a batch, so replays run at full speed
+        store = get_store(args.record or args.replay)
+        transport = ReplayTransport(transport, store, RECORD if args.record else REPLAY)
+        if args.replay:
+            clientOptions = dict(max_retries=0)
+    http = httpx.AsyncClient(transport=transport, timeout=120)
+    makeClient = partial(openai.AsyncOpenAI, base_url=baseUrl, http_client=http, **clientOptions)
+
+    # the app's bot and the simulated participants use the same connection
+    module.AsyncOpenAI = makeClient
+    client = makeClient(api_key=environ.get('OPENAI_KEY'))
+
+    session = otree.session.create_session(session_config_name=args.app, num_participants=args.participants)
+    players = [module.Player.objects_get(participant=pp) for pp in session.get_participants()]
+    print(f'[{args.app}] session {session.code}: {len(players)} simulated participants, {args.turns} turns each')
+
+    rng = random.Random(args.seed)
+    persona = args.persona or PERSONAS[args.app]
+    stats = dict(turns=0, done=0, failed=0)
+    # in batch mode every dialogue runs at once, so each round fills one batch
+    semaphore = asyncio.Semaphore(len(players) if args.batch else args.concurrency)
+    start = time.perf_counter()
+
+    async def one(player):
+        sim = SimParticipant(args.app, player, persona, args.participant_model, client, random.Random(rng.random()))
+        async with semaphore:
+            try:
+                await run_dialogue(module, sim, args.turns, stats)
+                stats['done'] += 1
+            except Exception as e:
+                stats['failed'] += 1
+                print(f'[{args.app}] participant {player.participant.code} failed: {e!r}')
+
+    try:
+        if args.batch:
+            # batches can take hours, so the apps' turn deadlines don't apply
+            with without_deadlines():
+                await asyncio.gather(*(one(p) for p in players))
+        else:
+            await asyncio.gather(*(one(p) for p in players))
+    finally:
+        await http.aclose()
+    elapsed = time.perf_counter() - start
+
+    path = args.out or os.path.join(OUTPUT_DIR, f"{args.app}-{datetime.now().strftime('%Y%m%d-%H%M%S')}.csv")
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    with open(path, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.writer(f)
+        for row in module.custom_export(players):
+            writer.writerow(row)
+
+    from shared.llm import COST
+    cost = COST.total() * (BATCH_DISCOUNT if args.batch else 1)
+    print(
+        f"[{args.app}] {stats['done']} dialogues done, {stats['failed']} failed, {stats['turns']} turns "
+        f"in {elapsed:.1f}s, estimated cost ${cost:.4f}"
+    )
+    if args.batch:
+        print(f'[{args.app}] {transport.requests} requests in {transport.batches} batches')
+    print(f'[{args.app}] wrote {path}')
+    return path
+
+
+########################################################
+# Command line                                         #
+########################################################
+
+def main():
+    parser = argparse.ArgumentParser(description='Pilot a chat app with simulated participants')
+    parser.add_argument('--app', choices=APPS, default='chat_complex')
+    parser.add_argument('--participants', type=int, default=20, help='simulated participants (one dialogue each)')
+    parser.add_argument('--turns', type=int, default=5, help='participant messages per dialogue')
+    parser.add_argument('--concurrency', type=int, default=50, help='dialogues running at once')
+    parser.add_argument('--rpm', type=int, default=500, help='API requests per minute, bots and participants together')
+    parser.add_argument('--participant-model', default='gpt-4o-mini', help='model playing the participant')
+    parser.add_argument('--persona', help='system prompt for the simulated participant (or @file)')
+    parser.add_argument('--out', help=f'csv file for the export (default {OUTPUT_DIR}/<app>-<time>.csv)')
+    parser.add_argument('--stub', action='store_true', help='use the offline stub server instead of the API')
+    parser.add_argument('--stub-latency', default='lognormal:1,0.5', help='stub reply latency (see tools.stub_server)')
+    parser.add_argument('--batch', action='store_true', help='send requests as Batch API jobs (half price, slower)')
+    parser.add_argument('--batch-window', type=float, default=2.0, help='seconds without new requests before a batch is submitted')
+    parser.add_argument('--batch-poll', type=float, default=30.0, help='seconds between batch status checks')
+    replay = parser.add_mutually_exclusive_group()
+    replay.add_argument('--record', metavar='DIR', help='save every API response to DIR (see shared.replay)')
+    replay.add_argument('--replay', metavar='DIR', help='answer every API request from DIR, without network')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    if args.persona and args.persona.startswith('@'):
+        with open(args.persona[1:], encoding='utf-8') as f:
+            args.persona = f.read()
+    if not args.stub and not args.replay:
+        # read the real key from .env before the stub default is set
+        from dotenv import load_dotenv
+        load_dotenv()
+    random.seed(args.seed)
+
+    asyncio.run(simulate(args))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,363 @@
+"""
+Local stand-in for the OpenAI and ElevenLabs APIs, for offline load and latency testing.
+
+Implements the endpoints the apps use:
+
+- POST /v1/responses                   (structured output via responses.parse)
+- POST /v1/chat/completions            (plain text, json_schema, and stream=True)
+- POST /v1/audio/transcriptions        (Whisper)
+- POST /v1/text-to-speech/{voice_id}   (ElevenLabs)
+- GET  /stats                          (request and injected error counts)
+
+Replies are deterministic: the same request always gets the same reply.
+Structured replies follow the json schema sent with the request, and values
+the apps assign in their instructions (sender, msgId, tone, reactions) are
+copied back, so each app's MsgOutputSchema parses exactly like a real reply.
+
+Usage:
+
+    python -m tools.stub_server --port 8001 --latency lognormal:0.8,0.5 --rate-limit-rate 0.02
+
+then start oTree with the apps pointed at it:
+
+    OPENAI_BASE_URL=http://127.0.0.1:8001/v1 ELEVENLABS_BASE_URL=http://127.0.0.1:8001 OPENAI_KEY=stub otree devserver
+"""
+
+import argparse
+import asyncio
+import hashlib
+import json
+import random
+import re
+import time
+from collections import Counter
+
+from starlette.applications import Starlette
+from starlette.responses import JSONResponse, Response, StreamingResponse
+from starlette.routing import Route
+
+
+########################################################
+# Latency distributions                                #
+########################################################
+
+# parse specs like 'fixed:0.5', 'uniform:0.2,1.5', 'normal:0.8,0.2' or 'lognormal:0.8,0.5'
+## for lognormal, the first value is the median in seconds and the second is sigma
+def parse_latency(spec: str):
+    kind, _, params = spec.partition(':')
+    values = [float(v) for v in params.split(',')] if params else []
+    if kind == 'fixed':
+        return lambda rng: values[0] if values else 0.0
+    if kind == 'uniform':
+        return lambda rng: rng.uniform(values[0], values[1])
+    if kind == 'normal':
+        return lambda rng: max(0.0, rng.gauss(values[0], values[1]))
+    if kind == 'lognormal':
+        import math
+        mu = math.log(values[0])
+        return lambda rng: rng.lognormvariate(mu, values[1])
+    raise ValueError(f'Unknown latency distribution {spec!r}')
+
+
+########################################################
+# Deterministic replies                                #
+########################################################
+
+STUB_REPLIES = [
+    'That is an interesting point, tell me more.',
+    'I see it a bit differently, but I get where you are coming from.',
+    'Good question! I am not completely sure, what do you think?',
+    'Honestly, I agree with most of that.',
+    'Hmm, I would push back on that a little.',
+]
+
+# stable hash of anything json-serializable
+def digest(obj) -> str:
+    return hashlib.sha256(json.dumps(obj, sort_keys=True, ensure_ascii=False, default=str).encode()).hexdigest()
+
+def stub_text(key: str) -> str:
+    return f'{STUB_REPLIES[int(key[:8], 16) % len(STUB_REPLIES)]} ({key[:6]})'
+
+# rough token count (about 4 characters per token)
+def count_tokens(obj) -> int:
+    return max(1, len(json.dumps(obj, ensure_ascii=False)) // 4)
+
+# collect all text sent in the request
+def request_text(messages) -> str:
+    if isinstance(messages, str):
+        return messages
+    parts = []
+    for m in messages or []:
+        content = m.get('content') if isinstance(m, dict) else m
+        if isinstance(content, list):
+            parts += [c.get('text', '') for c in content if isinstance(c, dict)]
+        else:
+            parts.append(str(content))
+    return '\n'.join(parts)
+
+# pull the 'instructions' strings out of the json the apps send as message content
+def instruction_text(messages) -> str:
+    found = []
+
+    def walk(obj):
+        if isinstance(obj, dict):
+            for k, v in obj.items():
+                if k == 'instructions' and isinstance(v, str):
+                    # chat_japanese json-encodes its instructions a second time
+                    try:
+                        v = json.loads(v) if v.startswith('"') else v
+                    except ValueError:
+                        pass
+                    found.append(v)
+                else:
+                    walk(v)
+        elif isinstance(obj, list):
+            for v in obj:
+                walk(v)
+        elif isinstance(obj, str):
+            try:
+                walk(json.loads(obj))
+            except ValueError:
+                pass
+
+    walk(messages)
+    # the most recent instructions come last
+    return '\n'.join(reversed(found)) if found else request_text(messages)
+
+# assigned values look like: 'msgId': B1-1712345678.123 (string),
+ASSIGNED_RE = re.compile(r"'(\w+)':\s*(.*?)\s*\((?:string|integer|boolean|文字列)\)")
+
+def assigned_values(text: str) -> dict:
+    values = {}
+    for name, value in ASSIGNED_RE.findall(text):
+        values.setdefault(name, value.strip())
+    return values
+
+# build an object matching a json schema
+## 'text' gets a canned reply, other fields copy the value assigned in the instructions
+def fill_schema(schema: dict, assigned: dict, key: str) -> dict:
+    out = {}
+    for name, prop in schema.get('properties', {}).items():
+        kind = prop.get('type')
+        value = assigned.get(name, '')
+        if kind in ('integer', 'number'):
+            m = re.search(r'-?\d+', value)
+            out[name] = int(m.group()) if m else 0
+        elif kind == 'boolean':
+            out[name] = value.lower() == 'true'
+        elif name == 'text':
+            out[name] = stub_text(key)
+        else:
+            out[name] = value or 'stub'
+    return out
+
+
+########################################################
+# Stub server                                          #
+########################################################
+
+class StubServer:
+
+    def __init__(self, latency='fixed:0', stream_latency=None, stt_latency='fixed:0', tts_latency='fixed:0',
+                 error_rate=0.0, rate_limit_rate=0.0, seed=0):
+        self.latency = parse_latency(latency)
+        self.stream_latency = parse_latency(stream_latency) if stream_latency else None
+        self.stt_latency = parse_latency(stt_latency)
+        self.tts_latency = parse_latency(tts_latency)
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.rng = random.Random(seed)
+        self.stats = Counter()
+
+    # sleep for a sampled latency and maybe return an injected error
+    async def simulate(self, endpoint, dist):
+        self.stats[f'{endpoint}.requests'] += 1
+        await asyncio.sleep(dist(self.rng))
+        roll = self.rng.random()
+        if roll < self.rate_limit_rate:
+            self.stats[f'{endpoint}.429'] += 1
+            wait = round(self.rng.uniform(0.2, 2.0), 3)
+            return JSONResponse(
+                {'error': {
+                    'message': f'Rate limit reached (stub). Please try again in {wait}s.',
+                    'type': 'requests',
+                    'code': 'rate_limit_exceeded',
+                }},
+                status_code=429,
+                headers={'retry-after': str(wait)},
+            )
+        if roll < self.rate_limit_rate + self.error_rate:
+            self.stats[f'{endpoint}.500'] += 1
+            return JSONResponse({'error': {'message': 'Injected server error (stub)', 'type': 'server_error'}}, status_code=500)
+        return None
+
+    def structured_reply(self, messages, schema, model):
+        key = digest([model, messages])
+        if schema:
+            assigned = assigned_values(instruction_text(messages))
+            return json.dumps(fill_schema(schema, assigned, key), ensure_ascii=False)
+        return stub_text(key)
+
+    # openai responses api
+    async def responses(self, request):
+        body = await request.json()
+        error = await self.simulate('responses', self.latency)
+        if error:
+            return error
+        fmt = (body.get('text') or {}).get('format') or {}
+        messages = body.get('input')
+        text = self.structured_reply(messages, fmt.get('schema'), body.get('model'))
+        inputTokens, outputTokens = count_tokens(messages), count_tokens(text)
+        now = int(time.time())
+        return JSONResponse({
+            'id': f'resp_stub{digest([messages, now])[:24]}',
+            'object': 'response',
+            'created_at': now,
+            'status': 'completed',
+            'model': body.get('model'),
+            'output': [{
+                'type': 'message',
+                'id': f'msg_stub{digest(text)[:24]}',
+                'status': 'completed',
+                'role': 'assistant',
+                'content': [{'type': 'output_text', 'text': text, 'annotations': []}],
+            }],
+            'parallel_tool_calls': True,
+            'tool_choice': 'auto',
+            'tools': [],
+            'text': body.get('text') or {'format': {'type': 'text'}},
+            'usage': {
+                'input_tokens': inputTokens,
+                'input_tokens_details': {'cached_tokens': 0},
+                'output_tokens': outputTokens,
+                'output_tokens_details': {'reasoning_tokens': 0},
+                'total_tokens': inputTokens + outputTokens,
+            },
+        })
+
+    # openai chat completions api, with optional streaming
+    async def chat_completions(self, request):
+        body = await request.json()
+        stream = body.get('stream', False)
+        error = await self.simulate('chat.completions', self.stream_latency if stream and self.stream_latency else self.latency)
+        if error:
+            return error
+        fmt = body.get('response_format') or {}
+        schema = (fmt.get('json_schema') or {}).get('schema') if fmt.get('type') == 'json_schema' else None
+        messages = body.get('messages')
+        model = body.get('model')
+        text = self.structured_reply(messages, schema, model)
+        completionId = f'chatcmpl-stub{digest([messages, time.time()])[:20]}'
+        now = int(time.time())
+        usage = {
+            'prompt_tokens': count_tokens(messages),
+            'completion_tokens': count_tokens(text),
+            'total_tokens': count_tokens(messages) + count_tokens(text),
+            'prompt_tokens_details': {'cached_tokens': 0},
+        }
+
+        if not stream:
+            return JSONResponse({
+                'id': completionId,
+                'object': 'chat.completion',
+                'created': now,
+                'model': model,
+                'choices': [{
+                    'index': 0,
+                    'message': {'role': 'assistant', 'content': text},
+                    'finish_reason': 'stop',
+                }],
+                'usage': usage,
+            })
+
+        # stream the reply a few characters at a time
+        async def events():
+            def chunk(delta, finish=None, withUsage=False):
+                data = {
+                    'id': completionId,
+                    'object': 'chat.completion.chunk',
+                    'created': now,
+                    'model': model,
+                    'choices': [{'index': 0, 'delta': delta, 'finish_reason': finish}],
+                }
+                if withUsage:
+                    data['usage'] = usage
+                return f'data: {json.dumps(data, ensure_ascii=False)}\n\n'
+
+            yield chunk({'role': 'assistant', 'content': ''})
+            for i in range(0, len(text), 8):
+                yield chunk({'content': text[i:i + 8]})
+                await asyncio.sleep(self.latency(self.rng) / 50)
+            yield chunk({}, 'stop', (body.get('stream_options') or {}).get('include_usage', False))
+            yield 'data: [DONE]\n\n'
+
+        return StreamingResponse(events(), media_type='text/event-stream')
+
+    # whisper transcription
+    async def transcriptions(self, request):
+        audio = await request.body()
+        error = await self.simulate('audio.transcriptions', self.stt_latency)
+        if error:
+            return error
+        key = hashlib.sha256(audio).hexdigest()
+        return JSONResponse({'text': f'Stub transcript {key[:8]}, hello there.'})
+
+    # elevenlabs text to speech
+    async def text_to_speech(self, request):
+        body = await request.json()
+        error = await self.simulate('text_to_speech', self.tts_latency)
+        if error:
+            return error
+        # about 60 ms of silent mp3 per character
+        numFrames = max(1, len(body.get('text', '')) * 60 // 26)
+        return Response(SILENT_MP3_FRAME * numFrames, media_type='audio/mpeg')
+
+    async def get_stats(self, request):
+        return JSONResponse(dict(self.stats))
+
+    def app(self):
+        return Starlette(routes=[
+            Route('/v1/responses', self.responses, methods=['POST']),
+            Route('/v1/chat/completions', self.chat_completions, methods=['POST']),
+            Route('/v1/audio/transcriptions', self.transcriptions, methods=['POST']),
+            Route('/v1/text-to-speech/{voice_id}', self.text_to_speech, methods=['POST']),
+            Route('/stats', self.get_stats, methods=['GET']),
+        ])
+
+
+# one silent MPEG-1 layer III frame (128 kbps, 44.1 kHz, ~26 ms)
+SILENT_MP3_FRAME = bytes([0xFF, 0xFB, 0x90, 0x64]) + bytes(413)
+
+
+########################################################
+# Command line                                         #
+########################################################
+
+def main():
+    parser = argparse.ArgumentParser(description='Local stub of the OpenAI and ElevenLabs APIs')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8001)
+    parser.add_argument('--latency', default='lognormal:0.8,0.5', help='LLM latency distribution')
+    parser.add_argument('--stream-latency', default=None, help='time to first token for streamed completions (defaults to --latency)')
+    parser.add_argument('--stt-latency', default='lognormal:0.6,0.4')
+    parser.add_argument('--tts-latency', default='lognormal:0.9,0.4')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of requests that fail with 500')
+    parser.add_argument('--rate-limit-rate', type=float, default=0.0, help='fraction of requests that fail with 429')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    import uvicorn
+    server = StubServer(
+        latency=args.latency,
+        stream_latency=args.stream_latency,
+        stt_latency=args.stt_latency,
+        tts_latency=args.tts_latency,
+        error_rate=args.error_rate,
+        rate_limit_rate=args.rate_limit_rate,
+        seed=args.seed,
+    )
+    uvicorn.run(server.app(), host=args.host, port=args.port, log_level='warning')
+
+
+if __name__ == '__main__':
+    main()
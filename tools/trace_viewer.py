@@ -0,0 +1,214 @@
+"""
+Per-message waterfall timelines from a trace file.
+
+Reads the spans written with TRACE_EXPORT=json and shows each live method
+message as a waterfall: one bar per stage (cache decode, API calls, database
+writes, uploads, ...), positioned by when it started and ended relative to the
+message.
+
+Usage:
+
+    python -m tools.trace_viewer _traces/spans.jsonl                      # text, all messages
+    python -m tools.trace_viewer _traces/spans.jsonl --session abc123 --slowest 20
+    python -m tools.trace_viewer _traces/spans.jsonl --html waterfall.html # open in a browser
+"""
+
+import argparse
+import html
+import json
+import sys
+from collections import defaultdict
+
+BAR_WIDTH = 50
+
+
+########################################################
+# Loading                                              #
+########################################################
+
+def load_spans(path):
+    spans = []
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                spans.append(json.loads(line))
+    return spans
+
+# group spans into traces: [{root, spans (in start order, with depth), duration}]
+def build_traces(spans, session=None, participant=None, app=None):
+    byTrace = defaultdict(list)
+    for s in spans:
+        byTrace[s['traceId']].append(s)
+
+    traces = []
+    for traceSpans in byTrace.values():
+        root = next((s for s in traceSpans if not s['parentId']), None)
+        if root is None:
+            continue
+        attrs = root['attributes']
+        if session and attrs.get('session') != session:
+            continue
+        if participant and attrs.get('participant') != participant:
+            continue
+        if app and attrs.get('app') != app:
+            continue
+
+        # depth of each span below the root
+        byId = {s['spanId']: s for s in traceSpans}
+        def depth(s):
+            d = 0
+            while s['parentId'] and s['parentId'] in byId:
+                s = byId[s['parentId']]
+                d += 1
+            return d
+
+        ordered = sorted(traceSpans, key=lambda s: (s['start'], depth(s)))
+        traces.append(dict(
+            root=root,
+            spans=[dict(s, depth=depth(s)) for s in ordered],
+            duration=(root['end'] - root['start']) / 1e6,
+        ))
+    traces.sort(key=lambda t: t['root']['start'])
+    return traces
+
+
+########################################################
+# Text output                                          #
+########################################################
+
+def _bar(span, root, width=BAR_WIDTH):
+    total = max(root['end'] - root['start'], 1)
+    left = int((span['start'] - root['start']) / total * width)
+    right = max(left + 1, int((span['end'] - root['start']) / total * width))
+    return ' ' * left + '#' * (min(right, width) - left)
+
+def _label(span):
+    extras = [f"{k}={span['attributes'][k]}" for k in ('bot', 'model', 'attempts', 'prompt_tokens') if span['attributes'].get(k)]
+    return ('  ' * span['depth'] + span['name'] + (' ' + ' '.join(extras) if extras else ''))
+
+def print_trace(trace, out=sys.stdout):
+    root = trace['root']
+    attrs = root['attributes']
+    status = '' if root['status'] == 'ok' else f"  ERROR {attrs.get('error', '')}"
+    out.write(
+        f"\n{root['name']}  {trace['duration']:.1f} ms  "
+        f"session={attrs.get('session')} participant={attrs.get('participant')}{status}\n"
+    )
+    for s in trace['spans']:
+        ms = (s['end'] - s['start']) / 1e6
+        offset = (s['start'] - root['start']) / 1e6
+        flag = ' !' if s['status'] != 'ok' else ''
+        out.write(f"  {_label(s)[:48]:48s} {offset:8.1f} {ms:8.1f} ms |{_bar(s, root):{BAR_WIDTH}s}|{flag}\n")
+
+# time spent in each stage over all traces
+def print_summary(traces, out=sys.stdout):
+    totals = defaultdict(list)
+    for t in traces:
+        for s in t['spans']:
+            if s['depth'] > 0:
+                totals[s['name']].append((s['end'] - s['start']) / 1e6)
+    out.write(f"\n{'stage':32s} {'count':>6s} {'mean ms':>9s} {'max ms':>9s} {'total ms':>10s}\n")
+    for name, values in sorted(totals.items(), key=lambda kv: -sum(kv[1])):
+        out.write(f'{name:32s} {len(values):6d} {sum(values) / len(values):9.1f} {max(values):9.1f} {sum(values):10.1f}\n')
+
+
+########################################################
+# HTML output                                          #
+########################################################
+
+HTML_PAGE = """<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<title>Message traces</title>
+<style>
+body {{ font-family: sans-serif; font-size: 13px; margin: 20px; }}
+details {{ border-bottom: 1px solid #ddd; padding: 4px 0; }}
+summary {{ cursor: pointer; }}
+.error {{ color: #b00; }}
+table {{ border-collapse: collapse; width: 100%; margin: 6px 0 10px; }}
+td {{ padding: 1px 6px; white-space: nowrap; }}
+td.name {{ width: 28%; }}
+td.ms {{ width: 7%; text-align: right; color: #555; }}
+td.lane {{ width: 65%; position: relative; }}
+.bar {{ position: absolute; top: 3px; height: 12px; background: #4a7bd0; border-radius: 2px; min-width: 2px; }}
+.bar.llm {{ background: #d0843b; }}
+.bar.stt, .bar.tts {{ background: #8b5fc7; }}
+.bar.db, .bar.cache {{ background: #3b9e6a; }}
+.bar.err {{ background: #c33; }}
+.mark {{ position: absolute; top: 0; height: 18px; width: 1px; background: #000; }}
+</style>
+</head>
+<body>
+<h2>Message traces ({count})</h2>
+<p>Click a message to see its waterfall. Black ticks mark replies sent to the page.</p>
+{traces}
+</body>
+</html>
+"""
+
+def _html_trace(trace):
+    root = trace['root']
+    attrs = root['attributes']
+    total = max(root['end'] - root['start'], 1)
+    rows = []
+    for s in trace['spans']:
+        left = (s['start'] - root['start']) / total * 100
+        width = (s['end'] - s['start']) / total * 100
+        kind = 'err' if s['status'] != 'ok' else s['name'].split('.')[0]
+        marks = ''.join(
+            f'<div class="mark" style="left:{(e["time"] - root["start"]) / total * 100:.2f}%"></div>'
+            for e in s['events']
+        )
+        title = html.escape(json.dumps(s['attributes'], default=str))
+        rows.append(
+            f'<tr title="{title}"><td class="name">{"&nbsp;" * 4 * s["depth"]}{html.escape(s["name"])}</td>'
+            f'<td class="ms">{(s["end"] - s["start"]) / 1e6:.1f} ms</td>'
+            f'<td class="lane"><div class="bar {kind}" style="left:{left:.2f}%;width:{width:.2f}%"></div>{marks}</td></tr>'
+        )
+    error = f' <span class="error">ERROR {html.escape(str(attrs.get("error", "")))}</span>' if root['status'] != 'ok' else ''
+    return (
+        f'<details><summary><b>{html.escape(root["name"])}</b> {trace["duration"]:.1f} ms '
+        f'&middot; session {html.escape(str(attrs.get("session")))} &middot; participant {html.escape(str(attrs.get("participant")))}{error}</summary>'
+        f'<table>{"".join(rows)}</table></details>'
+    )
+
+def write_html(traces, path):
+    with open(path, 'w') as f:
+        f.write(HTML_PAGE.format(count=len(traces), traces='\n'.join(_html_trace(t) for t in traces)))
+
+
+########################################################
+# Command line                                         #
+########################################################
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Show per-message waterfall timelines from a trace file.')
+    parser.add_argument('file', nargs='?', default='_traces/spans.jsonl', help='spans written with TRACE_EXPORT=json')
+    parser.add_argument('--session', help='only this session code')
+    parser.add_argument('--participant', help='only this participant code')
+    parser.add_argument('--app', help='only this app')
+    parser.add_argument('--slowest', type=int, help='only the N slowest messages')
+    parser.add_argument('--html', help='write an html page here instead of printing')
+    args = parser.parse_args(argv)
+
+    traces = build_traces(load_spans(args.file), args.session, args.participant, args.app)
+    if args.slowest:
+        traces = sorted(traces, key=lambda t: -t['duration'])[:args.slowest]
+
+    if args.html:
+        write_html(traces, args.html)
+        print(f'Wrote {len(traces)} traces to {args.html}')
+        return
+
+    for trace in traces:
+        print_trace(trace)
+    if traces:
+        print_summary(traces)
+    else:
+        print('No traces found.')
+
+
+if __name__ == '__main__':
+    main()
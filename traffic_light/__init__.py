@@ -5,6 +5,10 @@ import random
 import json
 from pydantic import BaseModel 
 import asyncio
+from shared.tracing import trace_live_method
+from shared.log import get_logger
+
+logger = get_logger(__name__)
 
 doc = """
 Traffic Light Game (Red Light Green Light) with LLM Agents.
@@ -108,7 +112,7 @@ async def get_bot_decision(light_color, position):
         )
         return json.loads(response.choices[0].message.content)
     except Exception as e:
-        print(f"LLM Error: {e}")
+        logger.error(f"LLM Error: {e}")
         # Fallback simple logic
         if light_color == 'GREEN': return {'decision': 'MOVE'}
         return {'decision': 'WAIT'}
@@ -144,6 +148,7 @@ class chat(Page):
 
 
     @staticmethod
+    @trace_live_method(__name__)
     async def live_method(player: Player, data):
         import time
         import random